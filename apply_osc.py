@@ -0,0 +1,369 @@
+"""
+Apply OpenStreetMap change files (osmChange XML, optionally gzipped) to the
+route tables, instead of re-importing the whole extract:
+
+    python apply_osc.py postgresql:///scenicstroll 2016-05-01.osc.gz \
+        --scenery rasters/current.arr
+
+Created, modified and deleted nodes and ways are applied to `node`, `way`
+and `waypoint`, with the same bbox and walkable way types as the importer.
+Only the affected ways (those changed, or passing through a changed node)
+have their waypoints' `cdist` and `cscore` recomputed, and only the nodes on
+them their `num_ways`. New and moved nodes are scored with the scenery
+raster, if given; otherwise moved nodes keep their scores, and new nodes on
+ways get the mean score of the other nodes on their ways (or of all nodes)
+until the next `update_scores`. The data version is bumped, so the app
+reloads its graph (and ignores stale snapshots and landmark tables).
+
+A changed way is only applied if all its nodes are in the database or in
+the changes; otherwise (e.g. a way newly made walkable through nodes left
+out by `parse_osm.py --referenced-only`, or one crossing the bbox) it is
+left as it was, and the number of such ways is logged.
+
+Several files are merged in the order given, later changes to an element
+replacing earlier ones, and applied in one transaction.
+"""
+
+import gzip
+import numpy as np
+from parse_osm import CopyWriter, Logger, _inside_bbox, _way_tags, type_id
+from scenicstroll.arrayfile import load_arrays
+from scenicstroll.route_db import RouteDB
+from scenicstroll.scenery import SceneryRaster
+from xml.etree.cElementTree import iterparse
+
+
+ACTIONS = ('create', 'modify', 'delete')
+
+
+def read_osc(paths, bbox):
+    """
+    Merged changes from osmChange files. Returns nodes as {id: (lon, lat)}
+    and ways as {id: (name, type_id, refs)}, with None for elements that are
+    deleted, or leave the bbox or stop being walkable.
+    """
+
+    nodes, ways = {}, {}
+
+    for path in paths:
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rb') as f:
+            action = None
+            for event, elem in iterparse(f, ('start', 'end')):
+
+                if elem.tag in ACTIONS:
+                    action = elem.tag if event == 'start' else None
+                    continue
+
+                if event != 'end' or action is None:
+                    continue
+
+                if elem.tag == 'node':
+                    node_id = int(elem.get('id'))
+                    if action == 'delete':
+                        nodes[node_id] = None
+                    else:
+                        x, y = float(elem.get('lon')), float(elem.get('lat'))
+                        nodes[node_id] = ((x, y) if _inside_bbox(x, y, bbox)
+                                          else None)
+                    elem.clear()
+
+                elif elem.tag == 'way':
+                    way_id = int(elem.get('id'))
+                    tags = (_way_tags((tag.get('k'), tag.get('v'))
+                                      for tag in elem.iterfind('tag'))
+                            if action != 'delete' else None)
+                    if tags is None:
+                        ways[way_id] = None
+                    else:
+                        name, way_type = tags
+                        refs = [int(nd.get('ref'))
+                                for nd in elem.iterfind('nd')]
+                        ways[way_id] = (name, type_id[way_type], refs)
+                    elem.clear()
+
+    return nodes, ways
+
+
+def _stage_changes(session, nodes, ways, batch_size):
+    """
+    Copy the changes into temporary tables osc_node, osc_way and
+    osc_waypoint.
+    """
+
+    session.execute(
+        'CREATE TEMPORARY TABLE osc_node (id BIGINT PRIMARY KEY, '
+        'lon DOUBLE PRECISION, lat DOUBLE PRECISION, deleted BOOLEAN) '
+        'ON COMMIT DROP')
+    session.execute(
+        'CREATE TEMPORARY TABLE osc_way (id BIGINT PRIMARY KEY, name TEXT, '
+        'way_type_id INTEGER, deleted BOOLEAN) ON COMMIT DROP')
+    session.execute(
+        'CREATE TEMPORARY TABLE osc_waypoint (way_id BIGINT, idx INTEGER, '
+        'node_id BIGINT) ON COMMIT DROP')
+
+    cursor = session.connection().connection.cursor()
+
+    writer = CopyWriter(cursor, 'osc_node', ('id', 'lon', 'lat', 'deleted'),
+                        batch_size)
+    for node_id, loc in nodes.items():
+        writer.write((node_id,) + (loc if loc else (None, None)) +
+                     (loc is None,))
+    writer.close()
+
+    writer = CopyWriter(cursor, 'osc_way',
+                        ('id', 'name', 'way_type_id', 'deleted'), batch_size)
+    waypoints = CopyWriter(cursor, 'osc_waypoint',
+                           ('way_id', 'idx', 'node_id'), batch_size)
+    for way_id, way in ways.items():
+        if way is None:
+            writer.write((way_id, None, None, True))
+            continue
+        name, way_type_id, refs = way
+        writer.write((way_id, name, way_type_id, False))
+        for i, node_id in enumerate(refs):
+            waypoints.write((way_id, i, node_id))
+    writer.close()
+    waypoints.close()
+
+    session.execute('ANALYZE osc_node')
+    session.execute('ANALYZE osc_way')
+    session.execute('ANALYZE osc_waypoint')
+
+
+def _skip_incomplete_ways(session):
+    """
+    Remove the changed ways with nodes that are neither stored nor created
+    by the changes (or are deleted by them) from the staged changes. Returns
+    the numbers of ways and of missing nodes.
+    """
+
+    session.execute(
+        'CREATE TEMPORARY TABLE osc_incomplete_way ON COMMIT DROP AS '
+        'SELECT osc_waypoint.way_id AS id, '
+        '       COUNT(DISTINCT osc_waypoint.node_id) AS missing '
+        'FROM osc_waypoint '
+        'LEFT JOIN osc_node ON osc_node.id = osc_waypoint.node_id '
+        'LEFT JOIN node ON node.id = osc_waypoint.node_id '
+        'WHERE osc_node.deleted OR (osc_node.id IS NULL AND node.id IS NULL) '
+        'GROUP BY osc_waypoint.way_id')
+    session.execute(
+        'DELETE FROM osc_way USING osc_incomplete_way '
+        'WHERE osc_way.id = osc_incomplete_way.id')
+    session.execute(
+        'DELETE FROM osc_waypoint USING osc_incomplete_way '
+        'WHERE osc_waypoint.way_id = osc_incomplete_way.id')
+
+    num_ways, num_missing = session.execute(
+        'SELECT COUNT(*), COALESCE(SUM(missing), 0) '
+        'FROM osc_incomplete_way').first()
+    return num_ways, num_missing
+
+
+def _score_nodes(session, raster, batch_size):
+    """
+    Score the created and moved nodes with the scenery raster.
+    """
+
+    rows = session.execute(
+        'SELECT id, lon, lat FROM osc_node WHERE NOT deleted').fetchall()
+    if not rows:
+        return 0
+
+    ids, lon, lat = zip(*rows)
+    scores = raster.score_samples(np.column_stack((lon, lat)))
+
+    session.execute(
+        'CREATE TEMPORARY TABLE osc_score (id BIGINT PRIMARY KEY, '
+        'score DOUBLE PRECISION) ON COMMIT DROP')
+    writer = CopyWriter(session.connection().connection.cursor(), 'osc_score',
+                        ('id', 'score'), batch_size)
+    for row in zip(ids, scores.tolist()):
+        writer.write(row)
+    writer.close()
+
+    session.execute(
+        'UPDATE node SET score = osc_score.score '
+        'FROM osc_score WHERE node.id = osc_score.id')
+    return len(rows)
+
+
+def _fill_scores(session):
+    """
+    Give the unscored nodes on the affected ways the mean score of the
+    other nodes on their ways, or else of all nodes, so that the cumulative
+    scores along the ways count them. Returns the number of nodes filled in.
+    """
+
+    num_way_mean = session.execute(
+        'UPDATE node SET score = t.score '
+        'FROM ('
+        '  SELECT unscored.node_id AS id, AVG(other.score) AS score'
+        '  FROM waypoint AS unscored'
+        '  JOIN affected_way ON affected_way.id = unscored.way_id'
+        '  JOIN node AS n ON n.id = unscored.node_id AND n.score IS NULL'
+        '  JOIN waypoint AS on_way ON on_way.way_id = unscored.way_id'
+        '  JOIN node AS other ON other.id = on_way.node_id'
+        '  GROUP BY unscored.node_id'
+        ') t '
+        'WHERE node.id = t.id AND t.score IS NOT NULL').rowcount
+
+    unscored = (
+        'SELECT waypoint.node_id FROM waypoint '
+        'JOIN affected_way ON affected_way.id = waypoint.way_id')
+    num_mean = session.execute(
+        'UPDATE node SET score = (SELECT AVG(score) FROM node) '
+        'WHERE score IS NULL AND id IN ({})'.format(unscored)).rowcount
+
+    num_left = session.execute(
+        'SELECT COUNT(*) FROM node '
+        'WHERE score IS NULL AND id IN ({})'.format(unscored)).scalar()
+    if num_left:
+        raise ValueError(
+            '{} nodes on changed ways have no score and there are no scores '
+            'to fill them in from: give a scenery raster, or run '
+            'update_scores first'.format(num_left))
+
+    return num_way_mean + num_mean
+
+
+def apply_changes(session, nodes, ways, log, raster=None, batch_size=10000):
+    """
+    Apply node and way changes (as from `read_osc`) to the route tables and
+    recompute the derived columns of the affected ways and nodes. Returns
+    the new data version.
+    """
+
+    _stage_changes(session, nodes, ways, batch_size)
+
+    num_skipped, num_missing = _skip_incomplete_ways(session)
+    if num_skipped:
+        log.write('skipped {} ways with {} nodes that are not stored'.format(
+            num_skipped, num_missing))
+
+    # ways to rebuild or recompute, and nodes whose way count may change,
+    # taken before any waypoints are removed
+    session.execute(
+        'CREATE TEMPORARY TABLE affected_way ON COMMIT DROP AS '
+        'SELECT id FROM osc_way '
+        'UNION SELECT DISTINCT waypoint.way_id FROM waypoint '
+        'JOIN osc_node ON osc_node.id = waypoint.node_id')
+    session.execute(
+        'CREATE TEMPORARY TABLE affected_node ON COMMIT DROP AS '
+        'SELECT waypoint.node_id AS id FROM waypoint '
+        'JOIN affected_way ON affected_way.id = waypoint.way_id '
+        'UNION SELECT node_id FROM osc_waypoint '
+        'UNION SELECT id FROM osc_node')
+
+    # changed ways are rewritten from scratch; other ways just lose
+    # waypoints at deleted nodes
+    session.execute(
+        'DELETE FROM waypoint USING osc_way '
+        'WHERE waypoint.way_id = osc_way.id')
+    session.execute(
+        'DELETE FROM waypoint USING osc_node '
+        'WHERE waypoint.node_id = osc_node.id AND osc_node.deleted')
+
+    # nodes
+    session.execute(
+        'DELETE FROM node USING osc_node '
+        'WHERE node.id = osc_node.id AND osc_node.deleted')
+    session.execute(
+        'INSERT INTO node (id, loc, num_ways) '
+        'SELECT id, CAST(ST_SetSRID(ST_MakePoint(lon, lat), 4326) '
+        '            AS geography), 0 '
+        'FROM osc_node WHERE NOT deleted '
+        'ON CONFLICT (id) DO UPDATE SET loc = EXCLUDED.loc')
+
+    # ways and their waypoints, all of whose nodes we have
+    session.execute(
+        'DELETE FROM way USING osc_way '
+        'WHERE way.id = osc_way.id AND osc_way.deleted')
+    session.execute(
+        'INSERT INTO way (id, name, way_type_id) '
+        'SELECT id, name, way_type_id FROM osc_way WHERE NOT deleted '
+        'ON CONFLICT (id) DO UPDATE '
+        'SET name = EXCLUDED.name, way_type_id = EXCLUDED.way_type_id')
+    session.execute(
+        'INSERT INTO waypoint (way_id, idx, node_id) '
+        'SELECT way_id, idx, node_id FROM osc_waypoint')
+
+    if raster is not None:
+        log.write('scored {} nodes'.format(
+            _score_nodes(session, raster, batch_size)))
+
+    num_filled = _fill_scores(session)
+    if num_filled:
+        log.write('filled in scores of {} nodes'.format(num_filled))
+
+    # cumulative distances and scores along the affected ways
+    session.execute(
+        'WITH wp AS ('
+        '  SELECT waypoint.id, waypoint.way_id, waypoint.idx, node.score,'
+        '         COALESCE(ST_Distance(lag(node.loc) OVER w, node.loc), 0)'
+        '           AS step'
+        '  FROM waypoint'
+        '  JOIN affected_way ON affected_way.id = waypoint.way_id'
+        '  JOIN node ON node.id = waypoint.node_id'
+        '  WINDOW w AS (PARTITION BY waypoint.way_id ORDER BY waypoint.idx)'
+        ') '
+        'UPDATE waypoint SET cdist = t.cdist, cscore = t.cscore '
+        'FROM ('
+        '  SELECT id, SUM(step) OVER w AS cdist, SUM(score) OVER w AS cscore'
+        '  FROM wp'
+        '  WINDOW w AS (PARTITION BY way_id ORDER BY idx)'
+        ') t '
+        'WHERE waypoint.id = t.id')
+
+    # number of ways through each affected node
+    session.execute(
+        'UPDATE node SET num_ways = t.num_ways '
+        'FROM ('
+        '  SELECT affected_node.id, COUNT(waypoint.node_id) AS num_ways'
+        '  FROM affected_node'
+        '  LEFT JOIN waypoint ON waypoint.node_id = affected_node.id'
+        '  GROUP BY affected_node.id'
+        ') t '
+        'WHERE node.id = t.id')
+
+    num_ways, num_nodes = (session.execute(
+        'SELECT (SELECT COUNT(*) FROM affected_way), '
+        '       (SELECT COUNT(*) FROM affected_node)').first())
+    log.write('updated {} ways and {} nodes'.format(num_ways, num_nodes))
+
+    version = RouteDB(session).bump_data_version()
+    session.commit()
+    return version
+
+
+if __name__ == '__main__':
+
+    import sys
+    from argparse import ArgumentParser
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+
+    parser = ArgumentParser()
+    parser.add_argument('url', type=str, help='database URL')
+    parser.add_argument('input', type=str, nargs='+',
+                        help='osmChange files, oldest first')
+    parser.add_argument(
+            '--bbox',
+            type=lambda s: [float(c) for c in s.split(',')],
+            default='-122.525,37.6936,-122.3499,37.8152',
+            help='xmin,ymin,xmax,ymax')
+    parser.add_argument('--scenery', type=str, default=None,
+                        help='scenery raster to score new and moved nodes')
+    args = parser.parse_args()
+
+    log = Logger(sys.stdout)
+    nodes, ways = read_osc(args.input, args.bbox)
+    log.write('read changes to {} nodes and {} ways'.format(
+        len(nodes), len(ways)))
+
+    raster = (SceneryRaster.from_arrays(*load_arrays(args.scenery))
+              if args.scenery else None)
+
+    Session = sessionmaker(bind=create_engine(args.url))
+    version = apply_changes(Session(), nodes, ways, log, raster)
+    log.write('data version is now {}'.format(version))
@@ -0,0 +1,144 @@
+"""
+Load test a running server: replay route queries from a number of client
+threads at each of several concurrency levels, and report throughput and
+latency percentiles for each level:
+
+    python -m benchmarks.load http://localhost:8000 pairs.tsv --threads 1,2,4,8
+
+`pairs.tsv` has two addresses per line, separated by a tab. Run the server
+with several worker threads (e.g. `gunicorn --threads 8 app:app`) and, to
+measure routing rather than the route cache, with ROUTE_CACHE_SIZE = 0.
+`benchmarks.synthetic_server` serves a synthetic city the same way without a
+database.
+"""
+
+import json
+import numpy as np
+import sys
+from benchmarks.query import summarize
+from threading import Thread
+from time import perf_counter
+from urllib.error import URLError
+from urllib.parse import urlencode
+from urllib.request import urlopen
+
+
+def read_pairs(path):
+    with open(path) as f:
+        return [tuple(line.rstrip('\n').split('\t')[:2])
+                for line in f if line.strip()]
+
+
+def post(url, params, timeout):
+    """
+    POST the form and return whether the server found a route.
+    """
+
+    body = urlencode(params).encode('utf-8')
+    with urlopen(url, body, timeout) as response:
+        return json.loads(response.read().decode('utf-8'))['success']
+
+
+def run_level(url, queries, num_threads, timeout):
+    """
+    Send the queries from `num_threads` threads, each taking the next query
+    until none are left. Returns the latencies of successful requests, the
+    number of failures and the wall time.
+    """
+
+    queue = iter(queries)
+    times = [[] for _ in range(num_threads)]
+    failures = [0]*num_threads
+
+    def client(k):
+        for params in queue:
+            start = perf_counter()
+            try:
+                ok = post(url, params, timeout)
+            except (URLError, OSError, ValueError):
+                ok = False
+            if ok:
+                times[k].append(perf_counter() - start)
+            else:
+                failures[k] += 1
+
+    threads = [Thread(target=client, args=(k,)) for k in range(num_threads)]
+    start = perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return sum(times, []), sum(failures), perf_counter() - start
+
+
+def main(args):
+
+    rng = np.random.RandomState(args.seed)
+    pairs = read_pairs(args.pairs)
+    url = args.server.rstrip('/') + '/query'
+
+    queries = []
+    for k in rng.randint(len(pairs), size=args.queries).tolist():
+        queries.append(dict(address1=pairs[k][0], address2=pairs[k][1],
+                            alpha=repr(float(rng.uniform(*args.alpha)))))
+
+    # warm up caches and connections
+    run_level(url, queries[:args.warmup], 1, args.timeout)
+
+    levels = {}
+    for num_threads in args.threads:
+        times, failures, wall = run_level(url, queries, num_threads,
+                                          args.timeout)
+        level = summarize(times) if times else dict(count=0)
+        level.update(failures=failures, wall_s=wall,
+                     requests_per_s=len(times)/wall)
+        levels[str(num_threads)] = level
+
+    return dict(params=vars(args), levels=levels)
+
+
+def report(results):
+
+    print('{:>7} {:>9} {:>9} {:>9} {:>9} {:>9}'.format(
+        'threads', 'req/s', 'speedup', 'p50 ms', 'p95 ms', 'failures'))
+
+    base = None
+    for num_threads, level in results['levels'].items():
+        if base is None:
+            base = level['requests_per_s']
+        print('{:>7} {:>9.1f} {:>8.2f}x {:>9.1f} {:>9.1f} {:>9}'.format(
+            num_threads, level['requests_per_s'],
+            level['requests_per_s']/base if base else 0.,
+            level.get('p50_ms', float('nan')),
+            level.get('p95_ms', float('nan')),
+            level['failures']))
+
+
+if __name__ == '__main__':
+
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument('server', type=str, help='URL of the running server')
+    parser.add_argument('pairs', type=str,
+                        help='file of tab-separated address pairs')
+    parser.add_argument('--threads', type=lambda s: [int(n) for n in s.split(',')],
+                        default='1,2,4,8')
+    parser.add_argument('--queries', type=int, default=200,
+                        help='requests per concurrency level')
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--alpha', type=float, nargs=2, default=(0., 10.))
+    parser.add_argument('--timeout', type=float, default=30.)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, default='benchmark-load.json')
+    args = parser.parse_args()
+
+    if not read_pairs(args.pairs):
+        sys.exit('no address pairs in {}'.format(args.pairs))
+
+    results = main(args)
+    report(results)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
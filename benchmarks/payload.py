@@ -0,0 +1,146 @@
+"""
+Benchmark the size and serialization time of route responses on a synthetic
+city: the path as full `latlngs`, or as an encoded polyline, in full or
+simplified for a zoom level, each with and without gzip.
+
+    python -m benchmarks.payload --rows 80 --cols 80 --nodes-per-block 10
+"""
+
+import gzip
+import json
+import numpy as np
+from benchmarks.query import od_pairs
+from benchmarks.synthetic_city import synthetic_city, xnode_waypoints
+from collections import defaultdict
+from scenicstroll.polyline import encode, simplify, zoom_tolerance
+from scenicstroll.route_graph import NoPathError, RoutingGraph, Topology
+from scenicstroll.spatial import ClusterIndex
+from scenicstroll.way_geometry import WayGeometry
+from time import perf_counter
+
+
+SIGHT_DISTANCE = 800
+
+
+def payloads(path, clusters, zooms):
+    """
+    Route payload in each format, as (name, function building it).
+    """
+
+    lat = [p[1] for p in path]
+    lon = [p[2] for p in path]
+
+    def full():
+        return dict(latlngs=[(p[1], p[2]) for p in path], clusters=clusters)
+
+    def polyline(zoom=None):
+        if zoom is None:
+            return dict(polyline=encode(lat, lon), clusters=clusters)
+        keep = simplify(lat, lon, zoom_tolerance(zoom, lat[0])).tolist()
+        return dict(polyline=encode([lat[k] for k in keep],
+                                    [lon[k] for k in keep]),
+                    clusters=clusters)
+
+    yield 'latlngs', full
+    yield 'polyline', polyline
+    for zoom in zooms:
+        yield 'polyline z{}'.format(zoom), lambda zoom=zoom: polyline(zoom)
+
+
+def main(args):
+
+    rng = np.random.RandomState(args.seed)
+    city = synthetic_city(args.rows, args.cols, args.spacing,
+                          nodes_per_block=args.nodes_per_block,
+                          num_photos=args.photos, seed=args.seed)
+
+    topology = Topology.from_waypoints(xnode_waypoints(city))
+    geometry = WayGeometry.from_waypoints(city.waypoints)
+    cluster_index = ClusterIndex(city.clusters, SIGHT_DISTANCE)
+
+    sizes = defaultdict(list)
+    times = defaultdict(list)
+    points = []
+
+    for lat1, lon1, lat2, lon2, alpha in od_pairs(topology, args.queries,
+                                                  [args.alpha], rng):
+        u1, u2 = (int(topology.node_ids[np.argmin(
+            (topology.lat - lat)**2 + (topology.lon - lon)**2)])
+            for lat, lon in ((lat1, lon1), (lat2, lon2)))
+
+        try:
+            _, edges = RoutingGraph.from_topology(
+                topology, alpha).get_optimal_path(u1, u2, 'bidirectional')
+        except NoPathError:
+            continue
+
+        path = geometry.get_path(edges)
+        if not path:
+            continue
+
+        _, lat, lon = zip(*path)
+        clusters = cluster_index.get_nearby(lat, lon, SIGHT_DISTANCE)
+        points.append(len(path))
+
+        for name, build in payloads(path, clusters, args.zooms):
+            start = perf_counter()
+            data = json.dumps(build()).encode('utf-8')
+            serialized = perf_counter()
+            compressed = gzip.compress(data, args.gzip_level)
+            end = perf_counter()
+
+            sizes[name].append(len(data))
+            sizes[name + ' gzip'].append(len(compressed))
+            times[name].append(serialized - start)
+            times[name + ' gzip'].append(end - start)
+
+    return dict(
+        params=vars(args),
+        routes=len(points),
+        mean_points=float(np.mean(points)) if points else None,
+        formats={name: dict(mean_bytes=float(np.mean(sizes[name])),
+                            max_bytes=int(np.max(sizes[name])),
+                            mean_ms=float(np.mean(times[name])*1e3))
+                 for name in sizes})
+
+
+def report(results):
+
+    print('{} routes, {:.0f} points on average'.format(
+        results['routes'], results['mean_points'] or 0))
+    print()
+    print('{:<20} {:>11} {:>11} {:>9} {:>9}'.format(
+        'format', 'mean bytes', 'max bytes', 'mean ms', 'vs full'))
+
+    base = results['formats']['latlngs']['mean_bytes']
+    for name, f in results['formats'].items():
+        print('{:<20} {:>11.0f} {:>11} {:>9.3f} {:>8.1f}%'.format(
+            name, f['mean_bytes'], f['max_bytes'], f['mean_ms'],
+            100*f['mean_bytes']/base))
+
+
+if __name__ == '__main__':
+
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument('--rows', type=int, default=60)
+    parser.add_argument('--cols', type=int, default=60)
+    parser.add_argument('--spacing', type=float, default=100.,
+                        help='block length in metres')
+    parser.add_argument('--nodes-per-block', type=int, default=6)
+    parser.add_argument('--photos', type=int, default=20000)
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--alpha', type=float, default=5.)
+    parser.add_argument('--zooms', type=lambda s: [int(z) for z in s.split(',')],
+                        default='18,16,14')
+    parser.add_argument('--gzip-level', type=int, default=6)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, default='benchmark-payload.json')
+    args = parser.parse_args()
+
+    results = main(args)
+    report(results)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
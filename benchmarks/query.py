@@ -0,0 +1,353 @@
+"""
+Benchmark the stages of a route query on a synthetic city: snapping the
+endpoints, building the routing graph, searching, reconstructing the path
+geometry and finding nearby photo clusters. A fixed, seeded set of
+origin-destination pairs and alphas is replayed, and latency percentiles and
+throughput of each stage are printed and written to a JSON file, which can
+be compared with an earlier run:
+
+    python -m benchmarks.query --rows 80 --cols 80 --output before.json
+    python -m benchmarks.query --rows 80 --cols 80 --compare before.json
+
+By default the city is used in memory. With --database, it is loaded into
+that (empty, scratch) database through the app's schema, and the graph is
+read back with the app's queries. --per-request loads the graph for each
+query from `RouteDB.get_relevant_waypoints` (or the same selection in
+memory, without --database), widening the region until the route is proven
+optimal as the app does without PRELOAD_GRAPH, and reports the number of
+waypoints fetched.
+
+With --landmarks, ALT landmark tables are precomputed for the alphas and
+used by the searches; the setup time and table size show the preprocessing
+cost against the query-time speed-up:
+
+    python -m benchmarks.query --output plain.json
+    python -m benchmarks.query --landmarks 16 --compare plain.json
+"""
+
+import json
+import numpy as np
+import platform
+import sys
+from benchmarks.synthetic_city import load_city, synthetic_city, xnode_waypoints
+from collections import defaultdict, namedtuple
+from scenicstroll.route_graph import Landmarks, NoPathError, RoutingGraph
+from scenicstroll.route_graph import Topology
+from scenicstroll.route_graph import corridor_search, haversine
+from scenicstroll.spatial import ClusterIndex, NodeIndex
+from scenicstroll.way_geometry import WayGeometry
+from time import perf_counter
+
+
+STAGES = ('snap', 'graph', 'search', 'geometry', 'clusters', 'total')
+
+# as in the app's config
+SEARCH_RADIUS = 200
+SIGHT_DISTANCE = 800
+CORRIDOR_EXPAND = (1.2, 1.5, 2., 3.)
+CORRIDOR_MARGIN = 200
+
+XNode = namedtuple('XNode', ['id', 'lat', 'lon'])
+
+CorridorWaypoint = namedtuple('CorridorWaypoint', [
+    'way_id', 'idx', 'node_id', 'cdist', 'cscore', 'lat', 'lon', 'inside'])
+
+
+class Timer:
+    """
+    Records durations of named stages.
+    """
+
+    def __init__(self):
+        self.times = defaultdict(list)
+
+    def __call__(self, stage, f, *args):
+        start = perf_counter()
+        result = f(*args)
+        self.times[stage].append(perf_counter() - start)
+        return result
+
+
+def summarize(times):
+    """
+    Count, mean, percentiles (in milliseconds) and throughput (per second)
+    of a list of durations.
+    """
+
+    t = np.array(times)*1e3
+    return dict(count=len(t),
+                mean_ms=float(t.mean()),
+                p50_ms=float(np.percentile(t, 50)),
+                p95_ms=float(np.percentile(t, 95)),
+                p99_ms=float(np.percentile(t, 99)),
+                throughput=float(len(t)/t.sum()*1e3))
+
+
+class MemoryCorridor:
+    """
+    The selection of `RouteDB.get_relevant_waypoints`, in memory, from
+    waypoints at intersections with coordinates, ordered by (way_id, idx).
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.way_id = np.array([wp.way_id for wp in rows])
+        self.lat = np.array([wp.lat for wp in rows])
+        self.lon = np.array([wp.lon for wp in rows])
+        self.node_loc = {wp.node_id: (wp.lat, wp.lon) for wp in rows}
+
+
+    def get_relevant_waypoints(self, u1, u2, expand, margin, inner=None):
+
+        (lat1, lon1), (lat2, lon2) = self.node_loc[u1], self.node_loc[u2]
+        dist = haversine(lat1, lon1, lat2, lon2)
+        total = (haversine(self.lat, self.lon, lat1, lon1) +
+                 haversine(self.lat, self.lon, lat2, lon2))
+
+        inside = (total <= expand*dist + margin if expand is not None else
+                  np.ones(len(self.rows), dtype=bool))
+        in_ring = inside
+        if inner is not None:
+            in_ring = inside & (total > inner*dist + margin)
+
+        same_way = self.way_id[1:] == self.way_id[:-1]
+        selected = in_ring.copy()
+        selected[1:] |= in_ring[:-1] & same_way
+        selected[:-1] |= in_ring[1:] & same_way
+
+        return [CorridorWaypoint(*self.rows[i][:7], inside=bool(inside[i]))
+                for i in np.flatnonzero(selected).tolist()]
+
+
+def min_edge_score(rows):
+    """
+    Smallest edge score, as `RouteDB.get_min_score`, from waypoints at
+    intersections ordered by (way_id, idx).
+    """
+
+    way_id = np.array([wp.way_id for wp in rows])
+    cscore = np.array([wp.cscore for wp in rows])
+    return float(np.diff(cscore)[way_id[1:] == way_id[:-1]].min())
+
+
+def od_pairs(topology, num_pairs, alphas, rng):
+    """
+    Fixed queries as (lat1, lon1, lat2, lon2, alpha): random intersections,
+    with the locations displaced by up to a few tens of metres.
+    """
+
+    i = rng.randint(topology.num_nodes, size=(num_pairs, 2))
+    jitter = rng.normal(0, 1e-4, (num_pairs, 4))
+    lat, lon = topology.lat, topology.lon
+
+    return [(lat[a] + j[0], lon[a] + j[1], lat[b] + j[2], lon[b] + j[3],
+             alphas[k % len(alphas)])
+            for k, ((a, b), j) in enumerate(zip(i.tolist(), jitter))]
+
+
+def run_query(timer, shared, query, method, get_graph):
+
+    lat1, lon1, lat2, lon2, alpha = query
+    start = perf_counter()
+
+    u1, u2 = timer('snap', shared['node_index'].nearest,
+                   [lat1, lat2], [lon1, lon2], SEARCH_RADIUS)
+    if u1 is None or u2 is None:
+        return None
+
+    rg = timer('graph', get_graph, u1, u2, alpha)
+
+    try:
+        _, edges = timer('search', rg.get_optimal_path, u1, u2, method)
+    except NoPathError:
+        return None
+
+    path = timer('geometry', shared['geometry'].get_path, edges)
+    if path:
+        _, lat, lon = zip(*path)
+        timer('clusters', shared['cluster_index'].get_nearby,
+              lat, lon, SIGHT_DISTANCE)
+
+    timer.times['total'].append(perf_counter() - start)
+    return rg.num_expanded
+
+
+def main(args):
+
+    rng = np.random.RandomState(args.seed)
+    setup = {}
+
+    start = perf_counter()
+    city = synthetic_city(args.rows, args.cols, args.spacing,
+                          num_photos=args.photos, seed=args.seed)
+    setup['generate_s'] = perf_counter() - start
+
+    if args.database:
+        from sqlalchemy import create_engine
+        from sqlalchemy.orm import sessionmaker
+        from scenicstroll import photo_db, route_db
+
+        engine = create_engine(args.database)
+        route_db.create_tables(engine)
+        photo_db.create_tables(engine)
+        session = sessionmaker(bind=engine)()
+
+        if session.query(route_db.Node).first() is not None:
+            sys.exit('{} is not empty'.format(args.database))
+
+        start = perf_counter()
+        load_city(city, session)
+        setup['load_db_s'] = perf_counter() - start
+
+        db = route_db.RouteDB(session)
+        xnode_rows = db.get_xnode_waypoints().all()
+        geometry_rows = db.get_way_geometry().all()
+        xnodes = db.get_xnodes().all()
+        clusters = photo_db.PhotoDB(session).get_clusters().all()
+    else:
+        xnode_rows = xnode_waypoints(city)
+        geometry_rows = city.waypoints
+        xnodes = [XNode(i, city.node_lat[i], city.node_lon[i])
+                  for i in np.flatnonzero(city.num_ways > 1).tolist()]
+        clusters = city.clusters
+
+    start = perf_counter()
+    topology = Topology.from_waypoints(xnode_rows)
+    shared = dict(geometry=WayGeometry.from_waypoints(geometry_rows),
+                  node_index=NodeIndex(xnodes, SEARCH_RADIUS),
+                  cluster_index=ClusterIndex(clusters, SIGHT_DISTANCE))
+    setup['build_s'] = perf_counter() - start
+
+    landmarks = None
+    if args.landmarks:
+        start = perf_counter()
+        landmarks = Landmarks.build(topology, args.alphas, args.landmarks,
+                                    args.seed)
+        setup['landmarks_s'] = perf_counter() - start
+
+    fetched = []
+
+    if args.per_request:
+        corridor = None if args.database else MemoryCorridor(xnode_rows)
+        min_score = (db.get_min_score() if args.database else
+                     min_edge_score(xnode_rows))
+
+        def get_graph(u1, u2, alpha):
+            if corridor is None:
+                node1, node2 = (session.query(route_db.Node).get(u)
+                                for u in (u1, u2))
+                fetch = lambda expand, inner: db.get_relevant_waypoints(
+                    node1, node2, expand, CORRIDOR_MARGIN, inner).all()
+            else:
+                fetch = lambda expand, inner: corridor.get_relevant_waypoints(
+                    u1, u2, expand, CORRIDOR_MARGIN, inner)
+
+            topology, _, _, num_fetched = corridor_search(
+                fetch, u1, u2, [alpha], CORRIDOR_EXPAND, min_score,
+                args.method)
+            fetched.append(num_fetched)
+            return RoutingGraph.from_topology(topology, alpha)
+    else:
+        def get_graph(u1, u2, alpha):
+            return RoutingGraph.from_topology(topology, alpha, landmarks)
+
+    queries = od_pairs(topology, args.queries, args.alphas, rng)
+
+    # warm up, then replay the queries
+    for query in queries[:args.warmup]:
+        run_query(Timer(), shared, query, args.method, get_graph)
+
+    timer = Timer()
+    del fetched[:]
+    expanded = [run_query(timer, shared, query, args.method, get_graph)
+                for query in queries]
+    found = [n for n in expanded if n is not None]
+
+    return dict(
+        params=vars(args),
+        city=dict(nodes=len(city.node_lat),
+                  intersections=topology.num_nodes,
+                  edges=topology.num_edges,
+                  ways=len(city.ways),
+                  photos=args.photos,
+                  clusters=len(city.clusters)),
+        environment=dict(python=platform.python_version(),
+                         numpy=np.__version__,
+                         machine=platform.machine()),
+        setup=setup,
+        routes_found=len(found),
+        mean_expanded=float(np.mean(found)) if found else None,
+        mean_fetched=float(np.sum(fetched)/len(queries)) if fetched else None,
+        landmarks_mb=landmarks.distances.nbytes/2**20 if landmarks else None,
+        stages={stage: summarize(timer.times[stage])
+                for stage in STAGES if timer.times[stage]})
+
+
+def report(results, baseline=None):
+
+    print('city: {nodes} nodes, {intersections} intersections, {edges} edges, '
+          '{photos} photos, {clusters} clusters'.format(**results['city']))
+    print('setup: ' + ', '.join('{} {:.2f} s'.format(k[:-2], v)
+                                for k, v in results['setup'].items()))
+    print('routes found: {} of {}, mean nodes expanded: {:.0f}'.format(
+        results['routes_found'], results['params']['queries'],
+        results['mean_expanded'] or 0))
+    if results.get('mean_fetched') is not None:
+        print('mean waypoints fetched: {:.0f}'.format(results['mean_fetched']))
+    if results.get('landmarks_mb') is not None:
+        print('landmark tables: {:.1f} MB'.format(results['landmarks_mb']))
+    print()
+
+    header = '{:<10} {:>9} {:>9} {:>9} {:>9} {:>11}'.format(
+        'stage', 'mean ms', 'p50 ms', 'p95 ms', 'p99 ms', 'per second')
+    if baseline:
+        header += ' {:>12}'.format('p50 vs base')
+    print(header)
+
+    for stage, s in results['stages'].items():
+        line = '{:<10} {mean_ms:>9.3f} {p50_ms:>9.3f} {p95_ms:>9.3f} ' \
+               '{p99_ms:>9.3f} {throughput:>11.1f}'.format(stage, **s)
+        if baseline and stage in baseline['stages']:
+            line += ' {:>11.2f}x'.format(
+                s['p50_ms']/baseline['stages'][stage]['p50_ms'])
+        print(line)
+
+
+if __name__ == '__main__':
+
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument('--rows', type=int, default=40)
+    parser.add_argument('--cols', type=int, default=40)
+    parser.add_argument('--spacing', type=float, default=100.,
+                        help='block length in metres')
+    parser.add_argument('--photos', type=int, default=20000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--alphas', type=lambda s: [float(a) for a in s.split(',')],
+                        default='0,2,5,10')
+    parser.add_argument('--method', type=str, default='bidirectional')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--database', type=str, default=None,
+                        help='URL of an empty scratch database')
+    parser.add_argument('--per-request', action='store_true',
+                        help='build the graph for the region of each query')
+    parser.add_argument('--landmarks', type=int, default=0,
+                        help='number of ALT landmarks (0: none)')
+    parser.add_argument('--output', type=str, default='benchmark-query.json')
+    parser.add_argument('--compare', type=str, default=None,
+                        help='results of an earlier run')
+    args = parser.parse_args()
+
+    results = main(args)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    report(results, baseline)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
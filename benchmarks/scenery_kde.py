@@ -0,0 +1,90 @@
+"""
+Compare the gridded FFT kernel density estimate with the exact estimate
+(a direct sum over photos with the same Gaussian kernel), for speed and
+accuracy of the normalized scenery scores.
+
+    python -m benchmarks.scenery_kde --photos 200000 --nodes 20000
+"""
+
+import numpy as np
+from argparse import ArgumentParser
+from scenicstroll.scenery import EARTH_RADIUS, GridKDE, normalize_scores
+from time import time
+
+
+def synthetic_photos(n, rng, center=(-122.4376, 37.7577), num_hotspots=50):
+    """
+    Photo locations as (lon, lat): clustered around hotspots, plus uniform
+    background.
+    """
+
+    lon0, lat0 = center
+    hotspots = rng.uniform(-0.06, 0.06, (num_hotspots, 2))
+    which = rng.randint(num_hotspots, size=n)
+    spread = rng.uniform(0.0005, 0.005, num_hotspots)[which]
+    X = hotspots[which] + rng.normal(0, 1, (n, 2))*spread[:, None]
+
+    background = rng.rand(n) < 0.2
+    X[background] = rng.uniform(-0.08, 0.08, (background.sum(), 2))
+
+    return X + (lon0, lat0)
+
+
+def exact_score_samples(model, photos, X, chunksize=2000):
+    """
+    Exact Gaussian KDE log density, in the same projection as the model.
+    """
+
+    px, py = model._project(photos[:, 0], photos[:, 1])
+    x, y = model._project(X[:, 0], X[:, 1])
+    bw = model.bandwidth
+    density = np.empty(len(X))
+
+    for i in range(0, len(X), chunksize):
+        dx = x[i:i + chunksize, None] - px[None, :]
+        dy = y[i:i + chunksize, None] - py[None, :]
+        k = np.exp(-0.5*(dx**2 + dy**2)/bw**2)
+        density[i:i + chunksize] = k.sum(axis=1)/(2*np.pi*bw**2*len(photos))
+
+    return np.log(np.maximum(density, np.finfo(np.float64).tiny))
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser()
+    parser.add_argument('--photos', type=int, default=50000)
+    parser.add_argument('--nodes', type=int, default=5000)
+    parser.add_argument('--bandwidth', type=float, default=1e-4*EARTH_RADIUS)
+    parser.add_argument('--cell-size', type=float, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(args.seed)
+    photos = synthetic_photos(args.photos, rng)
+    nodes = photos[rng.randint(len(photos), size=args.nodes)]
+    nodes += rng.normal(0, 0.002, nodes.shape)
+
+    t = time()
+    model = GridKDE(args.bandwidth, args.cell_size).fit(photos)
+    grid_scores = model.score_samples(nodes)
+    t_grid = time() - t
+
+    t = time()
+    exact_scores = exact_score_samples(model, photos, nodes)
+    t_exact = time() - t
+
+    # compare where the density is non-negligible
+    relevant = exact_scores > np.percentile(exact_scores, 1)
+    log_err = np.abs(grid_scores - exact_scores)[relevant]
+    score_err = np.abs(normalize_scores(grid_scores) -
+                       normalize_scores(exact_scores))
+
+    print('photos: {}, nodes: {}, grid: {}x{} cells of {:.0f} m'.format(
+        args.photos, args.nodes, model.density_.shape[1],
+        model.density_.shape[0], model.cell_size))
+    print('gridded KDE: {:.3f} s'.format(t_grid))
+    print('exact KDE:   {:.3f} s'.format(t_exact))
+    print('log density error: median {:.2e}, max {:.2e}'.format(
+        np.median(log_err), log_err.max()))
+    print('normalized score error: median {:.2e}, max {:.2e}'.format(
+        np.median(score_err), score_err.max()))
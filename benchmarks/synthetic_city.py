@@ -0,0 +1,240 @@
+"""
+Synthetic cities for benchmarks: a jittered street grid split into ways,
+with intermediate nodes along each block, and a field of photos clustered
+around hotspots. Scenery scores and photo clusters are computed from the
+photos as in the real pipeline (GridKDE and DBSCAN).
+
+The city can be used directly as rows in the shape returned by `RouteDB` and
+`PhotoDB` queries, or loaded into a scratch database with the same schema.
+"""
+
+import numpy as np
+from collections import namedtuple
+from scenicstroll.route_graph import haversine
+from scenicstroll.scenery import GridKDE, SceneryRaster
+from scenicstroll.spatial import dbscan
+
+
+EARTH_RADIUS = 6371008.8
+
+Waypoint = namedtuple('Waypoint', [
+    'way_id', 'idx', 'node_id', 'cdist', 'cscore', 'lat', 'lon'])
+
+Cluster = namedtuple('Cluster', [
+    'label', 'lat', 'lon', 'num_photos', 'repr_url', 'most_viewed'])
+
+City = namedtuple('City', [
+    'node_lat', 'node_lon', 'node_score', 'num_ways',
+    'ways', 'waypoints', 'photos', 'photo_labels', 'photo_views',
+    'clusters'])
+
+
+def _streets(rng, num_rows, num_cols, nodes_per_block, way_blocks, drop):
+    """
+    Ways as lists of node ids, along the rows and then the columns of the
+    grid of intersections. Intermediate nodes are numbered after the
+    intersections. Returns the ways and, for each intermediate node, the two
+    intersections and the fraction of the way between them.
+    """
+
+    ways = []
+    between = []
+    next_id = num_rows*num_cols
+
+    lines = ([[r*num_cols + c for c in range(num_cols)]
+              for r in range(num_rows)] +
+             [[r*num_cols + c for r in range(num_rows)]
+              for c in range(num_cols)])
+
+    for line in lines:
+        way = [line[0]]
+        length = rng.randint(*way_blocks)
+
+        for a, b in zip(line[:-1], line[1:]):
+
+            # missing block: end the way
+            if rng.rand() < drop:
+                if len(way) > 1:
+                    ways.append(way)
+                way = [b]
+                continue
+
+            for k in range(1, nodes_per_block + 1):
+                between.append((a, b, k/(nodes_per_block + 1)))
+                way.append(next_id)
+                next_id += 1
+            way.append(b)
+
+            # way ends at a random intersection, and the next one starts there
+            if (len(way) - 1)//(nodes_per_block + 1) >= length:
+                ways.append(way)
+                way = [b]
+                length = rng.randint(*way_blocks)
+
+        if len(way) > 1:
+            ways.append(way)
+
+    return ways, between
+
+
+def _photos(rng, n, x_extent, y_extent, num_hotspots):
+    """
+    Photo locations in metres: clustered around hotspots, plus uniform
+    background.
+    """
+
+    hotspots = rng.uniform(0, 1, (num_hotspots, 2))*(x_extent, y_extent)
+    which = rng.randint(num_hotspots, size=n)
+    spread = rng.uniform(20, 200, num_hotspots)[which]
+    X = hotspots[which] + rng.normal(0, 1, (n, 2))*spread[:, None]
+
+    background = rng.rand(n) < 0.2
+    X[background] = rng.uniform(0, 1, (background.sum(), 2))*(x_extent, y_extent)
+
+    return X
+
+
+def synthetic_city(num_rows=40, num_cols=40, spacing=100., nodes_per_block=3,
+                   num_photos=20000, num_hotspots=30, way_blocks=(2, 8),
+                   drop=0.05, eps=100., min_samples=10,
+                   center=(37.7577, -122.4376), seed=0):
+    """
+    Generate a city of num_rows x num_cols intersections `spacing` metres
+    apart, with ways spanning `way_blocks` blocks, a fraction `drop` of
+    blocks missing, and photos clustered with DBSCAN(eps, min_samples).
+    """
+
+    rng = np.random.RandomState(seed)
+
+    # intersections and intermediate nodes, in metres
+    num_xnodes = num_rows*num_cols
+    x = np.tile(np.arange(num_cols), num_rows)*spacing
+    y = np.repeat(np.arange(num_rows), num_cols)*spacing
+    x += rng.normal(0, spacing/20, num_xnodes)
+    y += rng.normal(0, spacing/20, num_xnodes)
+
+    ways, between = _streets(rng, num_rows, num_cols, nodes_per_block,
+                             way_blocks, drop)
+
+    if between:
+        a, b, t = (np.array(v) for v in zip(*between))
+        jitter = rng.normal(0, spacing/50, (2, len(t)))
+        x = np.concatenate((x, x[a] + t*(x[b] - x[a]) + jitter[0]))
+        y = np.concatenate((y, y[a] + t*(y[b] - y[a]) + jitter[1]))
+
+    # to degrees around the center
+    lat0, lon0 = center
+    x_extent, y_extent = (num_cols - 1)*spacing, (num_rows - 1)*spacing
+
+    def to_degrees(x, y):
+        lat = lat0 + np.degrees((y - y_extent/2)/EARTH_RADIUS)
+        lon = lon0 + np.degrees((x - x_extent/2)/
+                                (EARTH_RADIUS*np.cos(np.radians(lat0))))
+        return lat, lon
+
+    node_lat, node_lon = to_degrees(x, y)
+
+    # photos, their clusters, and scenery scores from their density
+    px, py = _photos(rng, num_photos, x_extent, y_extent, num_hotspots).T
+    photo_lat, photo_lon = to_degrees(px, py)
+    photos = np.column_stack((photo_lon, photo_lat))
+    labels, _ = dbscan(photo_lat, photo_lon, eps, min_samples)
+
+    views = rng.geometric(0.01, num_photos)
+    clusters = []
+    for label in np.unique(labels[labels >= 0]).tolist():
+        members = np.flatnonzero(labels == label)
+        most_viewed = int(members[np.argmax(views[members])])
+        clusters.append(Cluster(
+            label, photo_lat[members].mean(), photo_lon[members].mean(),
+            len(members), 'http://example.com/{}.jpg'.format(most_viewed),
+            most_viewed))
+
+    raster = SceneryRaster.fit(GridKDE().fit(photos[labels >= 0]),
+                               np.column_stack((node_lon, node_lat)))
+    node_score = raster.score_samples(np.column_stack((node_lon, node_lat)))
+
+    # waypoints with cumulative distances and scores along each way
+    num_ways = np.zeros(len(node_lat), dtype=np.int64)
+    waypoints = []
+
+    for way_id, way in enumerate(ways):
+        way = np.array(way)
+        num_ways[np.unique(way)] += 1
+
+        step = haversine(node_lat[way[:-1]], node_lon[way[:-1]],
+                         node_lat[way[1:]], node_lon[way[1:]])
+        cdist = np.concatenate(([0.], np.cumsum(step)))
+        cscore = np.cumsum(node_score[way])
+
+        waypoints.extend(
+            Waypoint(way_id, idx, node_id, d, s, node_lat[node_id],
+                     node_lon[node_id])
+            for idx, (node_id, d, s) in enumerate(zip(
+                way.tolist(), cdist.tolist(), cscore.tolist())))
+
+    return City(node_lat, node_lon, node_score, num_ways, ways, waypoints,
+                photos, labels, views, clusters)
+
+
+def xnode_waypoints(city):
+    """
+    Waypoints at intersections, as from `RouteDB.get_xnode_waypoints`.
+    """
+
+    return [wp for wp in city.waypoints if city.num_ways[wp.node_id] > 1]
+
+
+def load_city(city, session, batch_size=10000):
+    """
+    Write the city to the route and photo tables of an empty database with
+    COPY.
+    """
+
+    from parse_osm import CopyWriter, walkable_types
+    from scenicstroll.route_db import Node, Waypoint as WaypointRow, Way, WayType
+    from scenicstroll.photo_db import Photo, PhotoCluster
+
+    for i, name in enumerate(walkable_types):
+        session.add(WayType(id=i, name=name))
+
+    session.flush()
+    cursor = session.connection().connection.cursor()
+
+    def copy(table, columns, rows):
+        writer = CopyWriter(cursor, table.__tablename__, columns, batch_size)
+        for row in rows:
+            writer.write(row)
+        writer.close()
+
+    def point(lat, lon):
+        return 'SRID=4326;POINT({!r} {!r})'.format(lon, lat)
+
+    residential = walkable_types.index('residential')
+
+    copy(Node, ('id', 'loc', 'score', 'num_ways'),
+         ((i, point(lat, lon), score, n) for i, (lat, lon, score, n) in
+          enumerate(zip(city.node_lat.tolist(), city.node_lon.tolist(),
+                        city.node_score.tolist(), city.num_ways.tolist()))
+          if n > 0))
+
+    copy(Way, ('id', 'name', 'way_type_id'),
+         ((way_id, 'Street {}'.format(way_id), residential)
+          for way_id in range(len(city.ways))))
+
+    copy(WaypointRow, ('way_id', 'idx', 'node_id', 'cdist', 'cscore'),
+         ((wp.way_id, wp.idx, wp.node_id, wp.cdist, wp.cscore)
+          for wp in city.waypoints))
+
+    copy(PhotoCluster, ('label', 'centroid', 'num_photos', 'most_viewed'),
+         ((c.label, point(c.lat, c.lon), c.num_photos, c.most_viewed)
+          for c in city.clusters))
+
+    copy(Photo, ('id', 'location', 'url', 'views', 'label'),
+         ((i, point(lat, lon), 'http://example.com/{}.jpg'.format(i), views,
+           label if label >= 0 else None)
+          for i, ((lon, lat), label, views) in enumerate(zip(
+              city.photos.tolist(), city.photo_labels.tolist(),
+              city.photo_views.tolist()))))
+
+    session.commit()
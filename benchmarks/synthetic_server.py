@@ -0,0 +1,110 @@
+"""
+A stand-in for the app's `/query` on a synthetic city, to load test the
+threaded serving path without a database or geocoding service. Each request
+goes through the same steps as the app's after geocoding (snapping, graph,
+search, geometry, clusters) on preloaded in-memory data, with addresses
+given as "lat,lon". Geocoding, the app's main wait on I/O, can be stood in
+for by a fixed delay.
+
+Write address pairs for `benchmarks.load`, then serve and load test:
+
+    python -m benchmarks.synthetic_server pairs.tsv
+    gunicorn --threads 8 'benchmarks.synthetic_server:create_app(geocode_latency=0.1)'
+    python -m benchmarks.load http://localhost:8000 pairs.tsv
+"""
+
+import numpy as np
+from benchmarks.query import SEARCH_RADIUS, SIGHT_DISTANCE, XNode, od_pairs
+from benchmarks.synthetic_city import synthetic_city, xnode_waypoints
+from flask import Flask, jsonify, request
+from scenicstroll.route_graph import NoPathError, RoutingGraph, Topology
+from scenicstroll.spatial import ClusterIndex, NodeIndex
+from scenicstroll.way_geometry import WayGeometry
+from time import sleep
+
+
+def city_data(rows, cols, seed):
+    city = synthetic_city(rows, cols, 100., seed=seed)
+    xnodes = [XNode(i, city.node_lat[i], city.node_lon[i])
+              for i in np.flatnonzero(city.num_ways > 1).tolist()]
+
+    return (Topology.from_waypoints(xnode_waypoints(city)),
+            WayGeometry.from_waypoints(city.waypoints),
+            NodeIndex(xnodes, SEARCH_RADIUS),
+            ClusterIndex(city.clusters, SIGHT_DISTANCE))
+
+
+def parse_latlon(address):
+    lat, lon = address.split(',')
+    return float(lat), float(lon)
+
+
+def create_app(rows=40, cols=40, seed=0, geocode_latency=0.,
+               method='bidirectional'):
+    """
+    WSGI app serving `/query` on the synthetic city, sleeping
+    `geocode_latency` seconds per request in place of geocoding.
+    """
+
+    topology, geometry, node_index, cluster_index = city_data(rows, cols, seed)
+    app = Flask(__name__)
+
+    @app.route('/query', methods=['POST'])
+    def query():
+
+        try:
+            locs = [parse_latlon(request.form['address1']),
+                    parse_latlon(request.form['address2'])]
+            alpha = float(request.form['alpha'])
+        except (KeyError, ValueError):
+            return jsonify(success=False, message='Invalid input.')
+
+        if geocode_latency:
+            sleep(geocode_latency)
+
+        u1, u2 = node_index.nearest([loc[0] for loc in locs],
+                                    [loc[1] for loc in locs], SEARCH_RADIUS)
+        if u1 is None or u2 is None:
+            return jsonify(success=False, message='No data nearby.')
+
+        try:
+            rg = RoutingGraph.from_topology(topology, alpha)
+            _, edges = rg.get_optimal_path(u1, u2, method)
+        except NoPathError:
+            return jsonify(success=False, message='No route.')
+
+        path = geometry.get_path(edges)
+        clusters = []
+        if path:
+            _, lat, lon = zip(*path)
+            clusters = cluster_index.get_nearby(lat, lon, SIGHT_DISTANCE)
+
+        return jsonify(success=True,
+                       latlngs=[(lat, lng) for _, lat, lng in path],
+                       dist=sum(edge['dist'] for edge in edges),
+                       clusters=clusters)
+
+    return app
+
+
+if __name__ == '__main__':
+
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument('output', type=str,
+                        help='file to write address pairs to')
+    parser.add_argument('--rows', type=int, default=40)
+    parser.add_argument('--cols', type=int, default=40)
+    parser.add_argument('--pairs', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    topology = city_data(args.rows, args.cols, args.seed)[0]
+    rng = np.random.RandomState(args.seed)
+
+    with open(args.output, 'w') as f:
+        for lat1, lon1, lat2, lon2, _ in od_pairs(topology, args.pairs, [0.],
+                                                  rng):
+            f.write('{},{}\t{},{}\n'.format(
+                *(float(c) for c in (lat1, lon1, lat2, lon2))))
@@ -0,0 +1,76 @@
+"""
+Precompute ALT landmark tables for the app (config LANDMARKS), for a fixed
+set of alphas:
+
+    python build_landmarks.py postgresql://scenic@localhost/scenicstroll2 \
+        snapshots/landmarks.arr --scenery rasters/current.arr
+
+The tables hold only for the exact edge weights they were computed from, so
+pass the scenery raster the app is configured with, if any, and rebuild
+after importing, rescoring or switching rasters; the app ignores tables
+that do not match its graph, as it does for queries at other alphas. The
+app rounds alphas to multiples of ROUTE_CACHE_ALPHA_STEP, which the default
+alphas cover.
+"""
+
+import numpy as np
+from datetime import datetime
+from scenicstroll.arrayfile import load_arrays, save_arrays
+from scenicstroll.route_db import RouteDB
+from scenicstroll.route_graph import Landmarks, Topology
+from scenicstroll.scenery import SceneryRaster
+from scenicstroll.way_geometry import WayGeometry
+from time import perf_counter
+
+
+def build_landmarks(session, alphas, num_landmarks=16, scenery=None, seed=0):
+
+    db = RouteDB(session)
+    version = db.get_data_version()
+    topology = Topology.from_waypoints(db.get_xnode_waypoints())
+
+    # score edges from the raster, as the app does
+    if scenery is not None:
+        geometry = WayGeometry.from_waypoints(db.get_way_geometry())
+        raster = SceneryRaster.from_arrays(*load_arrays(scenery))
+        scores = raster.score_samples(
+            np.column_stack((geometry.lon, geometry.lat)))
+        topology = topology.with_scores(geometry.segment_sums(
+            scores, topology.way_id, topology.idx1, topology.idx2))
+
+    landmarks = Landmarks.build(topology, alphas, num_landmarks, seed)
+    return landmarks, version
+
+
+if __name__ == '__main__':
+
+    from argparse import ArgumentParser
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+
+    parser = ArgumentParser()
+    parser.add_argument('url', type=str, help='database URL')
+    parser.add_argument('output', type=str, help='landmark file to write')
+    parser.add_argument('--alphas', type=lambda s: [float(a) for a in s.split(',')],
+                        default=[k/2 for k in range(23)],
+                        help='comma-separated alphas (default: 0 to 11 by 0.5)')
+    parser.add_argument('--landmarks', type=int, default=16)
+    parser.add_argument('--scenery', type=str, default=None,
+                        help='scenery raster the app is configured with')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    Session = sessionmaker(bind=create_engine(args.url))
+
+    start = perf_counter()
+    landmarks, version = build_landmarks(
+        Session(), args.alphas, args.landmarks, args.scenery, args.seed)
+    elapsed = perf_counter() - start
+
+    arrays, meta = landmarks.to_arrays()
+    meta.update(data_version=version, created=datetime.now().isoformat())
+    save_arrays(args.output, arrays, meta)
+
+    print('{} landmarks for {} alphas in {:.1f} s, {:.1f} MB'.format(
+        len(landmarks.landmarks), len(landmarks.alphas), elapsed,
+        landmarks.distances.nbytes/2**20))
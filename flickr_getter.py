@@ -1,18 +1,32 @@
 import csv
-from flickrapi import FlickrAPI
-from datetime import date, timedelta
-from time import sleep
-from credentials.flickr import api_key, api_secret
-
-output_name = "photos-sc{n:02d}.csv"
-start_date = date(2014,9,12)
-end_date = date(2015,9,12)
+import json
+import os
+import sys
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+from threading import Lock
+from time import monotonic, sleep
+from urllib.parse import urlencode
+from urllib.request import urlopen
+
+output_name = "photos-sc.csv"
+start_date = datetime(2014,9,12)
+end_date = datetime(2015,9,12)
 #lat, lon = 37.7577, -122.4376 # SF
 lat, lon = 36.971249, -122.032023 # SC
 #radius = 20 # km
 radius = 5 # km
 
-api = FlickrAPI(api_key, api_secret)
+REST_ENDPOINT = 'https://api.flickr.com/services/rest/'
+
+# Flickr returns at most this many distinct photos per search, however many
+# pages are requested
+RESULT_CAP = 4000
+
+# don't split windows shorter than this, even if they hit the cap
+MIN_WINDOW = timedelta(minutes=10)
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
 
 extras_to_get = ','.join([
     'description',
@@ -44,14 +58,25 @@ search_args = dict(
     per_page=500,
 )
 
+
+def text(value):
+    """
+    Text of a field, which the JSON API may wrap as {'_content': text}.
+    """
+
+    if isinstance(value, dict):
+        value = value.get('_content')
+    return str(value)
+
+
 converters = [
     ("id", str),
     ("owner", str),
     ("secret", str),
     #("server", int),
     #("farm", int),
-    ("title", str),
-    ('description', str),
+    ("title", text),
+    ('description', text),
     #("ispublic", bool),
     #("isfriend", bool),
     #("isfamily", bool),
@@ -118,56 +143,285 @@ def get_size(elem):
     return w, h
 
 
-if __name__ == '__main__':
+class FlickrError(Exception):
+    pass
+
+
+class FlickrClient:
+    """
+    Minimal client for the Flickr REST API (JSON format). The endpoint can be
+    pointed at a local stub for testing.
+    """
+
+    def __init__(self, api_key, endpoint=REST_ENDPOINT, timeout=60):
+        self.api_key = api_key
+        self.endpoint = endpoint
+        self.timeout = timeout
+
+
+    def call(self, method, **params):
+        params = dict(params, method=method, api_key=self.api_key,
+                      format='json', nojsoncallback=1)
+        url = '{}?{}'.format(self.endpoint, urlencode(params))
+
+        with urlopen(url, timeout=self.timeout) as response:
+            result = json.loads(response.read().decode('utf-8'))
+
+        if result.get('stat') != 'ok':
+            raise FlickrError(result.get('message', 'unknown error'))
+
+        return result
+
+    def search(self, **params):
+        """
+        One page of `flickr.photos.search` results: a dict with the page
+        number, number of pages, total and list of photos.
+        """
+
+        return self.call('flickr.photos.search', **params)['photos']
+
+
+class TokenBucket:
+    """
+    Thread-safe rate limiter: allows `rate` calls per second on average, with
+    bursts of up to `capacity` calls.
+    """
+
+    def __init__(self, rate, capacity=1, timer=monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.timer = timer
+        self._tokens = capacity
+        self._last = timer()
+        self._lock = Lock()
+
+
+    def acquire(self):
+        """
+        Take a token, waiting until one is available.
+        """
+
+        while True:
+            with self._lock:
+                now = self.timer()
+                self._tokens = min(self.capacity,
+                                   self._tokens + (now - self._last)*self.rate)
+                self._last = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                wait_time = (1 - self._tokens)/self.rate
+
+            sleep(wait_time)
+
+
+class Harvester:
+    """
+    Fetches photos taken in a sequence of time windows, several windows at a
+    time in a thread pool, with all API calls going through a token bucket.
+
+    Completed windows, and where windows were split, are appended to a
+    checkpoint file, so an interrupted run resumes where it left off.
+    Windows whose search hits the API result cap are split in two until they
+    are shorter than MIN_WINDOW. Photos are deduplicated by id, including
+    against those already in the output file.
+    """
+
+    def __init__(self, client, search_args, output_path, checkpoint_path,
+                 workers=4, rate=1., max_retries=5, log=sys.stdout):
+        self.client = client
+        self.search_args = search_args
+        self.output_path = output_path
+        self.checkpoint_path = checkpoint_path
+        self.workers = workers
+        self.bucket = TokenBucket(rate, capacity=workers)
+        self.max_retries = max_retries
+        self.log = log
+        self.num_written = 0
+
+
+    def _search(self, window, page):
+        """
+        One page of results for the window, retrying with exponential backoff.
+        """
+
+        min_date, max_date = window
 
-    import os
-    import sys
-
-    # don't overwrite existing output files (increment suffix)
-    n = 0
-    while os.path.isfile(output_name.format(n=n)):
-        n += 1
-
-    with open(output_name.format(n=n), 'w') as output_file:
-
-        csv_writer = csv.writer(output_file)
-        csv_writer.writerow(list(zip(*converters))[0] + ('width','height'))
-
-        # Flickr API limits the number of unique photos returned per search
-        # query. Solution here is to iterate over days in the date range and
-        # make a separate query for each.
-        # (see http://stackoverflow.com/questions/1994037/flickr-api-returning-duplicate-photos)
-        for min_date, max_date in iter_days(start_date, end_date):
-
-            print("{start} to {end}: ".format(
-                    start=min_date,
-                    end=max_date,
-                ),
-                end=""
-            )
-
-            success = False
-
-            while not success:
-                sleep(2)
-                try:
-                
-                    # iterator over search results
-                    walker = api.walk(
-                        min_taken_date=min_date,
-                        max_taken_date=max_date,
-                        **search_args
-                    )
-
-                    # collect results
-                    data = [convert_values(elem) + get_size(elem)
-                            for elem in walker]
-
-                except KeyboardInterrupt as e:
-                    raise KeyboardInterrupt(e)
-                except:
-                    sys.stderr.write("failed, trying again...\n")
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            try:
+                return self.client.search(
+                    min_taken_date=min_date.strftime(DATE_FORMAT),
+                    max_taken_date=max_date.strftime(DATE_FORMAT),
+                    page=page,
+                    **self.search_args)
+            except (OSError, ValueError, FlickrError) as e:
+                if attempt == self.max_retries:
+                    raise
+                self.log.write('{} to {}, page {}: {}, trying again...\n'
+                               .format(min_date, max_date, page, e))
+                sleep(2**attempt)
+
+    def fetch_window(self, window):
+        """
+        Photos taken in the window, or if there are too many for one search,
+        None and the two halves of the window.
+        """
+
+        min_date, max_date = window
+        result = self._search(window, 1)
+
+        if (int(result['total']) > RESULT_CAP and
+                max_date - min_date >= 2*MIN_WINDOW):
+            mid = min_date + (max_date - min_date)//2
+            mid = mid.replace(microsecond=0)
+            return None, [(min_date, mid), (mid, max_date)]
+
+        photos = list(result['photo'])
+        for page in range(2, int(result['pages']) + 1):
+            photos.extend(self._search(window, page)['photo'])
+
+        return photos, []
+
+    def _checkpoint(self):
+        """
+        Completed windows, as a set of (min, max) keys, and windows that were
+        split, as a dict from key to the time they were split at.
+        """
+
+        completed, splits = set(), {}
+        if not os.path.isfile(self.checkpoint_path):
+            return completed, splits
+
+        with open(self.checkpoint_path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if len(entry) == 3:
+                    splits[(entry[0], entry[2])] = entry[1]
                 else:
-                    success = True
-                    csv_writer.writerows(data)
-                    print("fetched {n} photos".format(n=len(data)))
+                    completed.add(tuple(entry))
+
+        return completed, splits
+
+    def _seen_ids(self):
+        if not os.path.isfile(self.output_path):
+            return set()
+
+        with open(self.output_path) as f:
+            return set(row['id'] for row in csv.DictReader(f))
+
+    def run(self, windows):
+
+        completed, splits = self._checkpoint()
+        seen = self._seen_ids()
+        header = not os.path.isfile(self.output_path)
+        pending = {}
+
+        def key(window):
+            return tuple(d.strftime(DATE_FORMAT) for d in window)
+
+        def submit(window):
+            # windows split in an earlier run go straight to their halves
+            k = key(window)
+            if k in completed:
+                return
+            if k in splits:
+                mid = datetime.strptime(splits[k], DATE_FORMAT)
+                submit((window[0], mid))
+                submit((mid, window[1]))
+                return
+            pending[executor.submit(self.fetch_window, window)] = window
+
+        with open(self.output_path, 'a', newline='') as output_file, \
+                open(self.checkpoint_path, 'a') as checkpoint_file, \
+                ThreadPoolExecutor(self.workers) as executor:
+
+            csv_writer = csv.writer(output_file)
+            if header:
+                csv_writer.writerow(
+                    list(zip(*converters))[0] + ('width','height'))
+
+            for window in windows:
+                submit(window)
+
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    window = pending.pop(future)
+                    photos, subwindows = future.result()
+
+                    if photos is None:
+                        # record the split, so that a resumed run doesn't
+                        # search the whole window again
+                        checkpoint_file.write(json.dumps(
+                            (key(window)[0], key(subwindows[0])[1],
+                             key(window)[1])) + '\n')
+                        checkpoint_file.flush()
+                        for subwindow in subwindows:
+                            submit(subwindow)
+                        continue
+
+                    new = [elem for elem in photos if elem['id'] not in seen]
+                    seen.update(elem['id'] for elem in new)
+                    csv_writer.writerows(convert_values(elem) + get_size(elem)
+                                         for elem in new)
+
+                    # photos are flushed before the window is checkpointed,
+                    # so a crash in between only leads to refetching
+                    output_file.flush()
+                    checkpoint_file.write(json.dumps(key(window)) + '\n')
+                    checkpoint_file.flush()
+
+                    self.num_written += len(new)
+                    self.log.write('{} to {}: fetched {} photos ({} new)\n'
+                                   .format(window[0], window[1],
+                                           len(photos), len(new)))
+
+        return self.num_written
+
+
+if __name__ == '__main__':
+
+    from argparse import ArgumentParser
+
+    parse_date = lambda s: datetime.strptime(s, '%Y-%m-%d')
+
+    parser = ArgumentParser()
+    parser.add_argument('--output', type=str, default=output_name)
+    parser.add_argument('--checkpoint', type=str, default=None,
+                        help='completed windows (default: OUTPUT.checkpoint)')
+    parser.add_argument('--start', type=parse_date, default=start_date)
+    parser.add_argument('--end', type=parse_date, default=end_date)
+    parser.add_argument('--lat', type=float, default=lat)
+    parser.add_argument('--lon', type=float, default=lon)
+    parser.add_argument('--radius', type=float, default=radius, help='km')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--rate', type=float, default=1.,
+                        help='API calls per second')
+    parser.add_argument('--endpoint', type=str, default=REST_ENDPOINT)
+    parser.add_argument('--api-key', type=str, default=None)
+    args = parser.parse_args()
+
+    if args.api_key is None:
+        from credentials.flickr import api_key
+        args.api_key = api_key
+
+    harvester = Harvester(
+        FlickrClient(args.api_key, args.endpoint),
+        dict(search_args, lat=args.lat, lon=args.lon, radius=args.radius),
+        args.output,
+        args.checkpoint or args.output + '.checkpoint',
+        workers=args.workers,
+        rate=args.rate)
+
+    # Flickr API limits the number of unique photos returned per search
+    # query. Solution here is to iterate over days in the date range and
+    # make a separate query for each, splitting days with too many photos.
+    # (see http://stackoverflow.com/questions/1994037/flickr-api-returning-duplicate-photos)
+    n = harvester.run(iter_days(args.start, args.end))
+    print("fetched {n} new photos".format(n=n))
@@ -0,0 +1,59 @@
+"""
+Export the routing topology and way geometry from the route database to a
+binary snapshot file for the app (config GRAPH_SNAPSHOT):
+
+    python graph_snapshot.py postgresql://scenic@localhost/scenicstroll2 \
+        snapshots/graph.arr
+
+The app memory-maps the snapshot read-only, so workers start without
+querying the graph and share its pages. The snapshot records the data
+version it was exported at; the app ignores a snapshot whose version differs
+from the database's, so export again after importing or rescoring.
+"""
+
+from datetime import datetime
+from scenicstroll.arrayfile import save_arrays
+from scenicstroll.route_db import RouteDB
+from scenicstroll.route_graph import Topology
+from scenicstroll.way_geometry import WayGeometry
+
+
+def export_snapshot(session, path):
+
+    db = RouteDB(session)
+
+    # read everything in one snapshot of the database
+    session.connection(execution_options={'isolation_level': 'REPEATABLE READ'})
+    version = db.get_data_version()
+
+    topology = Topology.from_waypoints(db.get_xnode_waypoints())
+    geometry = WayGeometry.from_waypoints(db.get_way_geometry())
+
+    arrays = {}
+    for prefix, obj in (('topology', topology), ('geometry', geometry)):
+        for name, a in obj.to_arrays().items():
+            arrays['{}/{}'.format(prefix, name)] = a
+
+    save_arrays(path, arrays, dict(
+        data_version=version,
+        created=datetime.now().isoformat(),
+        num_nodes=topology.num_nodes,
+        num_edges=topology.num_edges))
+
+    return version
+
+
+if __name__ == '__main__':
+
+    from argparse import ArgumentParser
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+
+    parser = ArgumentParser()
+    parser.add_argument('url', type=str, help='database URL')
+    parser.add_argument('output', type=str, help='snapshot file to write')
+    args = parser.parse_args()
+
+    Session = sessionmaker(bind=create_engine(args.url))
+    version = export_snapshot(Session(), args.output)
+    print('exported data version {} to {}'.format(version, args.output))
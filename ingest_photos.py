@@ -0,0 +1,186 @@
+"""
+Load harvested photo metadata (CSV files from flickr_getter.py) into the
+photo table and cluster the photos, replacing the manual workflow in the
+notebook:
+
+    python ingest_photos.py postgresql:///scenicstroll photos-sf.csv
+
+Rows are streamed into the database with COPY, skipping photos already
+loaded. Photos are clustered with grid-based DBSCAN (`spatial.dbscan`), with
+outliers left unlabelled. When only a small fraction of the photos is new,
+just the grid cells around the new photos are reclustered, and only the
+affected cluster summaries are recomputed.
+"""
+
+import csv
+import numpy as np
+from parse_osm import CopyWriter, Logger
+from scenicstroll.photo_db import create_tables, Photo, PhotoDB
+from scenicstroll.spatial import dbscan
+
+
+# the notebook's DBSCAN parameters: eps of 1/6000 radian
+EPS = 1062
+MIN_SAMPLES = 10
+
+# recluster everything if more than this fraction of the photos is new, or
+# if the region to recluster around the new photos holds more than this
+# fraction of the photos
+FULL_RECLUSTER_FRACTION = 0.2
+FULL_REGION_FRACTION = 0.5
+
+
+def read_photos(paths):
+    """
+    Photos as (id, datetaken, location, owner, ownername, url, views) from
+    CSV files, skipping photos without coordinates.
+    """
+
+    for path in paths:
+        with open(path, newline='') as f:
+            for row in csv.DictReader(f):
+                lat, lon = float(row['latitude']), float(row['longitude'])
+                if lat == 0 and lon == 0:
+                    continue
+
+                views = row['views']
+                yield (int(row['id']),
+                       row['datetaken'],
+                       'SRID=4326;POINT({} {})'.format(lon, lat),
+                       row['owner'],
+                       row['ownername'],
+                       row['url_n'] if row['url_n'] != 'None' else None,
+                       int(views) if views.isdigit() else None)
+
+
+def load_photos(session, paths, log, batch_size=10000):
+    """
+    Copy photos from CSV files into the photo table. The ids of photos not
+    previously loaded are left in the temporary table `photo_new`. Returns
+    the number of new photos.
+    """
+
+    columns = ('id', 'datetaken', 'location', 'owner', 'ownername', 'url',
+               'views')
+
+    session.execute(
+        'CREATE TEMPORARY TABLE photo_import '
+        '(LIKE photo INCLUDING DEFAULTS) ON COMMIT DROP')
+    session.execute(
+        'CREATE TEMPORARY TABLE photo_new (id BIGINT PRIMARY KEY) '
+        'ON COMMIT DROP')
+
+    cursor = session.connection().connection.cursor()
+    writer = CopyWriter(cursor, 'photo_import', columns, batch_size)
+    for row in read_photos(paths):
+        writer.write(row)
+    writer.close()
+
+    log.write('read {} photos'.format(writer.rows_written))
+
+    session.execute(
+        'INSERT INTO photo_new '
+        'SELECT DISTINCT i.id FROM photo_import i '
+        'WHERE NOT EXISTS (SELECT 1 FROM photo p WHERE p.id = i.id)')
+    session.execute(
+        'INSERT INTO photo ({0}) '
+        'SELECT DISTINCT ON (id) {0} FROM photo_import '
+        'JOIN photo_new USING (id)'.format(', '.join(columns)))
+
+    num_new = session.execute('SELECT count(*) FROM photo_new').scalar()
+    log.write('{} new photos'.format(num_new))
+    return num_new
+
+
+def cluster_photos(session, log, eps=EPS, min_samples=MIN_SAMPLES, full=False):
+    """
+    Cluster all photos, or only update the clusters near the photos in
+    `photo_new`, and recompute the summaries of the clusters that changed.
+    """
+
+    photo_db = PhotoDB(session)
+
+    if not full:
+        # grid cells of at least eps holding all points within 2*eps of a
+        # new photo, whose neighbourhoods may change, and their neighbours
+        width, height, num_cells = photo_db.select_region(
+            'photo_new', eps, 3, 2)
+        num_region = photo_db.count_photos_in_region(width, height)
+        num_photos = session.execute('SELECT count(*) FROM photo').scalar()
+        log.write('{} photos in {} cells around the new photos'.format(
+            num_region, num_cells))
+
+        if num_region > FULL_REGION_FRACTION*num_photos:
+            log.write('reclustering all photos')
+            full = True
+
+    if full:
+        rows = photo_db.get_photo_points().all()
+        counted = None
+        session.execute('UPDATE photo SET label = NULL')
+        session.execute('DELETE FROM cluster')
+    else:
+        rows = photo_db.get_photos_in_region(width, height).fetchall()
+        counted = np.array([row.counted for row in rows], dtype=bool)
+
+    if not rows:
+        return
+
+    ids = [row.id for row in rows]
+    lat = np.array([row.lat for row in rows])
+    lon = np.array([row.lon for row in rows])
+    if full:
+        old = None
+    else:
+        old = np.array([-1 if row.label is None else row.label
+                        for row in rows])
+
+    next_label = session.execute(
+        'SELECT coalesce(max(label), -1) + 1 FROM cluster').scalar()
+
+    labels, merged = dbscan(lat, lon, eps, min_samples, old, counted,
+                            next_label)
+    labels = labels.tolist()
+
+    photo_db.set_labels(ids, labels, merged)
+    photo_db.update_cluster_summaries(
+        None if full else set(l for l in labels if l >= 0))
+
+    log.write('clustered {} photos: {} clusters changed, {} merged, '
+              '{} outliers'.format(
+                  len(ids), len(set(labels) - {-1}), len(merged),
+                  labels.count(-1)))
+
+
+if __name__ == '__main__':
+
+    import sys
+    from argparse import ArgumentParser
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+
+    parser = ArgumentParser()
+    parser.add_argument('url', type=str, help='database URL')
+    parser.add_argument('input', type=str, nargs='+', help='photo CSV files')
+    parser.add_argument('--eps', type=float, default=EPS,
+                        help='DBSCAN neighbourhood radius in metres')
+    parser.add_argument('--min-samples', type=int, default=MIN_SAMPLES)
+    parser.add_argument('--full', action='store_true',
+                        help='recluster all photos')
+    args = parser.parse_args()
+
+    engine = create_engine(args.url)
+    create_tables(engine)
+
+    Session = sessionmaker(bind=engine)
+    session = Session()
+    log = Logger(sys.stdout)
+
+    num_new = load_photos(session, args.input, log)
+    num_photos = session.query(Photo).count()
+
+    full = args.full or num_new > FULL_RECLUSTER_FRACTION*num_photos
+    if num_new or full:
+        cluster_photos(session, log, args.eps, args.min_samples, full)
+
+    session.commit()
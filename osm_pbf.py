@@ -0,0 +1,223 @@
+"""
+Minimal reader for the OpenStreetMap PBF format
+(http://wiki.openstreetmap.org/wiki/PBF_Format), decoding just what the
+importer needs: node ids and coordinates, and way ids, tags and node refs.
+
+A PBF file is a sequence of independently compressed blobs, so blobs can be
+read sequentially with `read_blobs` and decoded in parallel with
+`decode_block`.
+"""
+
+import lzma
+import struct
+import zlib
+
+
+def _varint(buf, pos):
+    result = shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _signed(n):
+    """
+    Interpret a varint as a (two's complement) int64.
+    """
+
+    return n - (1 << 64) if n >= 1 << 63 else n
+
+
+def _zigzag(n):
+    return (n >> 1) ^ -(n & 1)
+
+
+def _fields(buf):
+    """
+    Iterate over the (field number, wire type, value) of a protobuf message.
+    Length-delimited values are returned as memoryviews into `buf`.
+    """
+
+    buf = memoryview(buf)
+    pos, end = 0, len(buf)
+
+    while pos < end:
+        key, pos = _varint(buf, pos)
+        field, wire = key >> 3, key & 7
+
+        if wire == 0:
+            value, pos = _varint(buf, pos)
+        elif wire == 1:
+            value, pos = buf[pos:pos + 8], pos + 8
+        elif wire == 2:
+            n, pos = _varint(buf, pos)
+            value, pos = buf[pos:pos + n], pos + n
+        elif wire == 5:
+            value, pos = buf[pos:pos + 4], pos + 4
+        else:
+            raise ValueError('unsupported wire type {}'.format(wire))
+
+        yield field, wire, value
+
+
+def _packed(wire, value):
+    """
+    Values of a repeated varint field, which may or may not be packed.
+    """
+
+    if wire != 2:
+        return [value]
+
+    values = []
+    pos, end = 0, len(value)
+    while pos < end:
+        v, pos = _varint(value, pos)
+        values.append(v)
+
+    return values
+
+
+def _delta_decode(values):
+    total = 0
+    decoded = []
+    for v in values:
+        total += _zigzag(v)
+        decoded.append(total)
+    return decoded
+
+
+def read_blobs(f):
+    """
+    Iterate over the (type, blob) of each fileblock in a PBF file, where type
+    is e.g. 'OSMHeader' or 'OSMData' and blob is the undecoded Blob message.
+    """
+
+    while True:
+        header_size = f.read(4)
+        if not header_size:
+            return
+
+        header = f.read(struct.unpack('>i', header_size)[0])
+        blob_type, blob_size = None, 0
+
+        for field, _, value in _fields(header):
+            if field == 1:
+                blob_type = bytes(value).decode('utf-8')
+            elif field == 3:
+                blob_size = value
+
+        yield blob_type, f.read(blob_size)
+
+
+def _blob_data(blob):
+    for field, _, value in _fields(blob):
+        if field == 1:
+            return bytes(value)
+        elif field == 3:
+            return zlib.decompress(value)
+        elif field == 4:
+            return lzma.decompress(value)
+        elif field in (5, 6, 7):
+            raise ValueError('unsupported blob compression')
+
+    return b''
+
+
+def _tags(keys, vals, strings):
+    return [(strings[k], strings[v]) for k, v in zip(keys, vals)]
+
+
+def decode_block(blob):
+    """
+    Decode an OSMData blob. Returns the number of entities in the block, a
+    list of nodes as (id, lon, lat) and a list of ways as (id, tags, refs),
+    where tags is a list of (key, value) pairs.
+
+    Coordinates are computed from the integer nanodegrees with a single
+    division, so that they are identical to parsing the same coordinates
+    written in decimal (as in OSM XML).
+    """
+
+    strings = []
+    groups = []
+    granularity, lat_offset, lon_offset = 100, 0, 0
+
+    for field, wire, value in _fields(_blob_data(blob)):
+        if field == 1:
+            strings = [bytes(s).decode('utf-8')
+                       for _, _, s in _fields(value)]
+        elif field == 2:
+            groups.append(value)
+        elif field == 17:
+            granularity = value
+        elif field == 19:
+            lat_offset = _signed(value)
+        elif field == 20:
+            lon_offset = _signed(value)
+
+    def coord(offset, n):
+        return (offset + granularity*n)/1e9
+
+    num_entities = 0
+    nodes = []
+    ways = []
+
+    for group in groups:
+        for field, wire, value in _fields(group):
+
+            if field == 1:      # node
+                node_id = lat = lon = 0
+                for f, w, v in _fields(value):
+                    if f == 1:
+                        node_id = _zigzag(v)
+                    elif f == 8:
+                        lat = _zigzag(v)
+                    elif f == 9:
+                        lon = _zigzag(v)
+                nodes.append((node_id,
+                              coord(lon_offset, lon),
+                              coord(lat_offset, lat)))
+                num_entities += 1
+
+            elif field == 2:    # dense nodes
+                ids, lats, lons = [], [], []
+                for f, w, v in _fields(value):
+                    if f == 1:
+                        ids.extend(_packed(w, v))
+                    elif f == 8:
+                        lats.extend(_packed(w, v))
+                    elif f == 9:
+                        lons.extend(_packed(w, v))
+                for node_id, lat, lon in zip(_delta_decode(ids),
+                                             _delta_decode(lats),
+                                             _delta_decode(lons)):
+                    nodes.append((node_id,
+                                  coord(lon_offset, lon),
+                                  coord(lat_offset, lat)))
+                num_entities += len(ids)
+
+            elif field == 3:    # way
+                way_id = 0
+                keys, vals, refs = [], [], []
+                for f, w, v in _fields(value):
+                    if f == 1:
+                        way_id = _signed(v)
+                    elif f == 2:
+                        keys.extend(_packed(w, v))
+                    elif f == 3:
+                        vals.extend(_packed(w, v))
+                    elif f == 8:
+                        refs.extend(_packed(w, v))
+                ways.append((way_id,
+                             _tags(keys, vals, strings),
+                             _delta_decode(refs)))
+                num_entities += 1
+
+            elif field in (4, 5):   # relations, changesets
+                num_entities += 1
+
+    return num_entities, nodes, ways
@@ -1,7 +1,14 @@
+import numpy as np
+from collections import Counter, deque
+from io import StringIO
 from datetime import datetime
+from math import asin, cos, radians, sin, sqrt
+from multiprocessing import Pool, cpu_count
+from osm_pbf import decode_block, read_blobs
+from tempfile import TemporaryFile
 from time import time
 from xml.etree.cElementTree import iterparse
-from scenicstroll.route_db import create_tables, Node, Waypoint, Way, WayType
+from scenicstroll.route_db import create_tables, Node, RouteDB, Waypoint, Way, WayType
 
 
 walkable_types = (
@@ -45,25 +52,43 @@ def _inside_bbox(x, y, bbox):
             x < xmax and y < ymax)
 
 
-def _maybe_add_way(elem, session):
+def _xml_tags(elem):
+    return ((tag.get('k'), tag.get('v')) for tag in elem.iterfind('tag'))
+
+
+def _way_tags(tags):
+    """
+    Name and type of a walkable way, given its (key, value) tags, or None if
+    the way isn't walkable.
+    """
 
     name = None
     way_type = None
-    
+
     # scan tags for type and name
-    for tag in elem.iterfind('tag'):
-        
-        if tag.get('k') == 'highway':
-            way_type = tag.get('v')
+    for k, v in tags:
+
+        if k == 'highway':
+            way_type = v
             if way_type not in type_id: # not walkable
-                return False
-            
-        if tag.get('k') == 'name':
-            name = tag.get('v')
-    
+                return None
+
+        if k == 'name':
+            name = v
+
     if way_type is None:    # no `highway` tag; ignore
+        return None
+
+    return name, way_type
+
+
+def _maybe_add_way(elem, session):
+
+    tags = _way_tags(_xml_tags(elem))
+    if tags is None:
         return False
-    
+
+    name, way_type = tags
     way_id = int(elem.get('id'))
     way = Way(id=way_id, name=name, way_type_id=type_id[way_type])
     session.add(way)
@@ -111,9 +136,441 @@ def parse_osm(source, session, bbox, log):
             log.write('{} nodes, {} ways'.format(nodes_done, ways_done))
             session.commit()
 
+    RouteDB(session).bump_data_version()
+    session.commit()
+
+
+EARTH_RADIUS = 6371008.8
+
+
+def haversine(lon1, lat1, lon2, lat2):
+    """
+    Great-circle distance in metres between points given in degrees.
+    """
+
+    lon1, lat1, lon2, lat2 = map(radians, (lon1, lat1, lon2, lat2))
+    a = sin((lat2 - lat1)/2)**2 + cos(lat1)*cos(lat2)*sin((lon2 - lon1)/2)**2
+    return 2*EARTH_RADIUS*asin(sqrt(a))
+
+
+def _copy_value(value):
+    """
+    Format a value for PostgreSQL COPY text format.
+    """
+
+    if value is None:
+        return '\\N'
+
+    return (str(value)
+            .replace('\\', '\\\\')
+            .replace('\t', '\\t')
+            .replace('\n', '\\n')
+            .replace('\r', '\\r'))
+
+
+class CopyWriter:
+    """
+    Buffers rows for a table and writes them with COPY in batches. Rows can
+    also be spooled to a temporary file and copied later, e.g. to respect
+    foreign keys.
+    """
+
+    def __init__(self, cursor, table, columns, batch_size=10000, spool=False):
+        self.cursor = cursor
+        self.table = table
+        self.columns = columns
+        self.batch_size = batch_size
+        self.rows_written = 0
+        self._rows = []
+        self._spool = TemporaryFile('w+') if spool else None
+
+    def write(self, row):
+        self._rows.append('\t'.join(_copy_value(v) for v in row))
+        if len(self._rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._rows:
+            return
+
+        data = '\n'.join(self._rows) + '\n'
+        self.rows_written += len(self._rows)
+        self._rows = []
+
+        if self._spool is not None:
+            self._spool.write(data)
+        else:
+            self._copy(StringIO(data))
+
+    def close(self):
+        self.flush()
+        if self._spool is not None:
+            self._spool.seek(0)
+            self._copy(self._spool)
+            self._spool.close()
+
+    def _copy(self, f):
+        self.cursor.copy_expert(
+            'COPY {} ({}) FROM STDIN'.format(self.table, ', '.join(self.columns)),
+            f)
+
+
+def _xml_blocks(source, bbox, block_size=100000):
+    """
+    Read OSM XML in blocks of elements. Yields (number of elements, nodes,
+    ways) where nodes are (id, lon, lat) inside the bbox and ways are
+    (id, name, type_id, refs) for walkable ways.
+    """
+
+    num_elements, nodes, ways = 0, [], []
+
+    for elem in parse_tags(source, ('node', 'way')):
+
+        num_elements += 1
+
+        if elem.tag == 'node':
+            x, y = float(elem.get('lon')), float(elem.get('lat'))
+            if _inside_bbox(x, y, bbox):
+                nodes.append((int(elem.get('id')), x, y))
+
+        elif elem.tag == 'way':
+            tags = _way_tags(_xml_tags(elem))
+            if tags is not None:
+                name, way_type = tags
+                refs = [int(nd.get('ref')) for nd in elem.iterfind('nd')]
+                ways.append((int(elem.get('id')), name, type_id[way_type], refs))
+
+        if num_elements == block_size:
+            yield num_elements, nodes, ways
+            num_elements, nodes, ways = 0, [], []
+
+    yield num_elements, nodes, ways
+
+
+def _pbf_block(blob, bbox):
+    """
+    Decode and filter a PBF data blob, in the same form as `_xml_blocks`.
+    """
+
+    num_elements, pbf_nodes, pbf_ways = decode_block(blob)
+
+    nodes = [(node_id, x, y) for node_id, x, y in pbf_nodes
+             if _inside_bbox(x, y, bbox)]
+
+    ways = []
+    for way_id, tags, refs in pbf_ways:
+        tags = _way_tags(tags)
+        if tags is not None:
+            name, way_type = tags
+            ways.append((way_id, name, type_id[way_type], refs))
+
+    return num_elements, nodes, ways
+
+
+def _pbf_blocks(source, bbox, processes=None):
+    """
+    Read an OSM PBF file, decoding blobs in a process pool. Yields blocks in
+    file order, in the same form as `_xml_blocks`.
+    """
+
+    processes = processes or cpu_count()
+    pool = Pool(processes)
+    max_pending = 2*processes
+    pending = deque()
+
+    with open(source, 'rb') as f:
+        for blob_type, blob in read_blobs(f):
+            if blob_type != 'OSMData':
+                continue
+
+            # bound the number of blobs held in memory
+            if len(pending) >= max_pending:
+                yield pending.popleft().get()
+
+            pending.append(pool.apply_async(_pbf_block, (blob, bbox)))
+
+    while pending:
+        yield pending.popleft().get()
+
+    pool.close()
+    pool.join()
+
+
+def bulk_parse_osm(source, session, bbox, log, batch_size=10000,
+                   processes=None):
+    """
+    Fast import of OSM XML or PBF (if the file name ends in .pbf) using COPY.
+    Coordinates of nodes inside the bbox are kept in memory, so ways never
+    query for their nodes, and cumulative distances (`cdist`) and `num_ways`
+    are computed on the fly, making prep_routes.sql unnecessary. PBF blobs
+    are decoded in a pool of `processes` processes.
+    """
+
+    for i, name in enumerate(walkable_types):
+        session.add(WayType(id=i, name=name))
+
+    session.flush()
+    cursor = session.connection().connection.cursor()
+
+    ways = CopyWriter(cursor, Way.__tablename__,
+                      ('id', 'name', 'way_type_id'), batch_size)
+
+    # waypoints reference nodes, which are written last
+    waypoints = CopyWriter(cursor, Waypoint.__tablename__,
+                           ('way_id', 'idx', 'node_id', 'cdist'),
+                           batch_size, spool=True)
+
+    coords = {}
+    num_ways = Counter()
+    elements_done = 0
+    ways_done = 0
+    start = time()
+
+    if source.endswith('.pbf'):
+        log.write('started parsing PBF')
+        blocks = _pbf_blocks(source, bbox, processes)
+    else:
+        log.write('started parsing XML')
+        blocks = _xml_blocks(source, bbox)
+
+    for num_elements, block_nodes, block_ways in blocks:
+
+        for node_id, x, y in block_nodes:
+            coords[node_id] = (x, y)
+
+        for way_id, name, way_type_id, refs in block_ways:
+            ways.write((way_id, name, way_type_id))
+
+            # cumulative distance along the nodes of the way that we have
+            cdist = 0.
+            prev = None
+            for i, node_id in enumerate(refs):
+                if node_id not in coords:
+                    continue
+                loc = coords[node_id]
+                if prev is not None:
+                    cdist += haversine(prev[0], prev[1], loc[0], loc[1])
+                prev = loc
+                waypoints.write((way_id, i, node_id, cdist))
+                num_ways[node_id] += 1
+
+        elements_done += num_elements
+        ways_done += len(block_ways)
+
+        log.write('{} nodes, {} ways ({:.0f} elements/s)'.format(
+            len(coords), ways_done, elements_done/(time() - start)))
+
+    ways.close()
+
+    nodes = CopyWriter(cursor, Node.__tablename__,
+                       ('id', 'loc', 'num_ways'), batch_size)
+
+    for node_id, (x, y) in coords.items():
+        loc = 'SRID=4326;POINT({} {})'.format(x, y)
+        nodes.write((node_id, loc, num_ways[node_id]))
+
+    nodes.close()
+    waypoints.close()
+
+    log.write('wrote {} nodes, {} ways, {} waypoints ({:.0f} elements/s)'
+              .format(nodes.rows_written, ways.rows_written,
+                      waypoints.rows_written, elements_done/(time() - start)))
+
+    RouteDB(session).bump_data_version()
     session.commit()
 
 
+class NodeStore:
+    """
+    Coordinates for a fixed set of node ids, kept in sorted id order in a
+    memory-mapped temporary file (8 bytes per id in memory, 16 on disk), so
+    that lookups are binary searches over whole arrays rather than per-node
+    dict operations.
+    """
+
+    def __init__(self, ids):
+        self.ids = np.unique(np.asarray(ids, dtype=np.int64))
+        self._file = TemporaryFile()
+        self.coords = np.memmap(self._file, dtype=np.float64, mode='w+',
+                                shape=(max(len(self.ids), 1), 2))
+        self.coords[:] = np.nan
+
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _positions(self, node_ids):
+        """
+        Positions of the node ids in the store, and which of them are in it.
+        """
+
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        pos = np.searchsorted(self.ids, node_ids)
+        pos[pos == len(self.ids)] = 0
+        found = self.ids[pos] == node_ids if len(self.ids) else pos < 0
+        return pos, found
+
+    def set(self, node_ids, lon, lat):
+        """
+        Store coordinates of those of the nodes that are in the store.
+        """
+
+        pos, found = self._positions(node_ids)
+        self.coords[pos[found], 0] = np.asarray(lon)[found]
+        self.coords[pos[found], 1] = np.asarray(lat)[found]
+
+    def get(self, node_ids):
+        """
+        Positions of the nodes in the store (-1 for unknown nodes) and their
+        longitudes and latitudes (NaN for nodes without coordinates).
+        """
+
+        pos, found = self._positions(node_ids)
+        coords = self.coords[pos]
+        coords[~found] = np.nan
+        pos[~found] = -1
+        return pos, coords[:, 0], coords[:, 1]
+
+    def close(self):
+        del self.coords
+        self._file.close()
+
+
+def _read_blocks(source, bbox, processes=None):
+    if source.endswith('.pbf'):
+        return _pbf_blocks(source, bbox, processes)
+    return _xml_blocks(source, bbox)
+
+
+def referenced_parse_osm(source, session, bbox, log, batch_size=10000,
+                         processes=None):
+    """
+    Import like `bulk_parse_osm`, but write only the nodes referenced by
+    walkable ways rather than every node in the bbox. A first pass collects
+    the ids of referenced nodes; the second stores their coordinates in a
+    `NodeStore` as they are read, and computes the waypoints of each block
+    of ways with array operations. Nodes must precede ways in the file, as
+    in standard extracts.
+    """
+
+    for i, name in enumerate(walkable_types):
+        session.add(WayType(id=i, name=name))
+
+    session.flush()
+    cursor = session.connection().connection.cursor()
+    start = time()
+
+    # first pass: which nodes do walkable ways need?
+    refs = []
+    for _, _, block_ways in _read_blocks(source, bbox, processes):
+        if block_ways:
+            refs.append(np.unique(np.concatenate(
+                [np.array(w[3], dtype=np.int64) for w in block_ways])))
+    store = NodeStore(np.concatenate(refs) if refs else [])
+    del refs
+
+    log.write('{} nodes referenced by walkable ways ({:.0f} s)'.format(
+        len(store), time() - start))
+
+    # second pass: coordinates of those nodes, then ways and waypoints
+    ways = CopyWriter(cursor, Way.__tablename__,
+                      ('id', 'name', 'way_type_id'), batch_size)
+    waypoints = CopyWriter(cursor, Waypoint.__tablename__,
+                           ('way_id', 'idx', 'node_id', 'cdist'),
+                           batch_size, spool=True)
+
+    num_ways = np.zeros(len(store), dtype=np.int32)
+    bbox_nodes = 0
+
+    for num_elements, block_nodes, block_ways in _read_blocks(
+            source, bbox, processes):
+
+        if block_nodes:
+            node_ids, x, y = zip(*block_nodes)
+            store.set(node_ids, x, y)
+            bbox_nodes += len(block_nodes)
+
+        if not block_ways:
+            continue
+
+        way_ids = np.repeat([w[0] for w in block_ways],
+                            [len(w[3]) for w in block_ways])
+        idx = np.concatenate([np.arange(len(w[3])) for w in block_ways])
+        node_ids = np.concatenate([np.array(w[3], dtype=np.int64)
+                                   for w in block_ways])
+        pos, x, y = store.get(node_ids)
+
+        for way_id, name, way_type_id, _ in block_ways:
+            ways.write((way_id, name, way_type_id))
+
+        # waypoints at the nodes that we have, with cumulative distances
+        keep = ~np.isnan(x)
+        if not keep.any():
+            continue
+
+        way_ids, idx, node_ids, pos, x, y = (
+            a[keep] for a in (way_ids, idx, node_ids, pos, x, y))
+
+        same_way = way_ids[1:] == way_ids[:-1]
+        step = np.where(same_way, _haversine(x[:-1], y[:-1], x[1:], y[1:]), 0.)
+        cdist = np.concatenate(([0.], np.cumsum(step)))
+        way_start = np.concatenate(([True], ~same_way))
+        cdist -= np.maximum.accumulate(np.where(way_start, cdist, 0.))
+
+        np.add.at(num_ways, pos, 1)
+
+        for row in zip(way_ids.tolist(), idx.tolist(), node_ids.tolist(),
+                       cdist.tolist()):
+            waypoints.write(row)
+
+    ways.close()
+
+    nodes = CopyWriter(cursor, Node.__tablename__,
+                       ('id', 'loc', 'num_ways'), batch_size)
+
+    located = np.flatnonzero(~np.isnan(store.coords[:len(store), 0]))
+    for node_id, x, y, n in zip(store.ids[located].tolist(),
+                                store.coords[located, 0].tolist(),
+                                store.coords[located, 1].tolist(),
+                                num_ways[located].tolist()):
+        nodes.write((node_id, 'SRID=4326;POINT({} {})'.format(x, y), n))
+
+    nodes.close()
+    waypoints.close()
+    store.close()
+
+    log.write('wrote {} of {} nodes in the bbox, {} ways, {} waypoints '
+              '({:.0f} s)'.format(nodes.rows_written, bbox_nodes,
+                                  ways.rows_written, waypoints.rows_written,
+                                  time() - start))
+
+    RouteDB(session).bump_data_version()
+    session.commit()
+
+
+def _haversine(lon1, lat1, lon2, lat2):
+    """
+    `haversine` for arrays.
+    """
+
+    lon1, lat1, lon2, lat2 = map(np.radians, (lon1, lat1, lon2, lat2))
+    a = (np.sin((lat2 - lat1)/2)**2 +
+         np.cos(lat1)*np.cos(lat2)*np.sin((lon2 - lon1)/2)**2)
+    return 2*EARTH_RADIUS*np.arcsin(np.sqrt(a))
+
+
+def log_table_sizes(session, log):
+    """
+    Log the size of the node table and of its indexes.
+    """
+
+    rows, table, indexes = session.execute(
+        "SELECT (SELECT COUNT(*) FROM node), "
+        "pg_table_size('node'), pg_indexes_size('node')").first()
+    log.write('node table: {} rows, {:.1f} MB, indexes {:.1f} MB'.format(
+        rows, table/2**20, indexes/2**20))
+
+
 if __name__ == '__main__':
 
     import sys
@@ -123,7 +580,7 @@ if __name__ == '__main__':
     from sqlalchemy.orm import sessionmaker
 
     parser = ArgumentParser()
-    parser.add_argument('input', type=str, help='OSM XML file')
+    parser.add_argument('input', type=str, help='OSM XML or PBF file')
     parser.add_argument('url', type=str, help='database URL')
 
     parser.add_argument(
@@ -132,6 +589,22 @@ if __name__ == '__main__':
             default='-122.525,37.6936,-122.3499,37.8152',
             help='xmin,ymin,xmax,ymax')
 
+    parser.add_argument(
+            '--bulk',
+            action='store_true',
+            help='fast import using COPY (no need to run prep_routes.sql)')
+
+    parser.add_argument(
+            '--referenced-only',
+            action='store_true',
+            help='bulk import of only the nodes on walkable ways, in two passes')
+
+    parser.add_argument(
+            '--processes',
+            type=int,
+            default=None,
+            help='processes for decoding PBF (default: number of CPUs)')
+
     args = parser.parse_args()
 
     engine = create_engine(args.url)
@@ -140,7 +613,16 @@ if __name__ == '__main__':
     Session = sessionmaker(bind=engine)
     session = Session()
 
-    parse_osm(args.input,
-              session,
-              args.bbox,
-              Logger(sys.stdout))
+    log = Logger(sys.stdout)
+
+    # PBF is only supported by the bulk importers
+    if args.referenced_only:
+        referenced_parse_osm(args.input, session, args.bbox, log,
+                             processes=args.processes)
+    elif args.bulk or args.input.endswith('.pbf'):
+        bulk_parse_osm(args.input, session, args.bbox, log,
+                       processes=args.processes)
+    else:
+        parse_osm(args.input, session, args.bbox, log)
+
+    log_table_sizes(session, log)
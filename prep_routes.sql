@@ -34,3 +34,8 @@ WHERE node.id = t.node_id;
 UPDATE node
 SET num_ways = 0
 WHERE num_ways IS NULL;
+
+/* let caches and preloaded graphs know the routing data changed */
+INSERT INTO data_version (id, version)
+VALUES (1, 1)
+ON CONFLICT (id) DO UPDATE SET version = data_version.version + 1;
@@ -0,0 +1,58 @@
+"""
+Build a scenery raster file for the app (config SCENERY_RASTER): fit a
+gridded KDE to the photo locations and normalize it over all nodes on ways.
+
+    python scenery_raster.py postgresql://scenic@localhost/scenicstroll2 \
+        rasters/scenery-v2.arr
+    ln -sfn scenery-v2.arr rasters/current.arr
+
+Files are written atomically, and the app picks up a new file when the path
+it is configured with (typically a symlink) changes.
+"""
+
+import numpy as np
+from datetime import datetime
+from scenicstroll.arrayfile import save_arrays
+from scenicstroll.photo_db import PhotoDB
+from scenicstroll.route_db import RouteDB
+from scenicstroll.scenery import EARTH_RADIUS, GridKDE, SceneryRaster
+
+
+def build_raster(session, bandwidth, cell_size=None, version=None):
+
+    photos = np.array(PhotoDB(session).get_photo_locations().all(),
+                      dtype=np.float64)
+    model = GridKDE(bandwidth, cell_size).fit(photos)
+
+    # normalize over nodes, as RouteDB.update_scores does
+    rows = RouteDB(session).get_way_geometry()
+    node_id, lon, lat = zip(*((row.node_id, row.lon, row.lat) for row in rows))
+    _, first = np.unique(node_id, return_index=True)
+    nodes = np.column_stack((lon, lat))[first]
+
+    return SceneryRaster.fit(model, nodes, version)
+
+
+if __name__ == '__main__':
+
+    from argparse import ArgumentParser
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+
+    parser = ArgumentParser()
+    parser.add_argument('url', type=str, help='database URL')
+    parser.add_argument('output', type=str, help='raster file to write')
+    parser.add_argument('--bandwidth', type=float, default=1e-4*EARTH_RADIUS,
+                        help='kernel bandwidth in metres')
+    parser.add_argument('--cell-size', type=float, default=None,
+                        help='grid spacing in metres (default: bandwidth/8)')
+    parser.add_argument('--version', type=str,
+                        default=datetime.now().strftime('%Y%m%d%H%M%S'))
+    args = parser.parse_args()
+
+    Session = sessionmaker(bind=create_engine(args.url))
+    raster = build_raster(Session(), args.bandwidth, args.cell_size,
+                          args.version)
+
+    arrays, meta = raster.to_arrays()
+    save_arrays(args.output, arrays, meta)
@@ -1,25 +1,308 @@
-from flask import Flask, jsonify
-from forms import InputForm
+import atexit
+import gzip
+import json
+import numpy as np
+import os
+from arrayfile import load_arrays
+from cache import RouteCache
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, jsonify, stream_with_context
+from forms import FrontierForm, InputForm
 from flask import render_template, request, redirect, url_for
-from geoalchemy2 import Geography, Geometry
-from geoalchemy2.functions import ST_X, ST_Y
+from geocoding import Gazetteer, Geocoder
 from geopy.geocoders import GoogleV3
-from sqlalchemy import cast, create_engine
-from sqlalchemy.orm import sessionmaker
-from photo_db import Photo, PhotoCluster
-from route_db import RouteDB, Node, Waypoint
-from route_graph import RoutingGraph
+from metrics import Metrics
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import scoped_session, sessionmaker
+from photo_db import PhotoDB
+from polyline import encode, simplify, zoom_tolerance
+from route_db import DataVersion, RouteDB, Node
+from route_graph import Landmarks, NoPathError, RoutingGraph, Topology
+from route_graph import corridor_search, get_route_frontier
+from scenery import SceneryRaster
+from spatial import ClusterIndex, NodeIndex
+from threading import Lock
+from time import time
+from way_geometry import WayGeometry
 
 
 app = Flask(__name__)
 app.config.from_object('config')
-geolocator = GoogleV3()
 
-# connect database
-engine = create_engine(app.config['DATABASE'])
-Session = sessionmaker(bind=engine)
-session = Session()
-db = RouteDB(session)
+# connect database; each thread (or greenlet, when patched) handling a
+# request gets its own session from the scoped session, and a connection
+# from the pool only while it has a transaction open
+engine = create_engine(app.config['DATABASE'],
+                       pool_size=app.config['DB_POOL_SIZE'],
+                       max_overflow=app.config['DB_MAX_OVERFLOW'],
+                       pool_timeout=app.config['DB_POOL_TIMEOUT'],
+                       pool_recycle=app.config['DB_POOL_RECYCLE'])
+session_factory = sessionmaker(bind=engine)
+Session = scoped_session(session_factory)
+db = RouteDB(Session)
+
+
+@event.listens_for(session_factory, 'after_begin')
+def set_read_only(session, transaction, connection):
+    # the app only reads; guard against accidental writes, and let the server
+    # skip the bookkeeping for them
+    connection.execute('SET TRANSACTION READ ONLY')
+
+
+# per-stage timings and per-request counts, served at /metrics
+metrics = Metrics()
+metrics.instrument_engine(engine)
+
+# geocoding; the gazetteer for resolving street names locally is set up
+# along with the routing data below
+geolocator = Geocoder(GoogleV3(),
+                      maxsize=app.config['GEOCODE_CACHE_SIZE'],
+                      ttl=app.config['GEOCODE_CACHE_TTL'],
+                      max_workers=app.config['GEOCODE_WORKERS'])
+
+if app.config['GEOCODE_CACHE_FILE']:
+    if os.path.isfile(app.config['GEOCODE_CACHE_FILE']):
+        geolocator.load_cache(app.config['GEOCODE_CACHE_FILE'])
+    atexit.register(geolocator.save_cache, app.config['GEOCODE_CACHE_FILE'])
+
+route_cache = RouteCache(app.config['ROUTE_CACHE_SIZE'],
+                         app.config['ROUTE_CACHE_ALPHA_STEP'])
+
+# threads for graph searches, if configured; this bounds the number of
+# concurrent searches (and their memory) independently of the number of
+# request handlers, and keeps them off the event loop of gevent workers
+routing_pool = (ThreadPoolExecutor(app.config['ROUTING_WORKERS'])
+                if app.config['ROUTING_WORKERS'] else None)
+
+RoutingData = namedtuple('RoutingData', [
+    'version',
+    'topology',
+    'geometry',
+    'node_index',
+    'cluster_index',
+    'scenery',
+    'landmarks'])
+
+
+def scenery_file():
+    """
+    Identity of the configured scenery raster file, as its resolved path and
+    modification time, so that repointing a symlink or replacing the file is
+    noticed. None if no raster is configured.
+    """
+
+    path = app.config['SCENERY_RASTER']
+    if not path:
+        return None
+
+    path = os.path.realpath(path)
+    return path, os.stat(path).st_mtime_ns
+
+
+def apply_scenery(topology, geometry, scenery):
+    """
+    Topology with edge scores derived from the scenery raster: every waypoint
+    is scored, and edges get the sum of the scores along their stretch of way.
+    The raster is memory-mapped, so its pages are shared between processes.
+    """
+
+    arrays, meta = load_arrays(scenery[0])
+    raster = SceneryRaster.from_arrays(arrays, meta)
+
+    scores = raster.score_samples(
+        np.column_stack((geometry.lon, geometry.lat)))
+    app.logger.info('loaded scenery raster %s (version %s)',
+                    scenery[0], raster.version)
+
+    return topology.with_scores(geometry.segment_sums(
+        scores, topology.way_id, topology.idx1, topology.idx2))
+
+
+def load_snapshot(version):
+    """
+    Topology and way geometry from the configured graph snapshot file, or
+    None if there is none or it was exported at another data version.
+    """
+
+    path = app.config['GRAPH_SNAPSHOT']
+    if not path or not os.path.isfile(path):
+        return None
+
+    arrays, meta = load_arrays(path,
+                               verify=app.config['GRAPH_SNAPSHOT_VERIFY'])
+    if meta['data_version'] != version:
+        app.logger.warning('ignoring graph snapshot %s at data version %s '
+                           '(database is at %s)',
+                           path, meta['data_version'], version)
+        return None
+
+    parts = {'topology': {}, 'geometry': {}}
+    for key, a in arrays.items():
+        prefix, name = key.split('/', 1)
+        parts[prefix][name] = a
+
+    return (Topology.from_arrays(parts['topology']),
+            WayGeometry.from_arrays(parts['geometry']))
+
+
+def load_landmarks(topology):
+    """
+    ALT landmark tables from the configured file, or None if there is none
+    or they were computed for other edge weights.
+    """
+
+    path = app.config['LANDMARKS']
+    if not path or topology is None or not os.path.isfile(path):
+        return None
+
+    landmarks = Landmarks.from_arrays(*load_arrays(path))
+    if not landmarks.matches(topology):
+        app.logger.warning('ignoring landmarks %s computed for another graph',
+                           path)
+        return None
+
+    app.logger.info('loaded landmarks %s for alphas %s', path,
+                    landmarks.alphas)
+    return landmarks
+
+
+def cache_version(shared):
+    return shared.version, shared.scenery
+
+
+def load_data():
+    """
+    Load everything derived from the database that is shared by requests.
+    """
+
+    version = db.get_data_version()
+
+    # routing topology and way geometry, from a snapshot if possible
+    snapshot = load_snapshot(version) if app.config['PRELOAD_GRAPH'] else None
+
+    if snapshot is not None:
+        topology, geometry = snapshot
+    elif app.config['PRELOAD_GRAPH']:
+        topology = Topology.from_waypoints(db.get_xnode_waypoints())
+        geometry = WayGeometry.from_waypoints(db.get_way_geometry())
+    else:
+        topology = None
+        geometry = None
+
+    # scores from the scenery raster rather than the database, if configured
+    scenery = scenery_file() if topology is not None else None
+    if scenery is not None:
+        topology = apply_scenery(topology, geometry, scenery)
+
+    # intersections for snapping locations to the road network
+    node_index = NodeIndex(db.get_xnodes(), app.config['SEARCH_RADIUS'])
+
+    # photo clusters, indexed on a grid with cells of the sight distance
+    cluster_index = ClusterIndex(PhotoDB(Session).get_clusters(),
+                                 app.config['SIGHT_DISTANCE'])
+
+    if app.config['GEOCODE_GAZETTEER']:
+        geolocator.gazetteer = Gazetteer.from_named_xnodes(
+            db.get_named_xnodes(), app.config['GEOCODE_LOCALITIES'])
+
+    if topology is not None:
+        metrics.set_gauge('graph_nodes', topology.num_nodes,
+                          help='Nodes in the preloaded routing graph.')
+        metrics.set_gauge('graph_edges', topology.num_edges,
+                          help='Directed edges in the preloaded routing '
+                               'graph.')
+    metrics.set_gauge('data_version', version,
+                      help='Version of the routing data in use.')
+
+    return RoutingData(version, topology, geometry, node_index, cluster_index,
+                       scenery, load_landmarks(topology))
+
+
+DataVersion.__table__.create(engine, checkfirst=True)
+data = load_data()
+Session.remove()
+route_cache.check_version(cache_version(data))
+last_version_check = time()
+reload_lock = Lock()
+
+
+def refresh_data():
+    """
+    Reload shared data and invalidate cached routes if the data version or
+    the scenery raster has changed, checking at most every
+    DATA_VERSION_CHECK_INTERVAL seconds. A new raster only rescores the
+    preloaded topology.
+    """
+
+    global data, last_version_check
+
+    if time() - last_version_check < app.config['DATA_VERSION_CHECK_INTERVAL']:
+        return
+
+    with reload_lock:
+        last_version_check = time()
+        if db.get_data_version() != data.version:
+            data = load_data()
+        elif data.scenery is not None and scenery_file() != data.scenery:
+            scenery = scenery_file()
+            topology = apply_scenery(data.topology, data.geometry, scenery)
+            data = data._replace(topology=topology, scenery=scenery,
+                                 landmarks=load_landmarks(topology))
+
+        route_cache.check_version(cache_version(data))
+
+
+@app.before_request
+def start_request():
+    metrics.start_request()
+
+
+@app.teardown_appcontext
+def remove_session(exc):
+    # ends the transaction and returns the connection to the pool, also after
+    # a failed query, so that the next request starts from a clean session
+    Session.remove()
+
+
+@app.teardown_request
+def end_request(exc):
+    record = metrics.end_request(request.endpoint or 'unknown')
+    threshold = app.config['SLOW_REQUEST_THRESHOLD']
+
+    if record is not None and threshold is not None:
+        elapsed = record.elapsed
+        if elapsed > threshold:
+            app.logger.warning('slow request %s (%.3f s): %s',
+                               request.path, elapsed, record.describe())
+
+
+@app.after_request
+def compress(response):
+    """
+    Gzip large responses for clients that accept it. Any response that could
+    be gzipped varies with Accept-Encoding, whether or not this one is, so
+    that caches don't serve one client's encoding to another.
+    """
+
+    if (response.is_streamed or
+            response.status_code != 200 or
+            'Content-Encoding' in response.headers):
+        return response
+
+    response.vary.add('Accept-Encoding')
+
+    if 'gzip' not in request.headers.get('Accept-Encoding', '').lower():
+        return response
+
+    body = response.get_data()
+    if len(body) < app.config['GZIP_MIN_SIZE']:
+        return response
+
+    response.set_data(gzip.compress(body, app.config['GZIP_LEVEL']))
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
+
 
 @app.route('/')
 @app.route('/index')
@@ -38,119 +321,411 @@ def query():
     if not form.validate():
         return jsonify(success=False, message='Invalid input.')
 
+    with metrics.timer('refresh'):
+        refresh_data()
+    shared = data
+
+    addresses = [form.address1.data, form.address2.data]
+    alpha = route_cache.quantize(float(form.alpha.data))
+
+    nodes, msg = locate(shared, addresses)
+    if msg:
+        return jsonify(success=False, message=msg)
+
+    payload = route_cache.get(nodes[0], nodes[1], alpha)
+
+    if payload is None:
+        try:
+            path, dist = run_routing(
+                get_optimal_path, shared, nodes[0], nodes[1], alpha)
+        except:
+            msg = "Sorry, I couldn't find a route. Try something else?"
+            return jsonify(success=False, message=msg)
+
+        payload = get_route_payload(shared, path, dist)
+
+        # don't cache results computed from data that has since been replaced
+        if cache_version(shared) == route_cache.version:
+            route_cache.put(nodes[0], nodes[1], alpha, payload)
+
+    return jsonify(success=True, message=describe(payload['dist']),
+                   **format_payload(payload))
+
+
+@app.route('/frontier', methods=['POST'])
+def frontier():
+    """
+    All distinct optimal routes for alpha in [alpha_min, alpha_max], so that
+    the client can switch between them without further requests. Alphas
+    that no route covers were left unsearched and need a `/query`.
+    """
+
+    form = FrontierForm(request.form)
+    if not form.validate():
+        return jsonify(success=False, message='Invalid input.')
+
+    with metrics.timer('refresh'):
+        refresh_data()
+    shared = data
+
+    try:
+        alpha_min = float(form.alpha_min.data)
+        alpha_max = float(form.alpha_max.data)
+    except ValueError:
+        alpha_min = alpha_max = np.nan
+
+    if not (np.isfinite(alpha_min) and np.isfinite(alpha_max) and
+            alpha_min <= alpha_max):
+        return jsonify(success=False, message='Invalid alpha range.'), 400
+
+    alpha_min = route_cache.quantize(alpha_min)
+    alpha_max = route_cache.quantize(alpha_max)
+
     addresses = [form.address1.data, form.address2.data]
-    locs = tuple(geolocator.geocode(address) for address in addresses)
-    alpha = float(form.alpha.data)
+    fmt = path_format()
+
+    nodes, msg = locate(shared, addresses)
+    if msg:
+        return jsonify(success=False, message=msg)
+
+    payloads = route_cache.get_frontier(nodes[0], nodes[1],
+                                        alpha_min, alpha_max, fmt)
+    if payloads is not None:
+        return jsonify(success=True, routes=payloads)
+
+    if shared.topology is not None:
+        topology = shared.topology
+        metrics.count('graph_nodes', topology.num_nodes)
+        metrics.count('graph_edges', topology.num_edges)
+    else:
+        # a region in which the routes at both ends of the range are optimal
+        with metrics.timer('corridor'):
+            topology, _ = load_corridor(nodes[0], nodes[1],
+                                        [alpha_min, alpha_max])
+
+    # the grid of quantized alphas, or the page's slider steps without one
+    step = route_cache.alpha_step or 1.
+
+    try:
+        with metrics.timer('search'):
+            routes = run_routing(
+                get_route_frontier,
+                topology, nodes[0], nodes[1], alpha_min, alpha_max,
+                step, app.config['SEARCH_METHOD'],
+                shared.landmarks, app.config['FRONTIER_MAX_SEARCHES'],
+                app.config['FRONTIER_MAX_ROUTES'])
+    except:
+        msg = "Sorry, I couldn't find a route. Try something else?"
+        return jsonify(success=False, message=msg)
+
+    payloads = []
+    for route in routes:
+        path, dist = get_detailed_path(shared, route['edges'])
+        payload = format_payload(get_route_payload(shared, path, dist))
+        payloads.append(dict(payload,
+                             message=describe(dist),
+                             alpha_min=route['alpha_min'],
+                             alpha_max=route['alpha_max']))
+
+    if cache_version(shared) == route_cache.version:
+        route_cache.put_frontier(nodes[0], nodes[1], alpha_min, alpha_max, fmt,
+                                 payloads)
+
+    return jsonify(success=True, routes=payloads)
+
+
+@app.route('/batch', methods=['POST'])
+def batch():
+    """
+    Optimal routes between many points at one alpha. The JSON body has
+    `alpha`, `sources` and optionally `targets` (default: the sources), each
+    a list of node ids or [lat, lon] pairs, and `geometry` to include the
+    path of each route. The response is newline-delimited JSON: first the
+    snapped nodes, then one line per source with the distance and weight to
+    each target (null where there is no route), as they are computed.
+    """
+
+    params = request.get_json(force=True, silent=True)
+    if not isinstance(params, dict):
+        return jsonify(success=False, message='Invalid input.')
+
+    try:
+        alpha = float(params.get('alpha', 0))
+        sources = parse_points(params['sources'])
+        targets = parse_points(params.get('targets', params['sources']))
+    except (KeyError, TypeError, ValueError):
+        return jsonify(success=False, message='Invalid input.')
+
+    if len(sources) + len(targets) > app.config['BATCH_MAX_POINTS']:
+        msg = 'At most {} points per batch.'
+        return jsonify(success=False,
+                       message=msg.format(app.config['BATCH_MAX_POINTS']))
+
+    with metrics.timer('refresh'):
+        refresh_data()
+    shared = data
+
+    # loading the whole graph from the database per request would cost more
+    # than the searches, so batches need it preloaded
+    if shared.topology is None:
+        return jsonify(success=False,
+                       message='Batch routing needs a preloaded graph.'), 503
+
+    with metrics.timer('snap'):
+        source_nodes = snap_points(shared, sources)
+        target_nodes = snap_points(shared, targets)
+
+    with metrics.timer('graph'):
+        rg = RoutingGraph.from_topology(shared.topology, alpha)
+
+    with_geometry = bool(params.get('geometry', False))
+
+    def generate():
+        yield json.dumps(dict(success=True, alpha=alpha,
+                              sources=source_nodes,
+                              targets=target_nodes)) + '\n'
+
+        for k, u1 in enumerate(source_nodes):
+            with metrics.timer('search'):
+                results = run_routing(rg.get_one_to_many, u1, target_nodes,
+                                      with_geometry)
+            metrics.count('nodes_expanded', rg.num_expanded)
+
+            line = dict(source=k,
+                        dist=[r and r['dist'] for r in results],
+                        weight=[r and r['weight'] for r in results])
+            if with_geometry:
+                line['latlngs'] = [
+                    r and [(lat, lng) for _, lat, lng in
+                           get_detailed_path(shared, r['edges'])[0]]
+                    for r in results]
+            yield json.dumps(line) + '\n'
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/x-ndjson')
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(),
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@app.route('/stats')
+def stats():
+    return jsonify(route_cache=route_cache.stats(),
+                   geocode_cache=geolocator.cache.stats())
+
+
+def locate(shared, addresses):
+    """
+    Geocode the addresses and snap them to intersections. Returns the node ids
+    and an error message, which is None on success.
+    """
+
+    with metrics.timer('geocode'):
+        locs = geolocator.geocode_all(addresses)
 
     for loc, address in zip(locs, addresses):
         if not loc:
             msg = "Sorry, I don't recognize '{}'. Try something else?"
-            return jsonify(success=False, message=msg.format(address))
+            return None, msg.format(address)
 
-    nodes = tuple(db.get_nearest_xnodes(
-                    loc.latitude,
-                    loc.longitude,
-                    app.config['SEARCH_RADIUS']).first()
-                  for loc in locs)
+    with metrics.timer('snap'):
+        nodes = shared.node_index.nearest(
+            [loc.latitude for loc in locs],
+            [loc.longitude for loc in locs],
+            app.config['SEARCH_RADIUS'])
 
     for node, address in zip(nodes, addresses):
-        if not node:
+        if node is None:
             msg = "Sorry, I don't have data near {} yet. Try something else?"
-            return jsonify(success=False, message=msg.format(address))
+            return None, msg.format(address)
 
-    try:
-        path, dist = get_optimal_path(nodes[0], nodes[1], alpha)
-    except:
-        msg = "Sorry, I couldn't find a route. Try something else?"
-        return jsonify(success=False, message=msg)
+    return nodes, None
+
+
+def run_routing(f, *args):
+    """
+    f(*args), in the routing pool if there is one, recording its stages
+    with the current request.
+    """
+
+    if routing_pool is None:
+        return f(*args)
 
-    latlngs = [(lat, lng) for _, lat, lng in path]
-    clusters = get_nearby_clusters(path)
+    record = metrics.current
 
+    def task():
+        with metrics.attach(record):
+            try:
+                return f(*args)
+            finally:
+                Session.remove()
+
+    return routing_pool.submit(task).result()
+
+
+def parse_points(points):
+    """
+    Node ids and (lat, lon) pairs from a list of JSON values.
+    """
+
+    if not isinstance(points, list):
+        raise TypeError('expected a list of points')
+
+    return [int(p) if isinstance(p, int) else (float(p[0]), float(p[1]))
+            for p in points]
+
+
+def snap_points(shared, points):
+    """
+    Node ids of the points, snapping locations to the nearest intersection
+    all at once. None where no intersection is within the search radius.
+    """
+
+    located = [k for k, p in enumerate(points) if isinstance(p, tuple)]
+    nodes = list(points)
+
+    if located:
+        lat, lon = zip(*(points[k] for k in located))
+        for k, u in zip(located, shared.node_index.nearest(
+                lat, lon, app.config['SEARCH_RADIUS'])):
+            nodes[k] = u
+
+    return nodes
+
+
+def describe(dist):
     dist_mi = dist/1609.34
     aan = 'a' if str(dist_mi)[0] in '012345679' else 'an'
-    msg = 'Found {} {:.1f}-mile walk.'.format(aan, dist_mi)
+    return 'Found {} {:.1f}-mile walk.'.format(aan, dist_mi)
 
-    return jsonify(success=True,
-                   message=msg,
-                   latlngs=latlngs,
-                   dist=dist,
-                   clusters=clusters)
 
+def get_optimal_path(shared, u1, u2, alpha):
 
-def get_optimal_path(node1, node2, alpha):
+    if shared.topology is None:
+        with metrics.timer('corridor'):
+            _, paths = load_corridor(u1, u2, [alpha])
+        if paths[alpha] is None:
+            raise NoPathError('no path from {} to {}'.format(u1, u2))
+        return get_detailed_path(shared, paths[alpha][1])
 
     # build road graph
-    waypoints = db.get_relevant_waypoints(node1, node2)
-    rg = RoutingGraph(waypoints, alpha)
-    _, edges = rg.get_optimal_path(node1.id, node2.id)
-    dist = sum(edge['dist'] for edge in edges)
-    path = []
+    with metrics.timer('graph'):
+        rg = RoutingGraph.from_topology(shared.topology, alpha,
+                                        shared.landmarks)
+
+    metrics.count('graph_nodes', rg.topology.num_nodes)
+    metrics.count('graph_edges', rg.topology.num_edges)
+
+    with metrics.timer('search'):
+        _, edges = rg.get_optimal_path(u1, u2, app.config['SEARCH_METHOD'])
 
+    metrics.count('nodes_expanded', rg.num_expanded)
+
+    return get_detailed_path(shared, edges)
+
+
+def load_corridor(u1, u2, alphas):
+    """
+    Topology of a region around u1 and u2 loaded from the database, and the
+    optimal path in it for each alpha. The region is widened through
+    CORRIDOR_EXPAND, fetching only the waypoints new to each step, until the
+    paths are proven optimal, or else to the whole graph (see
+    `corridor_search`).
+    """
+
+    node1, node2 = (db.session.query(Node).get(u) for u in (u1, u2))
+
+    def fetch(expand, inner):
+        with metrics.timer('graph'):
+            return db.get_relevant_waypoints(
+                node1, node2, expand, app.config['CORRIDOR_MARGIN'],
+                inner).all()
+
+    topology, paths, num_loaded, num_fetched = corridor_search(
+        fetch, u1, u2, alphas, app.config['CORRIDOR_EXPAND'],
+        db.get_min_score(), app.config['SEARCH_METHOD'])
+
+    metrics.count('waypoints_fetched', num_fetched)
+    metrics.count('corridor_loads', num_loaded)
+    metrics.count('graph_nodes', topology.num_nodes)
+    metrics.count('graph_edges', topology.num_edges)
+    return topology, paths
+
+
+def get_detailed_path(shared, edges):
+
+    dist = sum(edge['dist'] for edge in edges)
 
     # get detailed path information for each edge
-    for edge in edges:
-        nodes = (
-            db.session.query(
-                Node,
-                ST_X(cast(Node.loc, Geometry)),
-                ST_Y(cast(Node.loc, Geometry)))
-            .join(Waypoint)
-            .filter(
-                (Waypoint.way_id == edge['way_id']) &
-                (Waypoint.idx >= edge['idx1']) &
-                (Waypoint.idx <= edge['idx2']))
-            .order_by(Waypoint.idx).all())
-
-        if edge['reversed']:
-            nodes = nodes[::-1]
-
-        path.extend((node.id, y, x) for node, x, y in nodes)
+    with metrics.timer('geometry'):
+        if shared.geometry is not None:
+            path = shared.geometry.get_path(edges)
+        else:
+            way_ids = set(edge['way_id'] for edge in edges)
+            path = (WayGeometry.from_waypoints(db.get_way_geometry(way_ids))
+                    .get_path(edges))
 
     return path, dist
 
 
-def get_nearby_clusters(path):
+def get_route_payload(shared, path, dist):
+    return dict(latlngs=[(lat, lng) for _, lat, lng in path],
+                dist=dist,
+                clusters=get_nearby_clusters(shared, path))
+
+
+def path_format():
+    """
+    The requested path format, as ('latlngs', None) or ('polyline', zoom),
+    see `format_payload`.
+    """
+
+    if request.form.get('format') != 'polyline':
+        return 'latlngs', None
+
+    return 'polyline', request.form.get('zoom', type=float)
 
-    node_ids = set(r[0] for r in path)
-    nodes_query = db.session.query(Node.loc).filter(Node.id.in_(node_ids))
 
-    # find set of clusters near nodes in the path
-    nearby_clusters = set([])
+def format_payload(payload):
+    """
+    The route payload with the path in the requested format: `latlngs` in
+    full (the default), or with format=polyline an encoded `polyline`,
+    simplified to POLYLINE_PIXELS pixels at the requested `zoom`, if any.
+    """
 
-    for node in nodes_query:
+    fmt, zoom = path_format()
+    if fmt != 'polyline':
+        return payload
 
-        nearby_clusters_query = (
-            session.query(PhotoCluster.label)
-            .filter(PhotoCluster.centroid.ST_DWithin(
-                    cast(node.loc, Geography), app.config['SIGHT_DISTANCE'])))
+    payload = dict(payload)
+    latlngs = payload.pop('latlngs')
+    lat = [p[0] for p in latlngs]
+    lon = [p[1] for p in latlngs]
 
-        nearby_clusters.update(label for (label,) in nearby_clusters_query)
+    if zoom is not None and latlngs:
+        tolerance = zoom_tolerance(zoom, sum(lat)/len(lat),
+                                   app.config['POLYLINE_PIXELS'])
+        with metrics.timer('simplify'):
+            keep = simplify(lat, lon, tolerance).tolist()
+        lat = [lat[k] for k in keep]
+        lon = [lon[k] for k in keep]
 
-    # get info for nearby clusters
-    clusters_query = (
-        session.query(
-            PhotoCluster,
-            ST_X(cast(PhotoCluster.centroid, Geometry)),
-            ST_Y(cast(PhotoCluster.centroid, Geometry)))
-        .filter(PhotoCluster.label.in_(nearby_clusters)))
+    payload['polyline'] = encode(lat, lon)
+    return payload
 
-    # construct the response
-    clusters = []
-    for cluster, x, y in clusters_query:
 
-        most_viewed_url = (
-            session.query(Photo.url)
-            .filter(Photo.id == cluster.most_viewed)
-            .first())[0]
+def get_nearby_clusters(shared, path):
 
-        clusters.append({
-            'location': (y, x),
-            'size': cluster.num_photos,
-            'repr_url': most_viewed_url,
-        })
+    if not path:
+        return []
 
-    return clusters
+    _, lat, lon = zip(*path)
+    with metrics.timer('clusters'):
+        return shared.cluster_index.get_nearby(
+            lat, lon, app.config['SIGHT_DISTANCE'])
 
 
 if __name__ == '__main__':
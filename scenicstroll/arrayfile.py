@@ -0,0 +1,98 @@
+"""
+Simple binary container for named numpy arrays plus JSON metadata, laid out
+so that arrays can be memory-mapped read-only. Pages of a mapped file are
+shared by all processes that map it, e.g. gunicorn workers.
+
+Layout: magic, header length (little-endian uint64), JSON header, then each
+array at an offset aligned to ALIGNMENT bytes. The header records a CRC-32
+checksum of each array, which can be verified on loading.
+"""
+
+import json
+import os
+import struct
+import zlib
+import numpy as np
+from tempfile import NamedTemporaryFile
+
+
+MAGIC = b'SSARRAY1'
+ALIGNMENT = 64
+
+
+def _aligned(n):
+    return (n + ALIGNMENT - 1)//ALIGNMENT*ALIGNMENT
+
+
+def save_arrays(path, arrays, meta=None):
+    """
+    Write arrays (a dict of name -> array) and metadata to `path`. The file
+    is written under a temporary name and renamed into place, so readers
+    never see a partial file.
+    """
+
+    arrays = {name: np.ascontiguousarray(a) for name, a in arrays.items()}
+
+    # the header records offsets, which depend on the header length
+    layout = {}
+    header_length = 0
+    while True:
+        offset = _aligned(len(MAGIC) + 8 + header_length)
+        for name in sorted(arrays):
+            a = arrays[name]
+            layout[name] = dict(dtype=a.dtype.str, shape=a.shape, offset=offset,
+                                crc32=zlib.crc32(a))
+            offset = _aligned(offset + a.nbytes)
+
+        header = json.dumps(dict(meta=meta or {}, arrays=layout)).encode('utf-8')
+        if len(header) <= header_length:
+            break
+        header_length = len(header) + 64
+
+    header = header.ljust(header_length)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    with NamedTemporaryFile('wb', dir=directory, delete=False) as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', header_length))
+        f.write(header)
+        for name in sorted(arrays):
+            f.seek(layout[name]['offset'])
+            f.write(arrays[name].tobytes())
+        f.truncate()
+
+    os.rename(f.name, path)
+
+
+def load_arrays(path, mmap=True, verify=False):
+    """
+    Read arrays and metadata written by `save_arrays`. With `mmap`, arrays
+    are read-only memory maps of the file. With `verify`, checksums are
+    checked (reading every array in full). Returns (arrays, meta).
+    """
+
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{} is not an array file'.format(path))
+        header_length, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_length).decode('utf-8'))
+
+    arrays = {}
+    for name, spec in header['arrays'].items():
+        dtype, shape = np.dtype(spec['dtype']), tuple(spec['shape'])
+
+        if int(np.prod(shape)) == 0:
+            arrays[name] = np.empty(shape, dtype)
+        elif mmap:
+            arrays[name] = np.memmap(path, dtype, 'r', spec['offset'], shape)
+        else:
+            with open(path, 'rb') as f:
+                f.seek(spec['offset'])
+                arrays[name] = np.fromfile(
+                    f, dtype, int(np.prod(shape))).reshape(shape)
+
+        if verify and zlib.crc32(arrays[name]) != spec['crc32']:
+            raise ValueError('{}: checksum mismatch for array {}'.format(
+                path, name))
+
+    return arrays, header['meta']
@@ -0,0 +1,124 @@
+from collections import OrderedDict
+from threading import Lock
+from time import time
+
+
+class LRUCache:
+    """
+    Thread-safe mapping of bounded size with least-recently-used eviction.
+    Entries older than `ttl` seconds (if given) are treated as missing.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None, timer=time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+
+    def __len__(self):
+        return len(self._data)
+
+    def _expired(self, stored):
+        return self.ttl is not None and self.timer() - stored > self.ttl
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, stored = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if self._expired(stored):
+                del self._data[key]
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, stored=None):
+        with self._lock:
+            self._data[key] = (value, self.timer() if stored is None else stored)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def entries(self):
+        """
+        List of (key, value, time stored) for unexpired entries, from least to
+        most recently used.
+        """
+
+        with self._lock:
+            return [(key, value, stored)
+                    for key, (value, stored) in self._data.items()
+                    if not self._expired(stored)]
+
+    def stats(self):
+        total = self.hits + self.misses
+        return dict(size=len(self._data),
+                    maxsize=self.maxsize,
+                    hits=self.hits,
+                    misses=self.misses,
+                    hit_rate=self.hits/total if total else 0.)
+
+
+class RouteCache:
+    """
+    Cache of query results keyed by snapped endpoints and alpha, and of route
+    frontiers keyed by endpoints, alpha range and path format, with alphas
+    quantized to multiples of `alpha_step`. The cache is emptied whenever the
+    data version it is checked against changes.
+    """
+
+    def __init__(self, maxsize=1024, alpha_step=0.5):
+        self.alpha_step = alpha_step
+        self.version = None
+        self._cache = LRUCache(maxsize)
+
+
+    def quantize(self, alpha):
+        if not self.alpha_step:
+            return alpha
+        return round(alpha/self.alpha_step)*self.alpha_step
+
+    def get(self, u1, u2, alpha):
+        return self._cache.get((u1, u2, self.quantize(alpha)))
+
+    def put(self, u1, u2, alpha, payload):
+        self._cache.put((u1, u2, self.quantize(alpha)), payload)
+
+    def get_frontier(self, u1, u2, alpha_min, alpha_max, fmt):
+        """
+        Cached frontier payloads for the alpha range, in the path format
+        `fmt`.
+        """
+
+        return self._cache.get(('frontier', u1, u2, self.quantize(alpha_min),
+                                self.quantize(alpha_max), fmt))
+
+    def put_frontier(self, u1, u2, alpha_min, alpha_max, fmt, payloads):
+        self._cache.put(('frontier', u1, u2, self.quantize(alpha_min),
+                         self.quantize(alpha_max), fmt), payloads)
+
+    def check_version(self, version):
+        """
+        Invalidate the cache if the data version has changed.
+        """
+
+        if version != self.version:
+            self._cache.clear()
+            self.version = version
+
+    def stats(self):
+        return dict(self._cache.stats(), version=self.version)
@@ -4,6 +4,85 @@ SECRET_KEY = 'secret'
 USERNAME = ''
 PASSWORD = ''
 
+# connection pool: connections kept open, extra connections allowed under
+# load, seconds to wait for a free one and seconds after which connections are
+# replaced. Size it to the number of threads (or greenlets) serving requests.
+DB_POOL_SIZE = 10
+DB_MAX_OVERFLOW = 10
+DB_POOL_TIMEOUT = 30
+DB_POOL_RECYCLE = 3600
+
+# threads running graph searches (0 to search in the request handler)
+ROUTING_WORKERS = 0
+
 SEARCH_RADIUS = 200
 SIGHT_DISTANCE = 800
 IMAGE_WIDTH = 200
+
+# load the full routing graph at startup rather than per request
+PRELOAD_GRAPH = True
+
+# graph search: 'dijkstra', 'astar' or 'bidirectional'
+SEARCH_METHOD = 'bidirectional'
+
+# without a preloaded graph, load the ellipse around the endpoints whose
+# points are at most each of these multiples of the trip distance (plus a
+# margin in metres) from the endpoints in total, widening until the route is
+# proven optimal (and loading the rest of the graph if the last doesn't)
+CORRIDOR_EXPAND = (1.2, 1.5, 2., 3.)
+CORRIDOR_MARGIN = 200
+
+# geocoding cache (TTL in seconds, optionally persisted to a JSON file) and
+# offline lookup of street names in these localities
+GEOCODE_CACHE_SIZE = 10000
+GEOCODE_CACHE_TTL = 30*24*3600
+GEOCODE_CACHE_FILE = None
+GEOCODE_GAZETTEER = True
+GEOCODE_LOCALITIES = ('San Francisco', 'SF', 'CA', 'California', 'USA')
+
+# threads for calls to the geocoding service; size it like DB_POOL_SIZE, to
+# the number of threads serving requests
+GEOCODE_WORKERS = 10
+
+# cache of query results, keyed by endpoints and alpha rounded to a multiple
+# of the step
+ROUTE_CACHE_SIZE = 1000
+ROUTE_CACHE_ALPHA_STEP = 0.5
+
+# seconds between checks of the database for new routing data
+DATA_VERSION_CHECK_INTERVAL = 60
+
+# largest number of sources plus targets in a request to /batch
+BATCH_MAX_POINTS = 2000
+
+# limits on the searches per request for the distinct optimal routes, which
+# are searched at multiples of ROUTE_CACHE_ALPHA_STEP, and the routes returned
+FRONTIER_MAX_SEARCHES = 16
+FRONTIER_MAX_ROUTES = 8
+
+# graph snapshot file (see graph_snapshot.py) to memory-map instead of
+# loading the graph from the database, if exported at the current data
+# version; optionally verify its checksums when loading
+GRAPH_SNAPSHOT = None
+GRAPH_SNAPSHOT_VERIFY = True
+
+# ALT landmark tables (see build_landmarks.py) to speed up searches at the
+# alphas they were computed for; ignored unless they match the graph
+LANDMARKS = None
+
+# scenery raster file (see scenery_raster.py) from which edge scores are
+# derived when the graph is preloaded, instead of the scores in the database.
+# Point a symlink at a new file to swap models without a restart.
+SCENERY_RASTER = None
+
+# log the stage timings of requests taking longer than this many seconds
+# (None to disable)
+SLOW_REQUEST_THRESHOLD = None
+
+# with format=polyline, simplify paths so that they are within this many
+# pixels of the full path at the zoom level given with the request
+POLYLINE_PIXELS = 1.
+
+# gzip responses of at least this many bytes for clients that accept it
+GZIP_MIN_SIZE = 1024
+GZIP_LEVEL = 6
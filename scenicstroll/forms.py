@@ -6,3 +6,9 @@ class InputForm(Form):
     address2 = StringField('address2', [Required()], default='Presidio, San Francisco')
     alpha = StringField('alpha', [Required()], default='5')
 
+
+class FrontierForm(Form):
+    address1 = StringField('address1', [Required()], default='15 Pier, San Francisco')
+    address2 = StringField('address2', [Required()], default='Presidio, San Francisco')
+    alpha_min = StringField('alpha_min', [Required()], default='0')
+    alpha_max = StringField('alpha_max', [Required()], default='11')
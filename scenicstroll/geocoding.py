@@ -0,0 +1,212 @@
+import json
+import re
+from cache import LRUCache
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+
+Location = namedtuple('Location', ['address', 'latitude', 'longitude'])
+
+
+# common abbreviations in street names, applied after lowercasing
+_abbreviations = {
+    'street': 'st',
+    'avenue': 'ave',
+    'boulevard': 'blvd',
+    'drive': 'dr',
+    'road': 'rd',
+    'place': 'pl',
+    'court': 'ct',
+    'lane': 'ln',
+    'terrace': 'ter',
+    'highway': 'hwy',
+    'north': 'n',
+    'south': 's',
+    'east': 'e',
+    'west': 'w',
+}
+
+_intersection_sep = re.compile(r'\s*(?:&|/|@|\band\b|\bat\b)\s*')
+
+
+def normalize_name(name):
+    """
+    Canonical form of a street name, e.g. 'Van Ness Avenue' -> 'van ness ave'.
+    """
+
+    words = re.sub(r'[^\w\s]', ' ', name.lower()).split()
+    return ' '.join(_abbreviations.get(w, w) for w in words)
+
+
+def normalize_address(address):
+    return ' '.join(address.lower().split())
+
+
+class Gazetteer:
+    """
+    Offline lookup of street and intersection names, e.g. 'Market St' or
+    'Market St & 5th St', built from the way names in the route database.
+    Addresses are only resolved if everything after the first comma is a
+    known locality (e.g. ', San Francisco, CA').
+    """
+
+    def __init__(self, streets, intersections, localities=()):
+        self.streets = streets
+        self.intersections = intersections
+        self.localities = set(normalize_name(l) for l in localities)
+
+
+    @classmethod
+    def from_named_xnodes(cls, named_xnodes, localities=()):
+        """
+        Build from (name, node_id, lat, lon) rows giving the names of the
+        ways through intersection nodes, e.g. from
+        `RouteDB.get_named_xnodes`.
+        """
+
+        names = defaultdict(set)
+        coords = {}
+
+        for row in named_xnodes:
+            names[row.node_id].add(normalize_name(row.name))
+            coords[row.node_id] = (row.lat, row.lon)
+
+        # intersections: any pair of differently named ways sharing a node
+        intersections = {}
+        street_nodes = defaultdict(list)
+
+        for node_id, node_names in names.items():
+            for name in node_names:
+                street_nodes[name].append(coords[node_id])
+                for other in node_names:
+                    if other != name:
+                        intersections.setdefault(
+                            (name, other), coords[node_id])
+
+        # streets: the intersection nearest the middle of the street
+        streets = {}
+        for name, points in street_nodes.items():
+            lat0 = sum(p[0] for p in points)/len(points)
+            lon0 = sum(p[1] for p in points)/len(points)
+            streets[name] = min(
+                points, key=lambda p: (p[0] - lat0)**2 + (p[1] - lon0)**2)
+
+        return cls(streets, intersections, localities)
+
+
+    def lookup(self, address):
+        """
+        Location of a street or intersection, or None if unknown.
+        """
+
+        parts = address.split(',')
+        if any(normalize_name(p) not in self.localities for p in parts[1:]):
+            return None
+
+        streets = [normalize_name(s)
+                   for s in _intersection_sep.split(parts[0]) if s.strip()]
+
+        if len(streets) == 1:
+            latlon = self.streets.get(streets[0])
+        elif len(streets) == 2:
+            latlon = self.intersections.get(tuple(streets))
+        else:
+            latlon = None
+
+        if latlon is None:
+            return None
+
+        return Location(address, *latlon)
+
+
+class Geocoder:
+    """
+    Geocoding through an external service (anything with a geopy-style
+    `geocode(address)` method), with an offline gazetteer tried first and an
+    LRU cache of the service's answers. The cache can be saved to and loaded
+    from a JSON file. Calls to the service are made from a pool of
+    `max_workers` threads, which should be about the number of threads
+    serving requests.
+    """
+
+    _missing = object()
+
+    def __init__(self, backend, gazetteer=None, maxsize=10000, ttl=None,
+                 max_workers=10):
+        self.backend = backend
+        self.gazetteer = gazetteer
+        self.cache = LRUCache(maxsize, ttl)
+        self._executor = ThreadPoolExecutor(max_workers)
+
+
+    def _lookup(self, address):
+        """
+        Location from the gazetteer or the cache, without calling the
+        service; `_missing` if neither has the address.
+        """
+
+        if self.gazetteer is not None:
+            loc = self.gazetteer.lookup(address)
+            if loc is not None:
+                return loc
+
+        return self.cache.get(normalize_address(address), self._missing)
+
+    def _fetch(self, address):
+        """
+        Location from the service, which is then cached.
+        """
+
+        loc = self.backend.geocode(address)
+        if loc is not None:
+            loc = Location(loc.address, loc.latitude, loc.longitude)
+        self.cache.put(normalize_address(address), loc)
+        return loc
+
+    def geocode(self, address):
+        """
+        Location of the address, or None if it couldn't be found.
+        """
+
+        loc = self._lookup(address)
+        return self._fetch(address) if loc is self._missing else loc
+
+    def geocode_all(self, addresses):
+        """
+        Locations of several addresses, in order. Addresses in the gazetteer
+        or the cache are answered at once; the others are looked up with the
+        service concurrently, so that hits never wait behind slow calls.
+        """
+
+        locs = [self._lookup(address) for address in addresses]
+
+        misses = {}
+        for address, loc in zip(addresses, locs):
+            if loc is self._missing:
+                misses.setdefault(normalize_address(address), address)
+
+        if len(misses) == 1:
+            found = {key: self._fetch(address)
+                     for key, address in misses.items()}
+        else:
+            futures = {key: self._executor.submit(self._fetch, address)
+                       for key, address in misses.items()}
+            found = {key: f.result() for key, f in futures.items()}
+
+        return [found[normalize_address(address)]
+                if loc is self._missing else loc
+                for address, loc in zip(addresses, locs)]
+
+    def save_cache(self, path):
+        entries = [(key, loc and list(loc), stored)
+                   for key, loc, stored in self.cache.entries()]
+
+        with open(path, 'w') as f:
+            json.dump(entries, f)
+
+    def load_cache(self, path):
+        with open(path) as f:
+            entries = json.load(f)
+
+        for key, loc, stored in entries:
+            self.cache.put(key, loc and Location(*loc), stored)
@@ -0,0 +1,224 @@
+"""
+Lightweight request instrumentation: time spent in named stages of each
+request, and per-request counts (e.g. database queries, graph size), kept as
+histograms and exported in the Prometheus text format.
+"""
+
+from bisect import bisect_left
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from threading import Lock, local
+from time import perf_counter
+
+
+# upper bounds of histogram buckets, for durations in seconds and for counts
+TIME_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.,
+                2.5, 5., 10.)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1e3, 2e3, 5e3, 1e4,
+                 2e4, 5e4, 1e5, 2e5, 5e5, 1e6)
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0]*(len(self.buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """
+        (upper bound, number of observations <= bound) for each bucket, the
+        last bound being infinity.
+        """
+
+        total = 0
+        for bound, n in zip(self.buckets + (float('inf'),), self.counts):
+            total += n
+            yield bound, total
+
+
+class RequestRecord:
+    """
+    Stage durations and counts of a single request.
+    """
+
+    def __init__(self):
+        self.start = perf_counter()
+        self.stages = OrderedDict()
+        self.counts = defaultdict(int)
+
+    @property
+    def elapsed(self):
+        return perf_counter() - self.start
+
+    def describe(self):
+        parts = ['{} {:.3f} s'.format(stage, t) for stage, t in self.stages.items()]
+        parts += ['{} {}'.format(name, n) for name, n in self.counts.items()]
+        return ', '.join(parts)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"'))
+                          for k, v in labels) + '}'
+
+
+def _format_bound(bound):
+    return '+Inf' if bound == float('inf') else repr(float(bound))
+
+
+class Metrics:
+    """
+    Registry of histograms and gauges, with a record of the request in
+    progress in each thread. Use `start_request` and `end_request` around
+    each request, `timer` around its stages and `count` for its counts.
+    Stages and counts outside a request only go to the histograms.
+    """
+
+    def __init__(self, namespace='scenicstroll'):
+        self.namespace = namespace
+        self._histograms = OrderedDict()
+        self._gauges = OrderedDict()
+        self._help = {}
+        self._lock = Lock()
+        self._local = local()
+
+
+    @property
+    def current(self):
+        """
+        Record of the current request, or None.
+        """
+
+        return getattr(self._local, 'record', None)
+
+    def observe(self, name, value, buckets=TIME_BUCKETS, help='', **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            self._help.setdefault(name, help)
+            if key not in series:
+                series[key] = Histogram(buckets)
+            series[key].observe(value)
+
+    def set_gauge(self, name, value, help='', **labels):
+        with self._lock:
+            self._gauges.setdefault(name, {})[tuple(sorted(labels.items()))] = value
+            self._help.setdefault(name, help)
+
+    @contextmanager
+    def timer(self, stage):
+        """
+        Time a stage of the current request.
+        """
+
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = perf_counter() - start
+            self.observe('stage_seconds', elapsed, stage=stage,
+                         help='Time spent in each stage of requests.')
+            record = self.current
+            if record is not None:
+                record.stages[stage] = record.stages.get(stage, 0.) + elapsed
+
+    @contextmanager
+    def attach(self, record):
+        """
+        Record stages and counts in this thread to `record`, the record of a
+        request being handled in another thread.
+        """
+
+        previous = self.current
+        self._local.record = record
+        try:
+            yield
+        finally:
+            self._local.record = previous
+
+    def count(self, name, n=1):
+        """
+        Add to a count of the current request, e.g. of database queries.
+        """
+
+        record = self.current
+        if record is not None:
+            record.counts[name] += n
+
+    def start_request(self):
+        self._local.record = RequestRecord()
+
+    def end_request(self, endpoint):
+        """
+        Record the duration and counts of the current request. Returns its
+        record, or None if no request was started.
+        """
+
+        record = self.current
+        if record is None:
+            return None
+
+        self._local.record = None
+        self.observe('request_seconds', record.elapsed, endpoint=endpoint,
+                     help='Duration of requests.')
+        for name, n in record.counts.items():
+            self.observe('request_' + name, n, COUNT_BUCKETS,
+                         endpoint=endpoint,
+                         help='Per-request count of {}.'.format(
+                             name.replace('_', ' ')))
+
+        return record
+
+    def instrument_engine(self, engine):
+        """
+        Count the database queries issued by each request on a SQLAlchemy
+        engine.
+        """
+
+        from sqlalchemy import event
+
+        @event.listens_for(engine, 'before_cursor_execute')
+        def count_query(*args):
+            self.count('db_queries')
+
+    def render(self):
+        """
+        All metrics in the Prometheus text exposition format.
+        """
+
+        lines = []
+
+        with self._lock:
+            for name, series in self._gauges.items():
+                full_name = '{}_{}'.format(self.namespace, name)
+                lines.append('# HELP {} {}'.format(full_name, self._help[name]))
+                lines.append('# TYPE {} gauge'.format(full_name))
+                for labels, value in series.items():
+                    lines.append('{}{} {!r}'.format(
+                        full_name, _format_labels(labels), float(value)))
+
+            for name, series in self._histograms.items():
+                full_name = '{}_{}'.format(self.namespace, name)
+                lines.append('# HELP {} {}'.format(full_name, self._help[name]))
+                lines.append('# TYPE {} histogram'.format(full_name))
+                for labels, h in series.items():
+                    for bound, n in h.cumulative():
+                        lines.append('{}_bucket{} {}'.format(
+                            full_name,
+                            _format_labels(labels + (('le', _format_bound(bound)),)),
+                            n))
+                    lines.append('{}_sum{} {!r}'.format(
+                        full_name, _format_labels(labels), h.sum))
+                    lines.append('{}_count{} {}'.format(
+                        full_name, _format_labels(labels), h.count))
+
+        return '\n'.join(lines) + '\n'
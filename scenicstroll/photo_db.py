@@ -1,7 +1,11 @@
 from sqlalchemy import BigInteger, Column, DateTime, ForeignKey, Integer, String
+from sqlalchemy import cast
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
-from geoalchemy2 import Geography
+from geoalchemy2 import Geography, Geometry
+from geoalchemy2.functions import ST_X, ST_Y
+from io import StringIO
+from math import cos, radians
 
 
 Base = declarative_base()
@@ -32,3 +36,185 @@ def create_tables(engine):
     Base.metadata.create_all(engine)
 
 
+class PhotoDB:
+
+    def __init__(self, session):
+        self.session = session
+
+
+    def get_clusters(self):
+        """
+        Centroid, size and most-viewed photo URL of every cluster.
+        """
+
+        return (
+            self.session
+            .query(
+                PhotoCluster.label,
+                ST_Y(cast(PhotoCluster.centroid, Geometry)).label('lat'),
+                ST_X(cast(PhotoCluster.centroid, Geometry)).label('lon'),
+                PhotoCluster.num_photos,
+                Photo.url.label('repr_url'))
+            .outerjoin(Photo, Photo.id == PhotoCluster.most_viewed)
+            .order_by(PhotoCluster.label))
+
+
+    def get_photo_locations(self):
+        """
+        Longitude and latitude of every photo in a cluster, leaving out
+        outliers.
+        """
+
+        return (
+            self.session
+            .query(
+                ST_X(cast(Photo.location, Geometry)).label('lon'),
+                ST_Y(cast(Photo.location, Geometry)).label('lat'))
+            .filter(Photo.label != None))
+
+
+    def get_photo_points(self):
+        """
+        Id, coordinates and cluster label of every photo.
+        """
+
+        return self.session.query(
+            Photo.id,
+            ST_Y(cast(Photo.location, Geometry)).label('lat'),
+            ST_X(cast(Photo.location, Geometry)).label('lon'),
+            Photo.label)
+
+
+    def select_region(self, table, cell_size, reach, counted_reach):
+        """
+        Create the temporary table `photo_region` of the cells of a
+        latitude-longitude grid within `reach` cells of the photos whose ids
+        are in `table`, and whether each is within `counted_reach` cells of
+        them. Cells are at least `cell_size` metres a side, so that every
+        photo within k*cell_size metres of a new photo is within k cells of
+        it. Returns the cell width and height in degrees, and the number of
+        cells.
+        """
+
+        max_lat = self.session.execute(
+            'SELECT max(abs(ST_Y(p.location::geometry))) '
+            'FROM {} n JOIN photo p ON p.id = n.id'.format(table)).scalar()
+
+        # the fewest metres per degree of latitude on the spheroid, and of
+        # longitude at the latitude of the region furthest from the equator
+        height = cell_size/110574.
+        max_lat = min((max_lat or 0.) + (reach + 1)*height, 89.)
+        width = cell_size/(111320.*cos(radians(max_lat)))
+
+        self.session.execute('DROP TABLE IF EXISTS photo_region')
+        self.session.execute(
+            'CREATE TEMPORARY TABLE photo_region ON COMMIT DROP AS '
+            'SELECT c.cx + dx AS cx, c.cy + dy AS cy, '
+            'bool_or(greatest(abs(dx), abs(dy)) <= :counted_reach) AS counted '
+            'FROM (SELECT DISTINCT '
+            '        floor(ST_X(p.location::geometry)/:width) AS cx, '
+            '        floor(ST_Y(p.location::geometry)/:height) AS cy '
+            '      FROM {} n JOIN photo p ON p.id = n.id) c, '
+            'generate_series(-:reach, :reach) dx, '
+            'generate_series(-:reach, :reach) dy '
+            'GROUP BY 1, 2'.format(table),
+            dict(width=width, height=height, reach=reach,
+                 counted_reach=counted_reach))
+
+        num_cells = self.session.execute(
+            'SELECT count(*) FROM photo_region').scalar()
+        return width, height, num_cells
+
+
+    # photos in the cells of `photo_region`: the envelope of each cell,
+    # padded against the geodesic edges of geography boxes, finds candidates
+    # with the spatial index, and the cell of each photo is then checked
+    # exactly, so that each photo is found once
+    _in_region = (
+        'FROM photo_region r JOIN photo p '
+        'ON p.location && ST_Expand(ST_MakeEnvelope('
+        '     r.cx*:width, r.cy*:height, (r.cx + 1)*:width, (r.cy + 1)*:height,'
+        '     4326), 0.1*:height)::geography '
+        'AND floor(ST_X(p.location::geometry)/:width) = r.cx '
+        'AND floor(ST_Y(p.location::geometry)/:height) = r.cy ')
+
+    def count_photos_in_region(self, width, height):
+        return self.session.execute(
+            'SELECT count(*) ' + self._in_region,
+            dict(width=width, height=height)).scalar()
+
+    def get_photos_in_region(self, width, height):
+        """
+        Id, coordinates and cluster label of every photo in the cells of
+        `photo_region` (see `select_region`), and whether its cell is
+        counted.
+        """
+
+        return self.session.execute(
+            'SELECT p.id, ST_Y(p.location::geometry) AS lat, '
+            'ST_X(p.location::geometry) AS lon, p.label, r.counted ' +
+            self._in_region,
+            dict(width=width, height=height))
+
+
+    def set_labels(self, ids, labels, merged=None):
+        """
+        Set the cluster labels of photos (-1 for outliers), after relabelling
+        all photos of merged clusters (a dict of old to new labels). Clusters
+        are created as needed, and merged ones deleted; call
+        `update_cluster_summaries` afterwards.
+        """
+
+        new_labels = sorted(set(l for l in labels if l >= 0))
+        self.session.execute(
+            'INSERT INTO cluster (label, num_photos) '
+            'SELECT label, 0 FROM unnest(CAST(:labels AS INTEGER[])) AS label '
+            'ON CONFLICT (label) DO NOTHING',
+            dict(labels=new_labels))
+
+        for old, new in (merged or {}).items():
+            self.session.execute(
+                'UPDATE photo SET label = :new WHERE label = :old',
+                dict(old=old, new=new))
+
+        self.session.execute('DROP TABLE IF EXISTS photo_label')
+        self.session.execute(
+            'CREATE TEMPORARY TABLE photo_label '
+            '(id BIGINT PRIMARY KEY, label INTEGER) ON COMMIT DROP')
+
+        cursor = self.session.connection().connection.cursor()
+        data = StringIO(''.join('{}\t{}\n'.format(i, l if l >= 0 else '\\N')
+                                for i, l in zip(ids, labels)))
+        cursor.copy_expert('COPY photo_label (id, label) FROM STDIN', data)
+
+        self.session.execute(
+            'UPDATE photo SET label = photo_label.label '
+            'FROM photo_label WHERE photo.id = photo_label.id '
+            'AND photo.label IS DISTINCT FROM photo_label.label')
+
+        if merged:
+            self.session.execute(
+                'DELETE FROM cluster WHERE label = ANY(:labels)',
+                dict(labels=list(merged)))
+
+
+    def update_cluster_summaries(self, labels=None):
+        """
+        Recompute the centroid, size and most-viewed photo of the given
+        clusters (default all) from their photos.
+        """
+
+        where = '' if labels is None else 'WHERE label = ANY(:labels) '
+
+        self.session.execute(
+            'INSERT INTO cluster (label, centroid, num_photos, most_viewed) '
+            'SELECT label, '
+            'ST_Centroid(ST_Collect(location::geometry))::geography, '
+            'count(*), '
+            '(array_agg(id ORDER BY views DESC NULLS LAST))[1] '
+            'FROM photo ' + where + 'GROUP BY label HAVING label IS NOT NULL '
+            'ON CONFLICT (label) DO UPDATE SET '
+            'centroid = excluded.centroid, '
+            'num_photos = excluded.num_photos, '
+            'most_viewed = excluded.most_viewed',
+            dict(labels=None if labels is None else list(labels)))
@@ -0,0 +1,122 @@
+"""
+Compact route geometry for responses: Douglas-Peucker simplification to a
+tolerance in metres, e.g. the size of a pixel at the zoom level the route is
+shown at, and the encoded polyline format used by Google Maps and Leaflet
+plugins (https://developers.google.com/maps/documentation/utilities/polylinealgorithm).
+"""
+
+import numpy as np
+
+
+EARTH_RADIUS = 6371008.8
+
+# metres per pixel of 256-pixel web mercator tiles at the equator, zoom 0
+METRES_PER_PIXEL = 2*np.pi*6378137./256
+
+
+def zoom_tolerance(zoom, lat, pixels=1.):
+    """
+    Size in metres of `pixels` pixels at the given zoom level and latitude.
+    """
+
+    return pixels*METRES_PER_PIXEL*np.cos(np.radians(lat))/2**zoom
+
+
+def simplify(lat, lon, tolerance):
+    """
+    Indices of the points kept by Douglas-Peucker simplification: every
+    point removed is within `tolerance` metres of the simplified line. The
+    first and last points are always kept.
+    """
+
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    n = len(lat)
+    if n < 3:
+        return np.arange(n)
+
+    # local equirectangular projection, in metres
+    scale = np.radians(EARTH_RADIUS)
+    x = lon*scale*np.cos(np.radians(lat.mean()))
+    y = lat*scale
+
+    keep = np.zeros(n, dtype=bool)
+    keep[[0, -1]] = True
+
+    # split all pending segments at once, one level of the recursion at a time
+    starts, ends = np.array([0]), np.array([n - 1])
+
+    while len(starts):
+        spans = ends - starts - 1
+        starts, ends, spans = starts[spans > 0], ends[spans > 0], spans[spans > 0]
+        if not len(starts):
+            break
+
+        # the points strictly inside each segment, and their segment
+        segment = np.repeat(np.arange(len(starts)), spans)
+        offsets = np.concatenate(([0], np.cumsum(spans)[:-1]))
+        points = starts[segment] + 1 + np.arange(len(segment)) - offsets[segment]
+
+        # distance of each point from its segment
+        i, j = starts[segment], ends[segment]
+        dx, dy = x[j] - x[i], y[j] - y[i]
+        px, py = x[points] - x[i], y[points] - y[i]
+        length_sq = dx*dx + dy*dy
+        with np.errstate(invalid='ignore', divide='ignore'):
+            t = np.where(length_sq > 0, (px*dx + py*dy)/length_sq, 0.)
+        t = np.clip(t, 0, 1)
+        d = np.hypot(px - t*dx, py - t*dy)
+
+        # farthest point of each segment, split there if beyond tolerance
+        farthest = np.maximum.reduceat(d, offsets)
+        is_max = d == farthest[segment]
+        first = np.unique(segment[is_max], return_index=True)[1]
+        split = points[is_max][first]
+        far = farthest > tolerance
+
+        keep[split[far]] = True
+        starts = np.concatenate((starts[far], split[far]))
+        ends = np.concatenate((split[far], ends[far]))
+
+    return np.flatnonzero(keep)
+
+
+def encode(lat, lon, precision=5):
+    """
+    Encoded polyline string of the points.
+    """
+
+    factor = 10**precision
+    values = np.column_stack((np.round(np.asarray(lat)*factor),
+                              np.round(np.asarray(lon)*factor))).astype(np.int64)
+    deltas = np.diff(np.vstack(([[0, 0]], values)), axis=0).ravel().tolist()
+
+    chars = []
+    for v in deltas:
+        v = ~(v << 1) if v < 0 else v << 1
+        while v >= 0x20:
+            chars.append(chr((0x20 | (v & 0x1f)) + 63))
+            v >>= 5
+        chars.append(chr(v + 63))
+
+    return ''.join(chars)
+
+
+def decode(s, precision=5):
+    """
+    Points of an encoded polyline, as lists of latitudes and longitudes.
+    """
+
+    values = []
+    v = shift = 0
+    for c in s:
+        b = ord(c) - 63
+        v |= (b & 0x1f) << shift
+        shift += 5
+        if b < 0x20:
+            values.append(~(v >> 1) if v & 1 else v >> 1)
+            v = shift = 0
+
+    coords = np.cumsum(np.array(values, dtype=np.int64).reshape(-1, 2), axis=0)
+    coords = coords/10**precision
+    return coords[:, 0].tolist(), coords[:, 1].tolist()
@@ -1,11 +1,13 @@
 import numpy as np
-from sqlalchemy import cast, create_engine, distinct, func
+from sqlalchemy import cast, create_engine, distinct, func, true
 from sqlalchemy import BigInteger, Column, Float, ForeignKey, Integer, String
 from sqlalchemy.orm import relationship, sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from geoalchemy2 import Geography, Geometry
 from geoalchemy2.functions import ST_X, ST_Y
+from io import StringIO
 from itertools import islice
+from multiprocessing import Pool
 
 
 Base = declarative_base()
@@ -20,6 +22,58 @@ def _grouper(n, iterable):
        yield chunk
 
 
+# model used by scoring worker processes
+_scorer = None
+
+
+def _init_scorer(model):
+    global _scorer
+    _scorer = model
+
+
+def _score_chunk(chunk):
+    ids, X = chunk
+    return ids, np.asarray(_scorer.score_samples(X), dtype=np.float64)
+
+
+def score_nodes(model, chunks, processes=None, normalize=None):
+    """
+    Score chunks of nodes, given as (ids, array of (lon, lat)), with
+    `model.score_samples` in a pool of `processes` processes (1 to score in
+    this process). `normalize`, by default the model's own `normalize`
+    method if it has one, is applied to the array of all scores, so that
+    normalization is global. Returns the arrays of ids and scores.
+    """
+
+    if normalize is None:
+        normalize = getattr(model, 'normalize', None)
+
+    ids, scores = [], []
+
+    if processes == 1:
+        _init_scorer(model)
+        results = map(_score_chunk, chunks)
+    else:
+        pool = Pool(processes, _init_scorer, (model,))
+        results = pool.imap(_score_chunk, chunks)
+
+    for chunk_ids, chunk_scores in results:
+        ids.append(chunk_ids)
+        scores.append(chunk_scores)
+
+    if processes != 1:
+        pool.close()
+        pool.join()
+
+    ids = np.concatenate(ids) if ids else np.array([], dtype=np.int64)
+    scores = np.concatenate(scores) if scores else np.array([])
+
+    if normalize is not None:
+        scores = normalize(scores)
+
+    return ids, scores
+
+
 class Node(Base):
     __tablename__ = 'node'
     id = Column(BigInteger, primary_key=True)
@@ -53,6 +107,12 @@ class Waypoint(Base):
     way = relationship('Way', backref='waypoints')
 
 
+class DataVersion(Base):
+    __tablename__ = 'data_version'
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False)
+
+
 def create_tables(engine):
     Base.metadata.create_all(engine)
 
@@ -61,35 +121,199 @@ class RouteDB:
 
     def __init__(self, session):
         self.session = session
+        self._min_score = (None, None)
+
 
+    def _in_neighborhood(self, node1, node2, expand=1.5, margin=200):
+        """
+        Filter for nodes in the ellipse with foci at the two nodes whose
+        points are at most `expand` times the distance between them, plus
+        `margin` metres, away from the foci in total, or for all nodes if
+        `expand` is None.
+        """
 
-    def _in_neighborhood(self, node1, node2, expand=1):
+        if expand is None:
+            return true()
 
         geog1 = cast(node1.loc, Geography)
         geog2 = cast(node2.loc, Geography)
-        radius = self.session.query(geog1.ST_Distance(geog2)).first()[0]
-        radius *= expand
-
-        return (Node.loc.ST_DWithin(geog1, radius) |
-                Node.loc.ST_DWithin(geog2, radius))
-
-
-    def get_relevant_waypoints(self, node1, node2, expand=1):
+        dist = self.session.query(geog1.ST_Distance(geog2)).first()[0]
+        total = expand*dist + margin
+
+        # each disk bounds the ellipse, and lets the spatial index do the work
+        return (Node.loc.ST_DWithin(geog1, total) &
+                Node.loc.ST_DWithin(geog2, total) &
+                (Node.loc.ST_Distance(geog1) + Node.loc.ST_Distance(geog2)
+                 <= total))
+
+
+    def get_relevant_waypoints(self, node1, node2, expand=1.5, margin=200,
+                               inner=None):
+        """
+        Waypoints at intersections (and at the two nodes) in the ellipse
+        around the two nodes given by `expand` and `margin` (see
+        `_in_neighborhood`) but not in the smaller one given by `inner`, if
+        any, together with the intersections next to them on their ways. With
+        `expand` None, all those not in the `inner` one.
+        Ordered by (way_id, idx), with node coordinates and an `inside` flag
+        that is false for those neighbours outside the ellipse: any path
+        that leaves the ellipse goes through one of them.
+        """
 
         # is intersection or terminal point
         is_xnode_or_terminal = (
             (Node.num_ways > 1) | (Node.id == node1.id) | (Node.id == node2.id))
 
-        in_neighborhood = self._in_neighborhood(node1, node2, expand)
+        inside = self._in_neighborhood(node1, node2, expand, margin)
+        in_ring = inside
+        if inner is not None:
+            in_ring = inside & ~self._in_neighborhood(
+                node1, node2, inner, margin)
+
+        ring_ways = (
+            self.session
+            .query(Waypoint.way_id)
+            .join(Node)
+            .filter(in_ring & is_xnode_or_terminal)
+            .distinct())
+
+        # the intersections of those ways, whether each is in the ring, and
+        # whether the one before or after it on the way is
+        flags = (
+            self.session
+            .query(
+                Waypoint.way_id,
+                Waypoint.idx,
+                Waypoint.node_id,
+                Waypoint.cdist,
+                Waypoint.cscore,
+                ST_Y(cast(Node.loc, Geometry)).label('lat'),
+                ST_X(cast(Node.loc, Geometry)).label('lon'),
+                inside.label('inside'),
+                in_ring.label('in_ring'))
+            .join(Node)
+            .filter(is_xnode_or_terminal &
+                    Waypoint.way_id.in_(ring_ways.subquery()))
+            .subquery())
+
+        f = flags.c
+        along_way = dict(partition_by=f.way_id, order_by=f.idx)
+        candidates = (
+            self.session
+            .query(
+                flags,
+                func.lag(f.in_ring).over(**along_way).label('prev_in_ring'),
+                func.lead(f.in_ring).over(**along_way).label('next_in_ring'))
+            .subquery())
 
+        c = candidates.c
         return (
             self.session
-            .query(Waypoint)
+            .query(c.way_id, c.idx, c.node_id, c.cdist, c.cscore, c.lat,
+                   c.lon, c.inside)
+            .filter(c.in_ring | c.prev_in_ring | c.next_in_ring)
+            .order_by(c.way_id, c.idx))
+
+
+    def get_min_score(self):
+        """
+        Smallest score of any stretch of way between consecutive
+        intersections, i.e. of any edge of the routing graph. Cached until
+        the data version changes.
+        """
+
+        version = self.get_data_version()
+        if self._min_score[0] != version:
+            score = self.session.execute(
+                'SELECT min(score) FROM ('
+                '  SELECT waypoint.cscore - lag(waypoint.cscore) OVER ('
+                '    PARTITION BY waypoint.way_id ORDER BY waypoint.idx'
+                '  ) AS score'
+                '  FROM waypoint JOIN node ON node.id = waypoint.node_id'
+                '  WHERE node.num_ways > 1'
+                ') AS edge').scalar()
+            self._min_score = version, score
+
+        return self._min_score[1]
+
+
+    def get_xnode_waypoints(self):
+        """
+        All waypoints at intersections, with node coordinates, ordered by
+        (way_id, idx). This is the full topology needed for routing.
+        """
+
+        return (
+            self.session
+            .query(
+                Waypoint.way_id,
+                Waypoint.idx,
+                Waypoint.node_id,
+                Waypoint.cdist,
+                Waypoint.cscore,
+                ST_Y(cast(Node.loc, Geometry)).label('lat'),
+                ST_X(cast(Node.loc, Geometry)).label('lon'))
             .join(Node)
-            .filter(in_neighborhood & is_xnode_or_terminal)
+            .filter(Node.num_ways > 1)
             .order_by(Waypoint.way_id, Waypoint.idx))
 
 
+    def get_way_geometry(self, way_ids=None):
+        """
+        Node ids and coordinates of all waypoints, or only of those in the
+        given ways, ordered by (way_id, idx).
+        """
+
+        query = (
+            self.session
+            .query(
+                Waypoint.way_id,
+                Waypoint.idx,
+                Waypoint.node_id,
+                ST_Y(cast(Node.loc, Geometry)).label('lat'),
+                ST_X(cast(Node.loc, Geometry)).label('lon'))
+            .join(Node))
+
+        if way_ids is not None:
+            query = query.filter(Waypoint.way_id.in_(way_ids))
+
+        return query.order_by(Waypoint.way_id, Waypoint.idx)
+
+
+    def get_xnodes(self):
+        """
+        Ids and coordinates of all intersection nodes.
+        """
+
+        return (
+            self.session
+            .query(
+                Node.id,
+                ST_Y(cast(Node.loc, Geometry)).label('lat'),
+                ST_X(cast(Node.loc, Geometry)).label('lon'))
+            .filter(Node.num_ways > 1))
+
+
+    def get_named_xnodes(self):
+        """
+        Names of the ways through each intersection node, with the node
+        coordinates.
+        """
+
+        return (
+            self.session
+            .query(
+                Way.name,
+                Waypoint.node_id,
+                ST_Y(cast(Node.loc, Geometry)).label('lat'),
+                ST_X(cast(Node.loc, Geometry)).label('lon'))
+            .select_from(Waypoint)
+            .join(Way, Way.id == Waypoint.way_id)
+            .join(Node, Node.id == Waypoint.node_id)
+            .filter((Node.num_ways > 1) & (Way.name != None))
+            .distinct())
+
+
     def get_nearest_xnodes(self, lat, lon, radius):
         pt = cast('POINT({} {})'.format(lon, lat), Geography)
         return (
@@ -100,27 +324,69 @@ class RouteDB:
             .order_by(Node.loc.ST_Distance(pt)))
 
 
-    def update_scores(self, model, chunksize=10000):
+    def get_data_version(self):
+        """
+        Version number of the routing data, bumped whenever it changes, so
+        that caches and preloaded structures know to refresh.
+        """
+
+        row = self.session.query(DataVersion.version).first()
+        return row[0] if row else 0
+
+
+    def bump_data_version(self):
+        version = self.get_data_version() + 1
+        self.session.merge(DataVersion(id=1, version=version))
+        self.session.flush()
+        return version
+
+
+    def update_scores(self, model, chunksize=10000, processes=None,
+                      normalize=None):
+        """
+        Score all nodes on ways with `model.score_samples`, which is passed
+        arrays of (lon, lat), and update the cumulative scores of waypoints.
+
+        Coordinates are streamed with a server-side cursor and scored in
+        chunks in a pool of `processes` processes (1 to score in this
+        process). `normalize`, by default the model's own `normalize` method
+        if it has one (as GridKDE does), is applied to the array of all
+        scores, so that normalization is global (see `score_nodes`). Scores
+        are written back with a single bulk update.
+        """
 
-        # update node scores
-        waypoint_nodes = (
+        # stream coordinates as plain arrays
+        coords = (
             self.session.query(
-                Node,
+                Node.id,
                 ST_X(cast(Node.loc, Geometry)),
                 ST_Y(cast(Node.loc, Geometry)))
                 .filter(Node.num_ways != 0)
-                .order_by(func.random()))   # random order
-
-        # process nodes in chunks for memory efficiency.
-        # note: normalization of scores is done per chunk, which should be a
-        # reasonable approximation to global normalization when the chunks are
-        # large since the query specifies random ordering
-        for chunk in _grouper(chunksize, waypoint_nodes):
-            nodes, x, y = zip(*chunk)
-            X = np.vstack((x, y)).T
-            scores = model.score_samples(X)
-            for node, score in zip(nodes, scores):
-                node.score = score
+                .yield_per(chunksize))
+
+        def chunks():
+            for chunk in _grouper(chunksize, coords):
+                ids, x, y = zip(*chunk)
+                yield np.array(ids, dtype=np.int64), np.vstack((x, y)).T
+
+        ids, scores = score_nodes(model, chunks(), processes, normalize)
+
+        self.session.execute('DROP TABLE IF EXISTS node_score')
+        self.session.execute(
+            'CREATE TEMPORARY TABLE node_score '
+            '(id BIGINT PRIMARY KEY, score DOUBLE PRECISION) ON COMMIT DROP')
+
+        cursor = self.session.connection().connection.cursor()
+
+        for i in range(0, len(ids), chunksize):
+            rows = zip(ids[i:i + chunksize].tolist(),
+                       scores[i:i + chunksize].tolist())
+            data = StringIO(''.join('{}\t{!r}\n'.format(*row) for row in rows))
+            cursor.copy_expert('COPY node_score (id, score) FROM STDIN', data)
+
+        self.session.execute(
+            'UPDATE node SET score = node_score.score '
+            'FROM node_score WHERE node.id = node_score.id')
 
         # update cumulative scores
         sq = (
@@ -136,3 +402,5 @@ class RouteDB:
              .filter(Waypoint.id == sq.c.id)
              .update({Waypoint.cscore: sq.c.cscore}))
 
+        self.bump_data_version()
+
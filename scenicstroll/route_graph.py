@@ -1,64 +1,935 @@
-import networkx as nx
-from collections import defaultdict
+import numpy as np
+import zlib
+from copy import copy
+from heapq import heappop, heappush
+from math import asin, cos, sin, sqrt
 
 
-def _add_way(G, way_id, waypoints, alpha=0):
+EARTH_RADIUS = 6371008.8
+
+
+class NoPathError(Exception):
+    pass
+
+
+class Topology:
+    """
+    Compact representation of the road network restricted to intersection
+    nodes. Each stretch of way between consecutive intersections becomes a
+    pair of directed edges stored in compressed sparse row (CSR) form, so that
+    the out-edges of node i are edges indptr[i] to indptr[i+1]. Edge
+    attributes (way_id, idx1, idx2, dist, score, reversed) are kept in typed
+    arrays indexed by edge. Every edge u->v has a twin v->u with the same
+    attributes, given by `twin`.
+    """
+
+    # everything needed to rebuild the topology, see `to_arrays`
+    _array_names = ('node_ids', 'lat', 'lon', 'indptr', 'tails', 'heads',
+                    'way_id', 'idx1', 'idx2', 'dist', 'score', 'reversed',
+                    'twin', 'chord')
+
+    def __init__(self, node_ids, lat, lon, tails, heads,
+                 way_id, idx1, idx2, dist, score, reversed, twin):
+
+        order = np.argsort(tails, kind='mergesort')
+        position = np.empty_like(order)
+        position[order] = np.arange(len(order))
+
+        self.node_ids = node_ids
+        self.lat = lat
+        self.lon = lon
+
+        self.indptr = np.concatenate(
+            ([0], np.cumsum(np.bincount(tails, minlength=len(node_ids)))))
+        self.tails = tails[order]
+        self.heads = heads[order]
+        self.way_id = way_id[order]
+        self.idx1 = idx1[order]
+        self.idx2 = idx2[order]
+        self.dist = dist[order]
+        self.score = score[order]
+        self.reversed = reversed[order]
+        self.twin = position[twin[order]]
+
+        # great-circle length of each edge, for search heuristics
+        self.chord = haversine(
+            lat[self.tails], lon[self.tails], lat[self.heads], lon[self.heads])
+
+        self._index()
+
+
+    def _index(self):
+        self.node_index = {u: i for i, u in enumerate(self.node_ids.tolist())}
+
+        # plain lists are much faster to index from the search loop
+        self._adjacency = (
+            self.indptr.tolist(), self.heads.tolist(), self.tails.tolist(),
+            self.twin.tolist())
+        self._latlon = (np.radians(self.lat).tolist(),
+                        np.radians(self.lon).tolist())
+
+
+    @classmethod
+    def from_waypoints(cls, waypoints):
+        """
+        Build the topology from an iterable of waypoints ordered by
+        (way_id, idx). Waypoints need `way_id`, `idx`, `node_id`, `cdist` and
+        `cscore` attributes, and optionally `lat` and `lon`.
+        """
+
+        rows = [(wp.way_id, wp.idx, wp.node_id, wp.cdist, wp.cscore,
+                 getattr(wp, 'lat', None), getattr(wp, 'lon', None))
+                for wp in waypoints]
+
+        if rows:
+            way_id, idx, node_id, cdist, cscore, lat, lon = zip(*rows)
+        else:
+            way_id = idx = node_id = cdist = cscore = lat = lon = ()
+
+        way_id = np.array(way_id, dtype=np.int64)
+        idx = np.array(idx, dtype=np.int32)
+        cdist = np.array(cdist, dtype=np.float64)
+        cscore = np.array(cscore, dtype=np.float64)
+
+        node_ids, node = np.unique(
+            np.array(node_id, dtype=np.int64), return_inverse=True)
+
+        node_lat = np.empty(len(node_ids))
+        node_lon = np.empty(len(node_ids))
+        node_lat[node] = np.array(lat, dtype=np.float64)
+        node_lon[node] = np.array(lon, dtype=np.float64)
+
+        # consecutive waypoints of the same way are joined by an edge
+        a = np.flatnonzero(way_id[:-1] == way_id[1:])
+        b = a + 1
+
+        dist = cdist[b] - cdist[a]
+        score = cscore[b] - cscore[a]
+        num_edges = len(a)
+
+        return cls(
+            node_ids, node_lat, node_lon,
+            tails=np.concatenate((node[a], node[b])),
+            heads=np.concatenate((node[b], node[a])),
+            way_id=np.tile(way_id[a], 2),
+            idx1=np.tile(idx[a], 2),
+            idx2=np.tile(idx[b], 2),
+            dist=np.tile(dist, 2),
+            score=np.tile(score, 2),
+            reversed=np.repeat([False, True], num_edges),
+            twin=np.concatenate((np.arange(num_edges, 2*num_edges),
+                                 np.arange(num_edges))))
+
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """
+        Rebuild a topology from the arrays given by `to_arrays`. The arrays
+        are used as given, so they may be read-only memory maps shared
+        between processes.
+        """
+
+        topology = cls.__new__(cls)
+        for name in cls._array_names:
+            setattr(topology, name, arrays[name])
+
+        topology._index()
+        return topology
+
+
+    def to_arrays(self):
+        return {name: getattr(self, name) for name in self._array_names}
+
+    def with_scores(self, score):
+        """
+        Copy of the topology with the given edge scores, sharing all other
+        arrays.
+        """
+
+        topology = copy(self)
+        topology.score = np.asarray(score, dtype=np.float64)
+        return topology
+
+    @property
+    def num_nodes(self):
+        return len(self.node_ids)
+
+    @property
+    def num_edges(self):
+        return len(self.heads)
+
+    def weights(self, alpha):
+        """
+        Edge weights for the given alpha, weight = distance * score^alpha.
+        Edges with undefined weight (e.g. missing scores) are made impassable.
+        """
+
+        with np.errstate(all='ignore'):
+            weights = self.dist * self.score**alpha
+
+        weights[~np.isfinite(weights)] = np.inf
+        return weights
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """
+    Great-circle distance in metres between points given in degrees.
+    """
+
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = (np.sin((lat2 - lat1)/2)**2 +
+         np.cos(lat1)*np.cos(lat2)*np.sin((lon2 - lon1)/2)**2)
+    return 2*EARTH_RADIUS*np.arcsin(np.sqrt(a))
+
+
+def _walk_back(pred, tails, v):
+    edges = []
+    while pred[v] is not None:
+        e = pred[v]
+        edges.append(e)
+        v = tails[e]
+    edges.reverse()
+    return edges
+
+
+def dijkstra(adjacency, weights, source, target):
+    """
+    Single-pair shortest path search on a CSR graph. Returns the list of
+    edges on the path (None if there is no path) and the number of nodes
+    expanded.
+    """
+
+    indptr, heads, tails, _ = adjacency
+    inf = float('inf')
+
+    dist = {source: 0.}
+    pred = {source: None}
+    done = set()
+    heap = [(0., source)]
+
+    while heap:
+        d, u = heappop(heap)
+
+        if u in done:
+            continue
+
+        done.add(u)
+
+        if u == target:
+            return _walk_back(pred, tails, target), len(done)
+
+        for e in range(indptr[u], indptr[u + 1]):
+            v = heads[e]
+            dv = d + weights[e]
+            if dv < dist.get(v, inf):
+                dist[v] = dv
+                pred[v] = e
+                heappush(heap, (dv, v))
+
+    return None, len(done)
+
+
+def dijkstra_many(adjacency, weights, source, targets):
+    """
+    Single-source search on a CSR graph that stops once all of `targets` are
+    settled. Returns the predecessor edge and weight of the optimal path to
+    each settled node, the set of settled nodes and the number expanded.
+    """
+
+    indptr, heads, tails, _ = adjacency
+    inf = float('inf')
+
+    dist = {source: 0.}
+    pred = {source: None}
+    done = set()
+    heap = [(0., source)]
+    remaining = set(targets)
+
+    while heap and remaining:
+        d, u = heappop(heap)
+
+        if u in done:
+            continue
+
+        done.add(u)
+        remaining.discard(u)
+
+        for e in range(indptr[u], indptr[u + 1]):
+            v = heads[e]
+            dv = d + weights[e]
+            if dv < dist.get(v, inf):
+                dist[v] = dv
+                pred[v] = e
+                heappush(heap, (dv, v))
+
+    return pred, dist, done, len(done)
+
+
+def dijkstra_nearest(adjacency, weights, source, targets, limit=float('inf')):
+    """
+    Least weight on a CSR graph of the optimal path from source to one of
+    `targets`, a dict from node to a weight added to paths ending there, or
+    `limit` if none is less, in which case the search stops there.
+    """
+
+    indptr, heads, _, _ = adjacency
+    inf = float('inf')
+
+    least_extra = min(targets.values()) if targets else inf
+    best = limit
+    dist = {source: 0.}
+    done = set()
+    heap = [(0., source)]
+
+    while heap:
+        d, u = heappop(heap)
+
+        if d + least_extra >= best:
+            break
+        if u in done:
+            continue
+
+        done.add(u)
+        if u in targets:
+            best = min(best, d + targets[u])
+
+        for e in range(indptr[u], indptr[u + 1]):
+            v = heads[e]
+            dv = d + weights[e]
+            if dv < dist.get(v, inf):
+                dist[v] = dv
+                heappush(heap, (dv, v))
+
+    return best
+
+
+def astar(adjacency, weights, source, target, heuristic):
+    """
+    A* search on a CSR graph. `heuristic(v)` must be a consistent lower bound
+    on the weight of the optimal path from v to the target. Returns the same
+    as `dijkstra`.
+    """
+
+    indptr, heads, tails, _ = adjacency
+    inf = float('inf')
+
+    dist = {source: 0.}
+    pred = {source: None}
+    done = set()
+    heap = [(heuristic(source), source)]
+
+    while heap:
+        _, u = heappop(heap)
+
+        if u in done:
+            continue
+
+        done.add(u)
+
+        if u == target:
+            return _walk_back(pred, tails, target), len(done)
+
+        d = dist[u]
+        for e in range(indptr[u], indptr[u + 1]):
+            v = heads[e]
+            dv = d + weights[e]
+            if dv < dist.get(v, inf):
+                dist[v] = dv
+                pred[v] = e
+                heappush(heap, (dv + heuristic(v), v))
+
+    return None, len(done)
+
+
+def bidirectional_astar(adjacency, weights, source, target,
+                        heuristic_to_target, heuristic_to_source):
+    """
+    Bidirectional A* search on a CSR graph with twinned edges, using the
+    average of the two heuristics as potential so that both searches see the
+    same non-negative reduced weights. The searches stop once the sum of
+    their smallest keys reaches the best path found so far. Returns the same
+    as `dijkstra`.
+    """
+
+    indptr, heads, tails, twin = adjacency
+    inf = float('inf')
+
+    def potential(v):
+        return (heuristic_to_target(v) - heuristic_to_source(v))/2
+
+    if source == target:
+        return [], 0
+
+    # forward and reverse search state
+    dist = ({source: 0.}, {target: 0.})
+    pred = ({source: None}, {target: None})
+    done = (set(), set())
+    heap = ([(potential(source), source)], [(-potential(target), target)])
+    sign = (1, -1)
+
+    best, meet = inf, None
+
+    while heap[0] and heap[1]:
+
+        if heap[0][0][0] + heap[1][0][0] >= best:
+            break
+
+        # expand the side with the smaller key
+        side = 0 if heap[0][0][0] <= heap[1][0][0] else 1
+        _, u = heappop(heap[side])
+
+        if u in done[side]:
+            continue
+
+        done[side].add(u)
+        d = dist[side][u]
+        other = dist[1 - side]
+
+        for e in range(indptr[u], indptr[u + 1]):
+            v = heads[e]
+            dv = d + weights[e]
+            if dv < dist[side].get(v, inf):
+                dist[side][v] = dv
+                # the reverse search records edges in the forward direction
+                pred[side][v] = e if side == 0 else twin[e]
+                heappush(heap[side], (dv + sign[side]*potential(v), v))
+                if v in other and dv + other[v] < best:
+                    best, meet = dv + other[v], v
+
+    num_expanded = len(done[0]) + len(done[1])
+
+    if meet is None:
+        return None, num_expanded
+
+    # forward half from the source, then reverse half out to the target
+    edges = _walk_back(pred[0], tails, meet)
+    v = meet
+    while pred[1][v] is not None:
+        e = pred[1][v]
+        edges.append(e)
+        v = heads[e]
+
+    return edges, num_expanded
+
+
+class Landmarks:
     """
-    Add way, specified by list of waypoints, to the routing graph G.
-    The parameter `alpha` controls the relative weighting of distance
-    and score through the formula weight = distance * score^alpha.
+    ALT (A*, landmarks, triangle inequality) preprocessing for a fixed set
+    of alphas: the optimal path weight from each of a few landmark nodes to
+    every node, for each alpha. Since every edge has a twin with the same
+    weight, d(v, t) >= |d(l, t) - d(l, v)| for any landmark l, a consistent
+    lower bound usually much tighter than the great-circle one.
+
+    The tables only hold for the topology they were computed on, as
+    identified by `fingerprint`.
     """
 
-    wp_next = iter(waypoints)
-    next(wp_next)
+    def __init__(self, alphas, landmarks, distances, fingerprint):
+        self.alphas = [float(a) for a in alphas]
+        self.landmarks = landmarks
+        self.distances = distances
+        self.fingerprint = fingerprint
+
+
+    @staticmethod
+    def topology_fingerprint(topology):
+        """
+        Checksum of the node ids, edges and edge weight inputs of a topology.
+        """
+
+        crc = 0
+        for a in (topology.node_ids, topology.heads, topology.dist,
+                  topology.score):
+            crc = zlib.crc32(np.ascontiguousarray(a).tobytes(), crc)
+        return crc
+
+    @classmethod
+    def build(cls, topology, alphas, num_landmarks=16, seed=0):
+        """
+        Choose landmarks by farthest-point selection on distances (so that
+        they spread out to the edges of the network), and compute their
+        distance tables for each alpha.
+        """
+
+        rng = np.random.RandomState(seed)
+        adjacency = topology._adjacency
+        n = topology.num_nodes
 
-    for wp1, wp2 in zip(waypoints, wp_next):
+        def distances(source, weights):
+            _, dist, _, _ = dijkstra_many(adjacency, weights, source, range(n))
+            d = np.full(n, np.inf)
+            d[list(dist.keys())] = list(dist.values())
+            return d
 
-        u1, u2 = wp1.node_id, wp2.node_id
-        dist = wp2.cdist - wp1.cdist
-        score = wp2.cscore - wp1.cscore
-        weight = dist * score**alpha
+        # farthest-point selection, starting from a random node
+        lengths = topology.weights(0).tolist()
+        landmarks = []
+        nearest = np.full(n, np.inf)
+        candidate = rng.randint(n) if n else None
 
-        if not G.has_edge(u1, u2) or weight < G.get_edge_data(u1, u2)['weight']:
+        while candidate is not None and len(landmarks) < num_landmarks:
+            landmarks.append(candidate)
+            d = distances(candidate, lengths)
+            nearest = np.minimum(nearest, np.where(np.isfinite(d), d, -np.inf))
+            nearest[landmarks] = -np.inf
+            best = int(np.argmax(nearest))
+            candidate = best if nearest[best] > 0 else None
 
-            edge_data = dict(way_id=way_id,
-                             idx1=wp1.idx,
-                             idx2=wp2.idx,
-                             dist=dist,
-                             score=score,
-                             weight=weight)
+        table = np.empty((len(alphas), len(landmarks), n))
+        for b, alpha in enumerate(alphas):
+            weights = topology.weights(alpha).tolist()
+            for k, l in enumerate(landmarks):
+                table[b, k] = distances(l, weights)
 
-            G.add_edge(u1, u2, dict(reversed=False, **edge_data))
-            G.add_edge(u2, u1, dict(reversed=True, **edge_data))
+        return cls(alphas, np.array(landmarks, dtype=np.int64), table,
+                   cls.topology_fingerprint(topology))
+
+    @classmethod
+    def from_arrays(cls, arrays, meta):
+        return cls(meta['alphas'], arrays['landmarks'], arrays['distances'],
+                   meta['fingerprint'])
+
+    def to_arrays(self):
+        return (dict(landmarks=self.landmarks, distances=self.distances),
+                dict(alphas=self.alphas, fingerprint=self.fingerprint))
+
+    def matches(self, topology):
+        return (self.distances.shape[2] == topology.num_nodes and
+                self.fingerprint == self.topology_fingerprint(topology))
+
+    def bucket(self, alpha, tol=1e-9):
+        """
+        Index of the table for `alpha`, or None if there is none.
+        """
+
+        for b, a in enumerate(self.alphas):
+            if abs(a - alpha) <= tol:
+                return b
+        return None
+
+    def heuristics(self, b, source, target, num_active=4):
+        """
+        Lower bounds on the path weight from each node to `target` and from
+        `source` to each node, as functions of the node index, using the
+        `num_active` landmarks giving the best bound between source and
+        target. Each bound is computed when the search first asks for it.
+        """
+
+        d = self.distances[b]
+        gap = np.abs(d[:, target] - d[:, source])
+        gap[~np.isfinite(gap)] = -1
+        active = np.argsort(-gap)[:num_active]
+        to_target = _LandmarkBounds(d, active, target)
+        from_source = _LandmarkBounds(d, active, source)
+        return to_target.__getitem__, from_source.__getitem__
+
+
+class _LandmarkBounds(dict):
+    """
+    Lower bounds max |d(l, v) - d(l, node)| over the `active` landmarks on
+    the path weight between each node v and `node`, from the landmark tables
+    `d`, each computed the first time v is looked up so that a search pays
+    only for the nodes it reaches.
+    """
+
+    def __init__(self, d, active, node):
+        # memoryviews index to floats much faster than arrays do
+        rows = [memoryview(np.ascontiguousarray(d[k]))
+                for k in active.tolist()]
+        self.rows = [(row, row[node]) for row in rows]
+
+    def __missing__(self, v):
+        inf = float('inf')
+        h = 0.
+        for row, r in self.rows:
+            gap = abs(row[v] - r)
+            if gap > h:
+                h = gap
+            elif gap != gap:
+                h = inf
+                break
+
+        # nodes unreachable from a landmark give no bound
+        if h == inf:
+            h = 0.
+        self[v] = h
+        return h
 
 
 class RoutingGraph:
 
     def __init__(self, waypoints, alpha=0):
+        self._init(Topology.from_waypoints(waypoints), alpha)
 
-        self._alpha = alpha
-        self.G = nx.DiGraph()
-        ways = defaultdict(list)
 
-        for wp in waypoints:
-            ways[wp.way_id].append(wp)
+    @classmethod
+    def from_topology(cls, topology, alpha=0, landmarks=None):
+        """
+        Create a routing graph sharing a preloaded topology. Only the edge
+        weights for `alpha` are computed. A* searches use the landmark
+        tables for `alpha` if given `Landmarks` has them.
+        """
 
-        for way_id, wps in ways.items():
-            _add_way(self.G, way_id, wps, alpha)
+        rg = cls.__new__(cls)
+        rg._init(topology, alpha, landmarks)
+        return rg
+
+
+    def _init(self, topology, alpha, landmarks=None):
+        self._alpha = alpha
+        self.topology = topology
+        self.weights = topology.weights(alpha)
+        self.landmarks = landmarks
+        self._weight_list = None
 
 
     @property
     def alpha(self):
         return self._alpha
 
-    def get_optimal_path(self, u1, u2):
+    @property
+    def weight_list(self):
+        """
+        Edge weights as a list, which the searches index faster than an
+        array. Built on first use and shared by all searches on the graph.
+        """
+
+        if self._weight_list is None:
+            self._weight_list = self.weights.tolist()
+        return self._weight_list
+
+    def _edge_data(self, e):
+        t = self.topology
+        return dict(way_id=int(t.way_id[e]),
+                    idx1=int(t.idx1[e]),
+                    idx2=int(t.idx2[e]),
+                    dist=float(t.dist[e]),
+                    score=float(t.score[e]),
+                    weight=float(self.weights[e]),
+                    reversed=bool(t.reversed[e]))
+
+    def _heuristic(self, target):
+        """
+        Lower bound on the weight of the optimal path from each node to
+        `target`: the great-circle distance times the smallest weight per
+        great-circle metre of any edge. Since the bound holds edge by edge,
+        the heuristic is consistent as well as admissible.
+        """
+
+        t = self.topology
+        has_length = t.chord > 0
+
+        with np.errstate(invalid='ignore'):
+            ratio = self.weights[has_length]/t.chord[has_length]
+
+        ratio = ratio[~np.isnan(ratio)]
+        rate = ratio.min() if len(ratio) else 0.
+
+        lat, lon = t._latlon
+        lat2, lon2 = lat[target], lon[target]
+        cos_lat2 = cos(lat2)
+        scale = 2*EARTH_RADIUS*rate
+
+        if not np.isfinite(scale):
+            return lambda v: 0.
+
+        def heuristic(v):
+            a = (sin((lat2 - lat[v])/2)**2 +
+                 cos(lat[v])*cos_lat2*sin((lon2 - lon[v])/2)**2)
+            return scale*asin(sqrt(a))
+
+        return heuristic
+
+    def get_optimal_path(self, u1, u2, method='dijkstra'):
         """
         Find the optimal path (i.e. path of least total weight) between the
-        nodes identified by u1, u2.
+        nodes identified by u1, u2. `method` is one of 'dijkstra', 'astar' or
+        'bidirectional'; all give optimal paths, and the number of nodes
+        expanded by the search is left in `num_expanded`.
         """
 
-        nodes = nx.shortest_path(self.G, u1, u2, weight='weight')
-        edges = [self.G.get_edge_data(u1_, u2_) for u1_, u2_ in zip(nodes, nodes[1:])]
+        t = self.topology
+
+        try:
+            source, target = t.node_index[u1], t.node_index[u2]
+        except KeyError as e:
+            raise NoPathError('node {} is not in the graph'.format(e))
+
+        # A* uses landmark bounds if there are tables for this alpha, and
+        # otherwise great-circle bounds, which need node coordinates
+        bucket = (self.landmarks.bucket(self._alpha)
+                  if self.landmarks is not None else None)
+
+        if method != 'dijkstra' and bucket is None and np.isnan(t.lat).any():
+            method = 'dijkstra'
+
+        weights = self.weight_list
+
+        if method == 'dijkstra':
+            path_edges, self.num_expanded = dijkstra(
+                t._adjacency, weights, source, target)
+        elif method == 'astar':
+            heuristic = (
+                self.landmarks.heuristics(bucket, source, target)[0]
+                if bucket is not None else self._heuristic(target))
+            path_edges, self.num_expanded = astar(
+                t._adjacency, weights, source, target, heuristic)
+        elif method == 'bidirectional':
+            heuristics = (
+                self.landmarks.heuristics(bucket, source, target)
+                if bucket is not None else
+                (self._heuristic(target), self._heuristic(source)))
+            path_edges, self.num_expanded = bidirectional_astar(
+                t._adjacency, weights, source, target, *heuristics)
+        else:
+            raise ValueError('unknown search method {}'.format(method))
+
+        if path_edges is None:
+            raise NoPathError('no path from {} to {}'.format(u1, u2))
+
+        nodes = [u1] + [int(t.node_ids[t.heads[e]]) for e in path_edges]
+        edges = [self._edge_data(e) for e in path_edges]
 
         return nodes, edges
 
+
+    def get_one_to_many(self, u1, targets, with_paths=False):
+        """
+        Optimal paths from u1 to each of the nodes `targets`, from a single
+        search that stops once every target is reached. Returns a list with,
+        for each target, a dict with the path's `dist` and `weight` (and its
+        `nodes` and `edges` if `with_paths`), or None if there is no path.
+        The number of nodes expanded is left in `num_expanded`.
+        """
+
+        t = self.topology
+        index = [t.node_index.get(u) for u in targets]
+
+        if u1 not in t.node_index:
+            self.num_expanded = 0
+            return [None]*len(index)
+
+        pred, dist, done, self.num_expanded = dijkstra_many(
+            t._adjacency, self.weight_list, t.node_index[u1],
+            [i for i in index if i is not None])
+
+        results = []
+        for u2, i in zip(targets, index):
+            if i is None or i not in done:
+                results.append(None)
+                continue
+
+            path_edges = _walk_back(pred, t.tails, i)
+            result = dict(dist=float(t.dist[path_edges].sum()),
+                          weight=dist[i])
+            if with_paths:
+                result['nodes'] = [u1] + [int(t.node_ids[t.heads[e]])
+                                          for e in path_edges]
+                result['edges'] = [self._edge_data(e) for e in path_edges]
+            results.append(result)
+
+        return results
+
+    def get_via_weight(self, u1, u2, via, limit=float('inf'), rate=0.):
+        """
+        Lower bound on the weight of any path from u1 to u2 through one of
+        the nodes `via`, given a lower bound `rate` on the weight per metre
+        of any edge: the least over them of the optimal path from u1 to one,
+        plus the larger of the optimal path from the nearest of them to u2
+        (edges weigh the same both ways) and `rate` times the great-circle
+        distance on to u2. Searches stop at `limit`, which is returned if
+        the bound is at least that.
+        """
+
+        t = self.topology
+        index = [t.node_index[u] for u in via if u in t.node_index]
+
+        if u1 not in t.node_index or u2 not in t.node_index or not index:
+            return limit
+
+        source, target = t.node_index[u1], t.node_index[u2]
+        weights = self.weight_list
+
+        rest = dijkstra_nearest(t._adjacency, weights, target,
+                                dict.fromkeys(index, 0.), limit)
+        if rest >= limit:
+            return limit
+
+        extra = dict.fromkeys(index, rest)
+        if rate > 0 and not np.isnan(t.lat[index + [target]]).any():
+            to_target = rate*haversine(t.lat[index], t.lon[index],
+                                       t.lat[target], t.lon[target])
+            extra = dict(zip(index, np.maximum(to_target, rest).tolist()))
+
+        return dijkstra_nearest(t._adjacency, weights, source, extra, limit)
+
+    def get_many_to_many(self, sources, targets, with_paths=False):
+        """
+        Optimal paths from each of `sources` to each of `targets`, with one
+        search per source. Yields (source, results) in the order of
+        `sources`, with results as from `get_one_to_many`, so that large
+        batches can be consumed as they are computed. Locations can be
+        snapped to nodes in bulk with `NodeIndex.nearest`.
+        """
+
+        for u1 in sources:
+            yield u1, self.get_one_to_many(u1, targets, with_paths)
+
+
+def corridor_search(fetch, u1, u2, alphas, steps, min_score=None,
+                    method='dijkstra'):
+    """
+    Optimal paths between u1 and u2 for each alpha, loading only a region
+    around them. `fetch(expand, inner)` returns the waypoints at
+    intersections in the region for `expand`, one of the increasing `steps`,
+    that were not in the region for `inner`, the step before (None at
+    first), along with the intersections next to them on their ways. Each
+    has an `inside` flag, false for the neighbours outside the region (see
+    `RouteDB.get_relevant_waypoints`).
+
+    Any path that leaves the region goes through one of those neighbours,
+    and its way there and back is in the region, so it weighs at least
+    `RoutingGraph.get_via_weight` for them, with weights per metre of at
+    least min_score**alpha for alpha >= 0 given the smallest edge score. A
+    path found in the region is optimal if it weighs no more. Otherwise, or
+    if there is no path, the region is widened, adding the waypoints of each
+    ring to those already loaded. If the paths are still not proven after
+    the last step, the rest of the graph is loaded with `fetch(None, inner)`,
+    which leaves no neighbours outside. Returns the topology of the last
+    region, a dict of (nodes, edges) (None if there is no path) by alpha,
+    the number of regions loaded and of waypoints fetched.
+    """
+
+    waypoints = {}
+    inner = None
+    num_fetched = 0
+
+    for num_loaded, expand in enumerate(tuple(steps) + (None,), 1):
+        ring = list(fetch(expand, inner))
+        num_fetched += len(ring)
+        inner = expand
+
+        # a neighbour fetched outside an earlier region is fetched again, as
+        # inside, once the region grows to include it
+        for wp in ring:
+            waypoints[wp.way_id, wp.idx] = wp
+
+        topology = Topology.from_waypoints(
+            waypoints[key] for key in sorted(waypoints))
+        outside = set(wp.node_id for wp in waypoints.values()
+                      if not wp.inside)
+
+        paths = {}
+        proven = True
+
+        for alpha in alphas:
+            rg = RoutingGraph.from_topology(topology, alpha)
+            try:
+                paths[alpha] = rg.get_optimal_path(u1, u2, method)
+                weight = sum(e['weight'] for e in paths[alpha][1])
+            except NoPathError:
+                paths[alpha] = None
+                weight = float('inf')
+
+            rate = (min_score**alpha
+                    if min_score is not None and min_score >= 0 and alpha >= 0
+                    else 0.)
+            via_weight = rg.get_via_weight(u1, u2, outside, weight, rate)
+            proven &= via_weight >= weight
+
+        if proven:
+            break
+
+    return topology, paths, num_loaded, num_fetched
+
+
+def get_route_frontier(topology, u1, u2, alpha_min, alpha_max, step=0.5,
+                       method='dijkstra', landmarks=None, max_searches=16,
+                       max_routes=8):
+    """
+    Find the distinct optimal paths between u1 and u2 as alpha ranges over
+    [alpha_min, alpha_max], i.e. the trade-off between distance and scenery.
+    All searches share the topology (and `landmarks`, for the alphas they
+    cover); each only computes new edge weights.
+
+    Paths are searched on the grid of alpha_min plus multiples of `step` (up
+    to alpha_max), the alphas of quantized queries. The grid is bisected,
+    widest interval first, until the paths at the ends of each interval
+    agree, or the ends are neighbours on the grid. A path optimal at both
+    ends of an interval is taken to be optimal throughout, and neighbours
+    with different paths are split at their midpoint. Bisection also stops
+    after `max_searches` searches, or once `max_routes` distinct paths are
+    found; the routes of intervals left unresolved cover only their ends,
+    and alphas in between must be searched on their own. Returns a list of
+    dicts with keys `alpha_min`, `alpha_max`, `nodes` and `edges`, ordered
+    by alpha.
+    """
+
+    found = set()
+
+    def solve(alpha):
+        rg = RoutingGraph.from_topology(topology, alpha, landmarks)
+        nodes, edges = rg.get_optimal_path(u1, u2, method)
+        key = tuple((e['way_id'], e['idx1'], e['idx2'], e['reversed'])
+                    for e in edges)
+        found.add(key)
+        return key, nodes, edges
+
+    # grid points are numbered from alpha_min, and the last is alpha_max
+    last = int(np.ceil((alpha_max - alpha_min)/step - 1e-9))
+
+    def grid(k):
+        return min(alpha_min + k*step, alpha_max)
+
+    path_lo = path_hi = solve(alpha_min)
+    num_searches = 1
+    if last > 0:
+        path_hi = solve(alpha_max)
+        num_searches += 1
+
+    # intervals to bisect, as (-width, order, lo, path_lo, hi, path_hi)
+    queue = [(-last, 0, 0, path_lo, last, path_hi)]
+    intervals = []
+
+    while queue:
+        _, order, lo, path_lo, hi, path_hi = heappop(queue)
+
+        if path_lo[0] == path_hi[0]:
+            intervals.append((grid(lo), grid(hi), path_lo))
+            continue
+
+        if hi - lo <= 1:
+            mid = (grid(lo) + grid(hi))/2
+            intervals.extend([(grid(lo), mid, path_lo),
+                              (mid, grid(hi), path_hi)])
+            continue
+
+        if num_searches >= max_searches or len(found) >= max_routes:
+            intervals.extend([(grid(lo), grid(lo), path_lo),
+                              (grid(hi), grid(hi), path_hi)])
+            continue
+
+        mid = (lo + hi)//2
+        path_mid = solve(grid(mid))
+        num_searches += 1
+        heappush(queue, (lo - mid, 2*num_searches, lo, path_lo, mid, path_mid))
+        heappush(queue, (mid - hi, 2*num_searches + 1,
+                         mid, path_mid, hi, path_hi))
+
+    intervals.sort(key=lambda interval: interval[:2])
+
+    # merge neighbouring intervals with the same path, leaving gaps where
+    # intervals are unresolved
+    frontier = []
+    for lo, hi, (key, nodes, edges) in intervals:
+        if (frontier and frontier[-1]['key'] == key and
+                frontier[-1]['alpha_max'] == lo):
+            frontier[-1]['alpha_max'] = hi
+        else:
+            frontier.append(dict(key=key, alpha_min=lo, alpha_max=hi,
+                                 nodes=nodes, edges=edges))
+
+    for route in frontier:
+        del route['key']
+
+    return frontier
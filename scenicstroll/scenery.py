@@ -0,0 +1,231 @@
+import numpy as np
+
+
+def sigmoid(x):
+    return 1/(1 + np.exp(x))
+
+
+def normalization(scores):
+    """
+    Shift and scale used by `normalize_scores` for these log densities.
+    """
+
+    scores = np.asarray(scores, dtype=np.float64)
+    shift = np.median(scores)
+    return float(shift), float(np.max(scores - shift))
+
+
+def normalize_scores(scores, shift=None, scale=None):
+    """
+    Map log densities to scenery scores in (0, 1): shift by the median, scale
+    by the maximum and apply a (decreasing) sigmoid, so that more scenic
+    places get lower scores and hence lower edge weights. A fixed `shift` and
+    `scale` may be given instead, e.g. computed over all nodes.
+    """
+
+    if shift is None or scale is None:
+        shift, scale = normalization(scores)
+
+    return sigmoid((np.asarray(scores, dtype=np.float64) - shift)/scale)
+
+
+class SceneryModel:
+    """
+    Wraps a density model (e.g. sklearn's KernelDensity) to give normalized
+    scenery scores. Note that normalization is relative to the samples passed
+    in each call; to normalize over all nodes, pass the density model itself
+    to `RouteDB.update_scores` with `normalize=normalize_scores`.
+    """
+
+    def __init__(self, model):
+        self.model = model
+
+    def score_samples(self, X):
+        return normalize_scores(self.model.score_samples(X))
+
+
+EARTH_RADIUS = 6371008.8
+
+
+class GridKDE:
+    """
+    Gaussian kernel density estimate of photo locations, computed on a
+    regular grid in metres: photos are binned onto the grid (with linear
+    binning) and convolved with the kernel by FFT, so the cost is nearly
+    independent of the number of photos. Densities at arbitrary points are
+    interpolated bilinearly.
+
+    Like sklearn's KernelDensity, `fit` and `score_samples` take arrays of
+    points, here (lon, lat) in degrees, and `score_samples` returns log
+    densities. `RouteDB.update_scores` normalizes the log densities of all
+    nodes with `normalize`, so the model can be passed to it directly. The
+    default bandwidth matches the 1e-4 radian bandwidth used in the
+    notebook.
+    """
+
+    def __init__(self, bandwidth=637., cell_size=None, truncate=4.):
+        self.bandwidth = bandwidth
+        self.cell_size = cell_size or bandwidth/8
+        self.truncate = truncate
+
+
+    def _project(self, lon, lat):
+        lon0, lat0 = self.origin_
+        x = EARTH_RADIUS*np.cos(np.radians(lat0))*np.radians(lon - lon0)
+        y = EARTH_RADIUS*np.radians(lat - lat0)
+        return x, y
+
+    def _grid_coords(self, X):
+        """
+        Fractional grid coordinates (column, row) of points.
+        """
+
+        X = np.asarray(X, dtype=np.float64)
+        x, y = self._project(X[:, 0], X[:, 1])
+        return (x - self.x0_)/self.cell_size, (y - self.y0_)/self.cell_size
+
+    def fit(self, X):
+
+        X = np.asarray(X, dtype=np.float64)
+        h = self.cell_size
+        radius = int(np.ceil(self.truncate*self.bandwidth/h))
+
+        self.origin_ = X[:, 0].mean(), X[:, 1].mean()
+        x, y = self._project(X[:, 0], X[:, 1])
+
+        # grid covering the photos plus the kernel support
+        self.x0_ = x.min() - radius*h
+        self.y0_ = y.min() - radius*h
+        nx = int(np.ceil((x.max() - self.x0_)/h)) + radius + 2
+        ny = int(np.ceil((y.max() - self.y0_)/h)) + radius + 2
+
+        # linear binning: split each photo between its 4 nearest grid points
+        gx, gy = self._grid_coords(X)
+        ix, iy = np.floor(gx).astype(int), np.floor(gy).astype(int)
+        fx, fy = gx - ix, gy - iy
+
+        counts = np.zeros(ny*nx)
+        for dx, dy, w in ((0, 0, (1 - fx)*(1 - fy)),
+                          (1, 0, fx*(1 - fy)),
+                          (0, 1, (1 - fx)*fy),
+                          (1, 1, fx*fy)):
+            counts += np.bincount((iy + dy)*nx + ix + dx, w, ny*nx)
+
+        counts = counts.reshape(ny, nx)
+
+        # Gaussian kernel sampled at the grid spacing
+        r = np.arange(-radius, radius + 1)*h
+        g = np.exp(-0.5*(r/self.bandwidth)**2)
+        kernel = np.outer(g, g)/(2*np.pi*self.bandwidth**2)
+
+        # linear (not circular) convolution by FFT
+        shape = (ny + 2*radius, nx + 2*radius)
+        conv = np.fft.irfft2(np.fft.rfft2(counts, shape) *
+                             np.fft.rfft2(kernel, shape), shape)
+
+        density = conv[radius:radius + ny, radius:radius + nx]/len(X)
+        self.density_ = np.maximum(density, 0)   # remove FFT round-off
+
+        return self
+
+    def density(self, X):
+        """
+        Density (per square metre) at each point, interpolated bilinearly.
+        Points off the grid have zero density.
+        """
+
+        gx, gy = self._grid_coords(X)
+        ny, nx = self.density_.shape
+
+        ix = np.clip(np.floor(gx).astype(int), 0, nx - 2)
+        iy = np.clip(np.floor(gy).astype(int), 0, ny - 2)
+        fx, fy = gx - ix, gy - iy
+
+        d = self.density_
+        density = ((1 - fx)*(1 - fy)*d[iy, ix] +
+                   fx*(1 - fy)*d[iy, ix + 1] +
+                   (1 - fx)*fy*d[iy + 1, ix] +
+                   fx*fy*d[iy + 1, ix + 1])
+
+        outside = (gx < 0) | (gx > nx - 1) | (gy < 0) | (gy > ny - 1)
+        density[outside] = 0.
+
+        return density
+
+    def score_samples(self, X):
+        """
+        Log density at each point.
+        """
+
+        tiny = np.finfo(np.float64).tiny
+        return np.log(np.maximum(self.density(X), tiny))
+
+    def normalize(self, scores):
+        """
+        Scenery scores from the log densities of all nodes, see
+        `normalize_scores`.
+        """
+
+        return normalize_scores(scores)
+
+
+class SceneryRaster:
+    """
+    Normalized scenery scores as a georeferenced grid: the densities of a
+    fitted GridKDE together with the shift and scale that normalize them over
+    all nodes. Scoring any point is a bilinear interpolation, so scores for
+    the routing graph can be derived when it is loaded instead of being
+    written to the database.
+
+    `to_arrays` and `from_arrays` convert to and from a dict of arrays plus
+    JSON-serializable metadata, e.g. for `arrayfile.save_arrays`. The density
+    grid is used as given, so it may be a read-only memory map.
+    """
+
+    def __init__(self, model, shift, scale, version=None):
+        self.model = model
+        self.shift = shift
+        self.scale = scale
+        self.version = version
+
+
+    @classmethod
+    def fit(cls, model, X, version=None):
+        """
+        Normalize a fitted GridKDE over the points X, given as (lon, lat).
+        """
+
+        shift, scale = normalization(model.score_samples(X))
+        return cls(model, shift, scale, version)
+
+    @classmethod
+    def from_arrays(cls, arrays, meta):
+        model = GridKDE(meta['bandwidth'], meta['cell_size'])
+        model.origin_ = tuple(meta['origin'])
+        model.x0_ = meta['x0']
+        model.y0_ = meta['y0']
+        model.density_ = arrays['density']
+
+        return cls(model, meta['shift'], meta['scale'], meta.get('version'))
+
+
+    def to_arrays(self):
+        m = self.model
+        meta = dict(bandwidth=m.bandwidth,
+                    cell_size=m.cell_size,
+                    origin=list(m.origin_),
+                    x0=m.x0_,
+                    y0=m.y0_,
+                    shift=self.shift,
+                    scale=self.scale,
+                    version=self.version)
+
+        return dict(density=m.density_), meta
+
+    def score_samples(self, X):
+        """
+        Normalized scenery score at each point, given as (lon, lat).
+        """
+
+        return normalize_scores(
+            self.model.score_samples(X), self.shift, self.scale)
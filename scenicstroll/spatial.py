@@ -0,0 +1,406 @@
+import numpy as np
+
+
+# WGS84 ellipsoid
+SEMI_MAJOR_AXIS = 6378137.
+ECCENTRICITY_SQ = 6.69437999014e-3
+
+
+def _radii_of_curvature(lat):
+    """
+    Meridional and prime vertical radii of curvature (in metres) of the WGS84
+    ellipsoid at latitude `lat` (in degrees).
+    """
+
+    w = 1 - ECCENTRICITY_SQ*np.sin(np.radians(lat))**2
+    meridional = SEMI_MAJOR_AXIS*(1 - ECCENTRICITY_SQ)/w**1.5
+    prime_vertical = SEMI_MAJOR_AXIS/np.sqrt(w)
+    return meridional, prime_vertical
+
+
+def distance(lat1, lon1, lat2, lon2):
+    """
+    Distance in metres between nearby points on the WGS84 ellipsoid, using
+    the radii of curvature at their mean latitude. At the scale of a walk
+    this agrees with PostGIS geography distances to within millimetres.
+    """
+
+    lat = (np.asarray(lat1) + lat2)/2
+    m, n = _radii_of_curvature(lat)
+    dy = m*np.radians(np.subtract(lat2, lat1))
+    dx = n*np.cos(np.radians(lat))*np.radians(np.subtract(lon2, lon1))
+    return np.hypot(dx, dy)
+
+
+class GridIndex:
+    """
+    Uniform grid over points projected to metres about their mean location.
+    Grid queries return candidates, which are then checked with the exact
+    `distance`.
+    """
+
+    # slack allowing for distortion of the projection across a metro area
+    _margin = 1.01
+
+    def __init__(self, lat, lon, cell_size):
+
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lon = np.asarray(lon, dtype=np.float64)
+        self.cell_size = float(cell_size)
+
+        if len(self.lat):
+            self._origin = (self.lat.mean(), self.lon.mean())
+        else:
+            self._origin = (0., 0.)
+
+        m, n = _radii_of_curvature(self._origin[0])
+        self._scale = (np.radians(m),
+                       np.radians(n*np.cos(np.radians(self._origin[0]))))
+
+        keys = self._cell_keys(*self._cells(self.lat, self.lon))
+        self._order = np.argsort(keys, kind='mergesort')
+        self._keys = keys[self._order]
+
+
+    def project(self, lat, lon):
+        """
+        Project points to (x, y) in metres.
+        """
+
+        lat0, lon0 = self._origin
+        y = (np.asarray(lat) - lat0)*self._scale[0]
+        x = (np.asarray(lon) - lon0)*self._scale[1]
+        return x, y
+
+    def _cells(self, lat, lon):
+        x, y = self.project(lat, lon)
+        return (np.floor(x/self.cell_size).astype(np.int64),
+                np.floor(y/self.cell_size).astype(np.int64))
+
+    @staticmethod
+    def _cell_keys(cx, cy):
+        return (cx << 32) + cy
+
+    def _candidate_ranges(self, lat, lon, radius):
+        """
+        For each grid cell within `radius` of each query point, the query
+        point and the range of sorted positions of the points in the cell.
+        """
+
+        lat = np.atleast_1d(lat)
+        lon = np.atleast_1d(lon)
+        cx, cy = self._cells(lat, lon)
+        k = int(np.ceil(radius*self._margin/self.cell_size))
+        offsets = np.arange(-k, k + 1)
+
+        # all cells in a (2k+1) x (2k+1) block around each query point
+        query, cx, cy = np.broadcast_arrays(
+            np.arange(len(lat))[:, None, None],
+            cx[:, None, None] + offsets[:, None],
+            cy[:, None, None] + offsets)
+        cells = self._cell_keys(cx.ravel(), cy.ravel())
+
+        lo = np.searchsorted(self._keys, cells, side='left')
+        hi = np.searchsorted(self._keys, cells, side='right')
+
+        return query.ravel(), lo, hi
+
+    def candidate_pairs(self, lat, lon, radius):
+        """
+        Pairs (i, j) of query point i and indexed point j such that j lies in
+        a grid cell within `radius` of i. A superset of the pairs within
+        `radius` of each other.
+        """
+
+        query, lo, hi = self._candidate_ranges(lat, lon, radius)
+        counts = hi - lo
+
+        # concatenate the ranges lo[i]..hi[i]
+        starts = np.repeat(lo - np.cumsum(counts) + counts, counts)
+        positions = starts + np.arange(counts.sum())
+
+        return np.repeat(query, counts), self._order[positions]
+
+    def iter_pairs(self, lat, lon, radius, max_pairs=2**22):
+        """
+        Pairs (i, j, distance) of query point i and indexed point j within
+        `radius` metres, in batches of query points with at most about
+        `max_pairs` candidate pairs each, to bound memory use when points
+        are dense.
+        """
+
+        lat = np.atleast_1d(lat)
+        lon = np.atleast_1d(lon)
+
+        query, lo, hi = self._candidate_ranges(lat, lon, radius)
+        counts = np.bincount(query, hi - lo, len(lat))
+        batch = (np.cumsum(counts) - counts)//max_pairs
+        bounds = np.flatnonzero(np.diff(batch)) + 1
+
+        for q in np.split(np.arange(len(lat)), bounds):
+            if not len(q):
+                continue
+            i, j = self.candidate_pairs(lat[q], lon[q], radius)
+            d = distance(lat[q][i], lon[q][i], self.lat[j], self.lon[j])
+            keep = d <= radius
+            yield q[i[keep]], j[keep], d[keep]
+
+    def _pair_distances(self, lat, lon, radius):
+        lat = np.atleast_1d(lat)
+        lon = np.atleast_1d(lon)
+        i, j = self.candidate_pairs(lat, lon, radius)
+        d = distance(lat[i], lon[i], self.lat[j], self.lon[j])
+        keep = d <= radius
+        return i[keep], j[keep], d[keep]
+
+    def within(self, lat, lon, radius):
+        """
+        Indices of points within `radius` metres of any of the query points,
+        e.g. the points along a path.
+        """
+
+        _, j, _ = self._pair_distances(lat, lon, radius)
+        return np.unique(j)
+
+    def nearest(self, lat, lon, radius):
+        """
+        Index of the nearest point within `radius` metres of each query
+        point, or -1 where there is none.
+        """
+
+        i, j, d = self._pair_distances(lat, lon, radius)
+        nearest = np.full(len(np.atleast_1d(lat)), -1, dtype=np.int64)
+
+        # sort by query point, then distance, and take the first of each
+        order = np.lexsort((d, i))
+        i, j = i[order], j[order]
+        first = np.ones(len(i), dtype=bool)
+        first[1:] = i[1:] != i[:-1]
+        nearest[i[first]] = j[first]
+
+        return nearest
+
+
+def _any_within(lat, lon, x, y, i, j, eps, max_pairs):
+    """
+    Whether any of the points i is within `eps` metres of any of the points
+    j. Points of i nearest the bounding box of j are tried first.
+    """
+
+    margin = eps*GridIndex._margin
+    gap = np.hypot(np.maximum(0, np.maximum(x[j].min() - x[i], x[i] - x[j].max())),
+                   np.maximum(0, np.maximum(y[j].min() - y[i], y[i] - y[j].max())))
+    i = i[np.argsort(gap)][:np.count_nonzero(gap <= margin)]
+
+    for chunk in np.array_split(i, -(-len(i)*len(j)//max_pairs) or 1):
+        d = distance(lat[chunk, None], lon[chunk, None], lat[j], lon[j])
+        if (d <= eps).any():
+            return True
+
+    return False
+
+
+def dbscan(lat, lon, eps, min_samples, labels=None, counted=None,
+           next_label=None, max_pairs=2**22):
+    """
+    Density-based clustering (DBSCAN) with neighbourhoods of radius `eps`
+    metres, where `min_samples` includes the point itself, as in sklearn.
+
+    Points are binned on a grid with cells of diagonal `eps`, so that points
+    sharing a cell are neighbours: cells with at least `min_samples` points
+    hold only core points, and only points in sparser cells need their
+    neighbours counted. Clusters are then found by joining cells holding core
+    points, testing each pair of nearby cells at most once.
+
+    For incremental updates after adding points, pass the existing `labels`
+    (-1 for noise and new points) and mark as `counted` the points whose
+    neighbourhoods are entirely among the points passed, e.g. all points
+    within 2*eps of a new point when all points within 3*eps are passed. Core
+    points are only determined among counted points, and core points with
+    the same existing label are taken to be connected. Clusters keep the
+    smallest existing label they contain; new clusters are numbered from
+    `next_label`, by default one more than the largest existing label.
+
+    Returns the labels (-1 for noise) and a dict mapping the existing labels
+    of merged clusters to their new labels.
+    """
+
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    n = len(lat)
+
+    old = (np.full(n, -1, dtype=np.int64) if labels is None
+           else np.asarray(labels, dtype=np.int64))
+    counted = (np.ones(n, dtype=bool) if counted is None
+               else np.asarray(counted, dtype=bool))
+    if next_label is None:
+        next_label = int(old.max()) + 1 if n else 0
+
+    grid = GridIndex(lat, lon, eps/np.sqrt(2)/GridIndex._margin)
+    x, y = grid.project(lat, lon)
+    cx, cy = grid._cells(lat, lon)
+    keys, first, cell, cell_size = np.unique(
+        grid._cell_keys(cx, cy), return_index=True, return_inverse=True,
+        return_counts=True)
+
+    # core points: counted points in dense cells or with enough neighbours
+    core = counted & (cell_size[cell] >= min_samples)
+    sparse = np.flatnonzero(counted & ~core)
+    num_neighbours = np.zeros(len(sparse), dtype=np.int64)
+
+    for i, _, _ in grid.iter_pairs(lat[sparse], lon[sparse], eps, max_pairs):
+        num_neighbours += np.bincount(i, minlength=len(sparse))
+
+    core[sparse] = num_neighbours >= min_samples
+
+    # union-find over cells and existing labels
+    existing = np.unique(old[old >= 0])
+    parent = list(range(len(keys) + len(existing)))
+
+    def find(a):
+        while parent[a] != a:
+            parent[a] = parent[parent[a]]
+            a = parent[a]
+        return a
+
+    def union(a, b):
+        a, b = find(a), find(b)
+        if a != b:
+            parent[max(a, b)] = min(a, b)
+
+    core_points = np.flatnonzero(core)
+    has_label = core_points[old[core_points] >= 0]
+    for a, b in set(zip(cell[has_label].tolist(),
+                        (len(keys) + np.searchsorted(
+                            existing, old[has_label])).tolist())):
+        union(a, b)
+
+    # core points of each cell, as ranges of core_points sorted by cell
+    core_points = core_points[np.argsort(cell[core_points], kind='mergesort')]
+    core_cells, start = np.unique(cell[core_points], return_index=True)
+    end = np.append(start[1:], len(core_points))
+
+    # pairs of core cells close enough to hold neighbours, each pair once
+    k = int(np.ceil(eps*GridIndex._margin/grid.cell_size))
+    ccx, ccy = cx[first[core_cells]], cy[first[core_cells]]
+    core_keys = keys[core_cells]
+
+    for dx in range(0, k + 1):
+        for dy in range(-k, k + 1):
+            if dx == 0 and dy <= 0:
+                continue
+
+            nbr = np.searchsorted(core_keys, grid._cell_keys(ccx + dx, ccy + dy))
+            nbr = np.minimum(nbr, len(core_keys) - 1)
+            found = np.flatnonzero(
+                core_keys[nbr] == grid._cell_keys(ccx + dx, ccy + dy))
+
+            for a, b in zip(found.tolist(), nbr[found].tolist()):
+                if find(core_cells[a]) == find(core_cells[b]):
+                    continue
+                if _any_within(lat, lon, x, y,
+                               core_points[start[a]:end[a]],
+                               core_points[start[b]:end[b]],
+                               eps, max_pairs):
+                    union(core_cells[a], core_cells[b])
+
+    # label clusters by their smallest existing label, or a new one
+    cluster_label = {}
+    for node, label in enumerate(existing.tolist(), len(keys)):
+        cluster_label.setdefault(find(node), label)
+
+    cell_label = np.full(len(keys), -1, dtype=np.int64)
+    for c in core_cells.tolist():
+        root = find(c)
+        if root not in cluster_label:
+            cluster_label[root] = next_label
+            next_label += 1
+        cell_label[c] = cluster_label[root]
+
+    merged = {}
+    for node, label in enumerate(existing.tolist(), len(keys)):
+        if cluster_label[find(node)] != label:
+            merged[label] = cluster_label[find(node)]
+
+    result = np.array([merged.get(l, l) for l in old.tolist()],
+                      dtype=np.int64)
+    result[core] = cell_label[cell[core]]
+
+    # unlabelled border points join the cluster of the nearest core point
+    border = np.flatnonzero(counted & ~core & (result < 0))
+    core_points = np.flatnonzero(core)
+    core_grid = GridIndex(lat[core_points], lon[core_points], eps)
+
+    for i, j, d in core_grid.iter_pairs(lat[border], lon[border], eps,
+                                        max_pairs):
+        order = np.lexsort((d, i))
+        i, j = i[order], j[order]
+        nearest = np.ones(len(i), dtype=bool)
+        nearest[1:] = i[1:] != i[:-1]
+        result[border[i[nearest]]] = result[core_points[j[nearest]]]
+
+    return result, merged
+
+
+class ClusterIndex:
+    """
+    In-memory spatial index of photo clusters.
+    """
+
+    def __init__(self, clusters, cell_size):
+
+        rows = [(c.label, c.lat, c.lon, c.num_photos, c.repr_url)
+                for c in clusters]
+
+        if rows:
+            labels, lat, lon, sizes, urls = zip(*rows)
+        else:
+            labels = lat = lon = sizes = urls = ()
+
+        self.labels = np.array(labels, dtype=np.int64)
+        self.sizes = list(sizes)
+        self.urls = list(urls)
+        self._grid = GridIndex(lat, lon, cell_size)
+
+
+    def get_nearby(self, lat, lon, radius):
+        """
+        Clusters with centroid within `radius` metres of any of the given
+        points, as dicts with keys `location`, `size` and `repr_url`.
+        """
+
+        g = self._grid
+
+        return [{'location': (g.lat[i], g.lon[i]),
+                 'size': self.sizes[i],
+                 'repr_url': self.urls[i]}
+                for i in g.within(lat, lon, radius).tolist()]
+
+
+class NodeIndex:
+    """
+    In-memory spatial index of road network nodes for snapping locations.
+    """
+
+    def __init__(self, nodes, cell_size):
+
+        rows = [(node.id, node.lat, node.lon) for node in nodes]
+
+        if rows:
+            ids, lat, lon = zip(*rows)
+        else:
+            ids = lat = lon = ()
+
+        self.ids = np.array(ids, dtype=np.int64)
+        self._grid = GridIndex(lat, lon, cell_size)
+
+
+    def nearest(self, lat, lon, radius):
+        """
+        Id of the nearest node within `radius` metres of each of the given
+        points, or None where there is none.
+        """
+
+        nearest = self._grid.nearest(lat, lon, radius)
+        return [int(self.ids[k]) if k >= 0 else None
+                for k in nearest.tolist()]
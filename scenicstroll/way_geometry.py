@@ -0,0 +1,120 @@
+import numpy as np
+
+
+class WayGeometry:
+    """
+    Detailed geometry of ways: the node ids and coordinates of every waypoint,
+    stored in contiguous arrays ordered by (way_id, idx). The waypoints of the
+    way at position i of `way_ids` are offsets[i] to offsets[i+1].
+    """
+
+    # constructor arguments, see `to_arrays`
+    _array_names = ('way_ids', 'offsets', 'idx', 'node_ids', 'lat', 'lon')
+
+    def __init__(self, way_ids, offsets, idx, node_ids, lat, lon):
+        self.way_ids = way_ids
+        self.offsets = offsets
+        self.idx = idx
+        self.node_ids = node_ids
+        self.lat = lat
+        self.lon = lon
+        self._way_index = {w: i for i, w in enumerate(way_ids.tolist())}
+
+
+    @classmethod
+    def from_waypoints(cls, waypoints):
+        """
+        Build from an iterable of waypoints ordered by (way_id, idx), having
+        `way_id`, `idx`, `node_id`, `lat` and `lon` attributes.
+        """
+
+        rows = [(wp.way_id, wp.idx, wp.node_id, wp.lat, wp.lon)
+                for wp in waypoints]
+
+        if rows:
+            way_id, idx, node_id, lat, lon = zip(*rows)
+        else:
+            way_id = idx = node_id = lat = lon = ()
+
+        way_id = np.array(way_id, dtype=np.int64)
+        way_ids, offsets = np.unique(way_id, return_index=True)
+
+        return cls(
+            way_ids,
+            np.append(offsets, len(way_id)),
+            np.array(idx, dtype=np.int32),
+            np.array(node_id, dtype=np.int64),
+            np.array(lat, dtype=np.float64),
+            np.array(lon, dtype=np.float64))
+
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """
+        Rebuild from the arrays given by `to_arrays`, e.g. read-only memory
+        maps.
+        """
+
+        return cls(**{name: arrays[name] for name in cls._array_names})
+
+
+    def to_arrays(self):
+        return {name: getattr(self, name) for name in self._array_names}
+
+    def get_segment(self, way_id, idx1, idx2, reversed=False):
+        """
+        Slice of the way between waypoint indices idx1 and idx2 (inclusive).
+        Returns arrays of node ids, latitudes and longitudes.
+        """
+
+        i = self._way_index[way_id]
+        start, end = self.offsets[i], self.offsets[i + 1]
+        idx = self.idx[start:end]
+
+        # waypoint indices need not be contiguous, so search for the bounds
+        lo = start + np.searchsorted(idx, idx1, side='left')
+        hi = start + np.searchsorted(idx, idx2, side='right')
+        step = -1 if reversed else 1
+        s = slice(lo, hi)
+
+        return (self.node_ids[s][::step],
+                self.lat[s][::step],
+                self.lon[s][::step])
+
+    def segment_sums(self, values, way_id, idx1, idx2):
+        """
+        Sums of per-waypoint `values` over the waypoints after idx1 up to and
+        including idx2 of each way, for arrays of edges. This is the
+        difference of cumulative sums along the way, as with
+        `Waypoint.cscore`.
+        """
+
+        # cumulative sums restarting at each way
+        csum = np.cumsum(values, dtype=np.float64)
+        start = np.repeat(self.offsets[:-1], np.diff(self.offsets))
+        csum -= np.concatenate(([0.], csum))[start]
+
+        # waypoints are sorted by (way, idx), so locate edge ends by bisection
+        way = np.repeat(np.arange(len(self.way_ids), dtype=np.int64),
+                        np.diff(self.offsets))
+        keys = (way << 32) + self.idx
+        way = np.searchsorted(self.way_ids, way_id)
+        i1 = np.searchsorted(keys, (way << 32) + idx1)
+        i2 = np.searchsorted(keys, (way << 32) + idx2)
+
+        return csum[i2] - csum[i1]
+
+    def get_path(self, edges):
+        """
+        Detailed path along a sequence of routing graph edges, as a list of
+        (node_id, lat, lon) tuples.
+        """
+
+        path = []
+
+        for edge in edges:
+            node_ids, lat, lon = self.get_segment(
+                edge['way_id'], edge['idx1'], edge['idx2'], edge['reversed'])
+            path.extend(zip(node_ids.tolist(), lat.tolist(), lon.tolist()))
+
+        return path
@@ -0,0 +1,14 @@
+import os
+import sys
+
+
+# the scripts at the top level import the app's modules as scenicstroll.X,
+# and the app's modules import each other by bare name
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'scenicstroll')]
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        'markers', 'postgis: needs a scratch PostGIS database given by '
+        'SCENICSTROLL_TEST_DATABASE')
@@ -0,0 +1,179 @@
+import numpy as np
+import os
+import pytest
+from benchmarks.query import (CORRIDOR_EXPAND, CORRIDOR_MARGIN, MemoryCorridor,
+                              min_edge_score)
+from benchmarks.synthetic_city import (load_city, synthetic_city,
+                                       xnode_waypoints)
+from scenicstroll.route_graph import (NoPathError, RoutingGraph, Topology,
+                                      corridor_search, haversine)
+
+
+@pytest.fixture(scope='module')
+def city():
+    return synthetic_city(20, 20, 100., num_photos=3000, seed=2)
+
+
+@pytest.fixture(scope='module')
+def rows(city):
+    return list(xnode_waypoints(city))
+
+
+class MemoryRegions:
+    """
+    Regions around pairs of nodes from the in-memory selection.
+    """
+
+    def __init__(self, rows):
+        self.corridor = MemoryCorridor(rows)
+        self.min_score = min_edge_score(rows)
+
+    def get_relevant_waypoints(self, u1, u2, expand, inner=None):
+        return self.corridor.get_relevant_waypoints(u1, u2, expand,
+                                                    CORRIDOR_MARGIN, inner)
+
+
+class DatabaseRegions:
+    """
+    Regions around pairs of nodes from `RouteDB.get_relevant_waypoints`.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.min_score = db.get_min_score()
+
+    def get_relevant_waypoints(self, u1, u2, expand, inner=None):
+        from scenicstroll.route_db import Node
+        node1, node2 = (self.db.session.query(Node).get(u) for u in (u1, u2))
+        return self.db.get_relevant_waypoints(node1, node2, expand,
+                                              CORRIDOR_MARGIN, inner).all()
+
+
+@pytest.fixture(scope='module')
+def database(city):
+    url = os.environ.get('SCENICSTROLL_TEST_DATABASE')
+    if not url:
+        pytest.skip('SCENICSTROLL_TEST_DATABASE is not set')
+
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from scenicstroll import photo_db, route_db
+
+    engine = create_engine(url)
+    route_db.create_tables(engine)
+    photo_db.create_tables(engine)
+    session = sessionmaker(bind=engine)()
+
+    if session.query(route_db.Node).first() is not None:
+        pytest.skip('{} is not empty'.format(url))
+
+    # the city is loaded in a transaction that is rolled back afterwards
+    load_city(city, session)
+    try:
+        yield route_db.RouteDB(session)
+    finally:
+        session.rollback()
+        session.close()
+
+
+@pytest.fixture(scope='module', params=[
+    'memory', pytest.param('postgis', marks=pytest.mark.postgis)])
+def regions(request, rows):
+    if request.param == 'memory':
+        return MemoryRegions(rows)
+    return DatabaseRegions(request.getfixturevalue('database'))
+
+
+def path_weight(path):
+    return path and sum(e['weight'] for e in path[1])
+
+
+@pytest.mark.parametrize('alpha', [0, 2, 5, 10])
+def test_corridor_paths_optimal(rows, regions, alpha):
+    full = RoutingGraph.from_topology(Topology.from_waypoints(rows), alpha)
+    rng = np.random.RandomState(alpha)
+    steps = CORRIDOR_EXPAND + (None,)
+
+    for u1, u2 in rng.choice(full.topology.node_ids, (20, 2)).tolist():
+        calls = []
+
+        def fetch(expand, inner):
+            calls.append((expand, inner))
+            return regions.get_relevant_waypoints(u1, u2, expand, inner)
+
+        topology, paths, num_loaded, num_fetched = corridor_search(
+            fetch, u1, u2, [alpha], CORRIDOR_EXPAND, regions.min_score)
+
+        try:
+            expected = path_weight(full.get_optimal_path(u1, u2))
+        except NoPathError:
+            expected = None
+
+        if expected is None:
+            assert paths[alpha] is None
+        else:
+            assert path_weight(paths[alpha]) == pytest.approx(expected)
+
+        # each fetch is of the ring outside the region before, and the rest
+        # of the graph if the widest region doesn't prove the path
+        assert calls == list(zip(steps, (None,) + steps))[:num_loaded]
+        assert num_fetched < 2*len(rows)
+
+
+def test_corridor_search_falls_back_to_whole_graph(rows):
+    corridor = MemoryCorridor(rows)
+    full = RoutingGraph.from_topology(Topology.from_waypoints(rows), 5)
+    rng = np.random.RandomState(5)
+    fallbacks = 0
+
+    # a region too narrow to prove most scenic paths
+    for u1, u2 in rng.choice(full.topology.node_ids, (20, 2)).tolist():
+        fetch = lambda expand, inner: corridor.get_relevant_waypoints(
+            u1, u2, expand, CORRIDOR_MARGIN, inner)
+        topology, paths, num_loaded, _ = corridor_search(
+            fetch, u1, u2, [5], (1.,), min_edge_score(rows))
+
+        if num_loaded == 2:
+            fallbacks += 1
+            assert topology.num_nodes == full.topology.num_nodes
+        assert (path_weight(paths[5]) ==
+                pytest.approx(path_weight(full.get_optimal_path(u1, u2))))
+
+    assert fallbacks > 0
+
+
+def test_corridor_ring_fetches(rows, regions):
+
+    # endpoints about 800 m apart in a city 2 km across
+    wp1 = rows[len(rows)//2]
+    u1, u2 = wp1.node_id, min(
+        rows, key=lambda wp: abs(haversine(wp1.lat, wp1.lon, wp.lat, wp.lon)
+                                 - 800)).node_id
+
+    whole = regions.get_relevant_waypoints(u1, u2, 1.5)
+    inner = regions.get_relevant_waypoints(u1, u2, 1.2)
+    ring = regions.get_relevant_waypoints(u1, u2, 1.5, 1.2)
+    rest = regions.get_relevant_waypoints(u1, u2, None, 1.5)
+
+    # the rings add up to the whole region, with its neighbours outside
+    key = lambda wp: (wp.way_id, wp.idx)
+    merged = {key(wp): wp for wp in inner}
+    merged.update((key(wp), wp) for wp in ring)
+    assert merged == {key(wp): wp for wp in whole}
+    assert any(not wp.inside for wp in whole)
+    assert 0 < len(ring) < len(whole)
+
+    # in (way_id, idx) order, and each neighbour outside is next to a
+    # waypoint inside on its way
+    for fetched in (whole, inner, ring):
+        assert [key(wp) for wp in fetched] == sorted(map(key, fetched))
+        for i, wp in enumerate(fetched):
+            if not wp.inside:
+                assert any(0 <= j < len(fetched) and
+                           fetched[j].way_id == wp.way_id and fetched[j].inside
+                           for j in (i - 1, i + 1))
+
+    # and the rest of the graph is everything outside, all inside
+    merged.update((key(wp), wp) for wp in rest)
+    assert set(merged) == set(map(key, rows))
+    assert all(wp.inside for wp in rest)
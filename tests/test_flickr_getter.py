@@ -0,0 +1,208 @@
+import csv
+import flickr_getter
+import json
+import pytest
+import threading
+from datetime import datetime, timedelta
+from flickr_getter import FlickrClient, FlickrError, Harvester, iter_days
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+DATE_FORMAT = flickr_getter.DATE_FORMAT
+
+
+def photo(photo_id, taken):
+    return {
+        'id': str(photo_id), 'owner': 'owner{}'.format(photo_id),
+        'secret': 'abc', 'title': 'Photo {}'.format(photo_id),
+        'description': {'_content': 'Taken at {}'.format(taken)},
+        'license': '4', 'dateupload': '1431000000',
+        'datetaken': taken.strftime(DATE_FORMAT), 'ownername': 'someone',
+        'views': str(10*photo_id), 'tags': 'a b', 'machine_tags': '',
+        'latitude': 36.97, 'longitude': -122.03, 'accuracy': '16',
+        'context': 0, 'place_id': 'x', 'woeid': '1', 'media': 'photo',
+        'media_status': 'ready', 'url_o': 'o.jpg', 'url_n': 'n.jpg',
+        'o_width': '800', 'o_height': '600',
+    }
+
+
+class StubFlickr(BaseHTTPRequestHandler):
+    """
+    `flickr.photos.search` over the server's photos, with taken dates
+    filtered inclusively at both ends as Flickr does, and at most RESULT_CAP
+    results per search. Windows whose min_taken_date is in the server's
+    `fail` set get an error.
+    """
+
+    def do_GET(self):
+        params = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+        server = self.server
+
+        with server.lock:
+            server.requests.append(params)
+
+        if (params.get('method') != 'flickr.photos.search' or
+                params['min_taken_date'] in server.fail):
+            result = dict(stat='fail', code=1, message='stub failure')
+        else:
+            lo = datetime.strptime(params['min_taken_date'], DATE_FORMAT)
+            hi = datetime.strptime(params['max_taken_date'], DATE_FORMAT)
+            matches = [p for p in server.photos
+                       if lo <= datetime.strptime(p['datetaken'],
+                                                  DATE_FORMAT) <= hi]
+            per_page = int(params['per_page'])
+            page = int(params['page'])
+            available = matches[:flickr_getter.RESULT_CAP]
+            result = dict(stat='ok', photos=dict(
+                page=page,
+                pages=max(1, -(-len(available)//per_page)),
+                perpage=per_page,
+                total=str(len(matches)),
+                photo=available[(page - 1)*per_page:page*per_page]))
+
+        body = json.dumps(result).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubFlickr)
+    server.lock = threading.Lock()
+    server.requests = []
+    server.fail = set()
+
+    day = datetime(2015, 5, 1)
+    server.photos = (
+        # a few photos a day, one of them exactly at midnight, so that it
+        # is in two days' windows
+        [photo(k, day + timedelta(hours=7*k)) for k in range(8)] +
+        # a dense day needing several splits
+        [photo(100 + k, day + timedelta(days=3, minutes=37*k))
+         for k in range(20)])
+    server.photos.append(photo(200, day + timedelta(days=2)))
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.shutdown()
+    thread.join()
+    server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def small_cap(monkeypatch):
+    monkeypatch.setattr(flickr_getter, 'RESULT_CAP', 6)
+
+
+class NullLog:
+    def write(self, mesg):
+        pass
+
+
+def harvester(stub, tmp_path, **kwargs):
+    client = FlickrClient('key', 'http://127.0.0.1:{}/'.format(
+        stub.server_address[1]))
+    args = dict(flickr_getter.search_args, per_page=4)
+    kwargs = dict(dict(workers=3, rate=1000., log=NullLog()), **kwargs)
+    return Harvester(client, args, str(tmp_path/'photos.csv'),
+                     str(tmp_path/'photos.csv.checkpoint'), **kwargs)
+
+
+def read_rows(tmp_path):
+    with open(str(tmp_path/'photos.csv'), newline='') as f:
+        return list(csv.DictReader(f))
+
+
+def windows():
+    return list(iter_days(datetime(2015, 5, 1), datetime(2015, 5, 5)))
+
+
+def test_harvest(stub, tmp_path):
+    n = harvester(stub, tmp_path).run(windows())
+    rows = read_rows(tmp_path)
+
+    # every photo once, although the midnight photos are in two windows
+    ids = sorted(int(row['id']) for row in rows)
+    assert ids == sorted(int(p['id']) for p in stub.photos)
+    assert n == len(rows)
+
+    by_id = {row['id']: row for row in rows}
+    assert by_id['3']['title'] == 'Photo 3'
+    assert by_id['3']['description'] == 'Taken at 2015-05-01 21:00:00'
+    assert (by_id['3']['width'], by_id['3']['height']) == ('800', '600')
+
+    # the dense day was split into windows under the cap, and each window
+    # is checkpointed once it is written
+    searched = [(r['min_taken_date'], r['max_taken_date'])
+                for r in stub.requests]
+    assert ('2015-05-04 00:00:00', '2015-05-05 00:00:00') in searched
+    assert ('2015-05-04 00:00:00', '2015-05-04 12:00:00') in searched
+
+    with open(str(tmp_path/'photos.csv.checkpoint')) as f:
+        entries = [tuple(json.loads(line)) for line in f]
+    checkpointed = [e for e in entries if len(e) == 2]
+    splits = [e for e in entries if len(e) == 3]
+    assert ('2015-05-04 00:00:00', '2015-05-05 00:00:00') not in checkpointed
+    assert ('2015-05-01 00:00:00', '2015-05-02 00:00:00') in checkpointed
+    assert (('2015-05-04 00:00:00', '2015-05-04 12:00:00',
+             '2015-05-05 00:00:00') in splits)
+
+    for lo, hi in checkpointed:
+        taken = [p for p in stub.photos
+                 if lo <= p['datetaken'] <= hi]
+        assert len(taken) <= flickr_getter.RESULT_CAP
+
+    # pages of windows are fetched until the end
+    assert any(r['page'] == '2' for r in stub.requests)
+
+
+def test_resume(stub, tmp_path):
+    stub.fail.add('2015-05-03 00:00:00')
+
+    # one window at a time, so that the days before the failure complete
+    with pytest.raises(FlickrError):
+        harvester(stub, tmp_path, workers=1, max_retries=0).run(windows())
+
+    first = {row['id'] for row in read_rows(tmp_path)}
+    assert first and len(first) < len(stub.photos)
+
+    with open(str(tmp_path/'photos.csv.checkpoint')) as f:
+        completed = [tuple(json.loads(line)) for line in f]
+
+    # resuming only searches the windows not completed, and writes each
+    # photo once
+    stub.fail.clear()
+    del stub.requests[:]
+    harvester(stub, tmp_path).run(windows())
+
+    searched = {(r['min_taken_date'], r['max_taken_date'])
+                for r in stub.requests}
+    assert not searched & set(completed)
+    assert ('2015-05-03 00:00:00', '2015-05-04 00:00:00') in searched
+
+    ids = [row['id'] for row in read_rows(tmp_path)]
+    assert sorted(ids) == sorted(p['id'] for p in stub.photos)
+
+    # a third run has nothing left to do, not even searching the windows
+    # that were split
+    del stub.requests[:]
+    assert harvester(stub, tmp_path).run(windows()) == 0
+    assert stub.requests == []
+
+
+def test_min_window(stub, tmp_path, monkeypatch):
+    monkeypatch.setattr(flickr_getter, 'MIN_WINDOW', timedelta(days=1))
+
+    # windows can't be split, so the dense day is capped
+    harvester(stub, tmp_path).run(windows())
+    dense = [row for row in read_rows(tmp_path) if int(row['id']) >= 100
+             and row['id'] != '200']
+    assert len(dense) == flickr_getter.RESULT_CAP
@@ -0,0 +1,101 @@
+import numpy as np
+import pytest
+from benchmarks.synthetic_city import synthetic_city, xnode_waypoints
+from cache import RouteCache
+from route_graph import RoutingGraph, Topology, get_route_frontier
+
+
+@pytest.fixture(scope='module')
+def topology():
+    city = synthetic_city(20, 20, 100., nodes_per_block=2, num_photos=3000,
+                          seed=1)
+    return Topology.from_waypoints(xnode_waypoints(city))
+
+
+def endpoints(topology, n, seed=0):
+    rng = np.random.RandomState(seed)
+    return [tuple(int(u) for u in rng.choice(topology.node_ids, 2))
+            for _ in range(n)]
+
+
+def test_frontier_covers_range(topology):
+    for u1, u2 in endpoints(topology, 10):
+        routes = get_route_frontier(topology, u1, u2, 0, 11, 0.5,
+                                    max_searches=100, max_routes=100)
+
+        assert routes[0]['alpha_min'] == 0 and routes[-1]['alpha_max'] == 11
+        for a, b in zip(routes[:-1], routes[1:]):
+            assert a['alpha_max'] == b['alpha_min']
+            assert a['nodes'] != b['nodes']
+
+        # the paths at the ends of the range are the optimal ones
+        for alpha, route in ((0, routes[0]), (11, routes[-1])):
+            rg = RoutingGraph.from_topology(topology, alpha)
+            assert route['nodes'] == rg.get_optimal_path(u1, u2)[0]
+
+
+def weight_at(route, alpha):
+    return sum(e['dist']*e['score']**alpha for e in route['edges'])
+
+
+@pytest.mark.parametrize('limits', [dict(max_searches=100, max_routes=100),
+                                    dict(max_searches=4), dict()])
+def test_frontier_grid_optimal(topology, limits):
+    grid = [k*0.5 for k in range(23)]
+    graphs = {alpha: RoutingGraph.from_topology(topology, alpha)
+              for alpha in grid}
+
+    for u1, u2 in endpoints(topology, 20, seed=1):
+        routes = get_route_frontier(topology, u1, u2, 0, 11, 0.5, **limits)
+
+        for alpha in grid:
+            covering = [r for r in routes
+                        if r['alpha_min'] <= alpha <= r['alpha_max']]
+
+            # alphas are only left to /query when the limits are reached
+            if not covering:
+                assert limits.get('max_routes') != 100
+                continue
+
+            _, edges = graphs[alpha].get_optimal_path(u1, u2)
+            optimal = sum(e['weight'] for e in edges)
+            for route in covering:
+                assert weight_at(route, alpha) == pytest.approx(optimal)
+
+
+def test_frontier_limits(topology):
+    for u1, u2 in endpoints(topology, 10):
+        full = get_route_frontier(topology, u1, u2, 0, 11, 0.5,
+                                  max_searches=100, max_routes=100)
+
+        routes = get_route_frontier(topology, u1, u2, 0, 11, 0.5,
+                                    max_routes=2)
+        assert len({tuple(r['nodes']) for r in routes}) <= 2
+        assert routes[0]['nodes'] == full[0]['nodes']
+        assert routes[-1]['nodes'] == full[-1]['nodes']
+
+        routes = get_route_frontier(topology, u1, u2, 0, 11, 0.5,
+                                    max_searches=3)
+        assert len({tuple(r['nodes']) for r in routes}) <= 3
+        assert routes[0]['alpha_min'] == 0 and routes[-1]['alpha_max'] == 11
+
+
+def test_frontier_single_alpha(topology):
+    (u1, u2), = endpoints(topology, 1)
+    routes = get_route_frontier(topology, u1, u2, 3, 3)
+    assert len(routes) == 1
+    assert (routes[0]['alpha_min'], routes[0]['alpha_max']) == (3, 3)
+
+
+def test_route_cache_frontier_keys():
+    cache = RouteCache(alpha_step=0.5)
+    cache.check_version(1)
+    cache.put_frontier(1, 2, 0, 11, ('polyline', None), ['routes'])
+
+    assert cache.get_frontier(1, 2, 0.1, 11.1, ('polyline', None)) == ['routes']
+    assert cache.get_frontier(1, 2, 0, 11, ('latlngs', None)) is None
+    assert cache.get_frontier(1, 2, 0, 11, ('polyline', 14.)) is None
+    assert cache.get_frontier(2, 1, 0, 11, ('polyline', None)) is None
+
+    cache.check_version(2)
+    assert cache.get_frontier(1, 2, 0, 11, ('polyline', None)) is None
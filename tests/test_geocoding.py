@@ -0,0 +1,194 @@
+import threading
+import time
+from cache import LRUCache
+from collections import namedtuple
+from geocoding import Gazetteer, Geocoder, Location
+
+
+NamedXNode = namedtuple('NamedXNode', ['name', 'node_id', 'lat', 'lon'])
+
+
+class StubGeocoder:
+    """
+    Geocoding service answering from a dict, recording the addresses asked
+    for. Addresses in `block` wait for the event before answering.
+    """
+
+    def __init__(self, places, block=(), event=None):
+        self.places = places
+        self.block = block
+        self.event = event
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def geocode(self, address):
+        with self._lock:
+            self.calls.append(address)
+        if address in self.block:
+            assert self.event.wait(5)
+        latlon = self.places.get(address)
+        return latlon and Location(address.upper(), *latlon)
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self):
+        return self.now
+
+
+def test_lru_eviction():
+    cache = LRUCache(maxsize=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+
+    # 'b' was least recently used
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert len(cache) == 2
+
+
+def test_ttl_expiry():
+    clock = Clock()
+    cache = LRUCache(maxsize=10, ttl=10, timer=clock)
+    cache.put('a', 1)
+    clock.now = 5
+    cache.put('b', 2)
+
+    clock.now = 10
+    assert cache.get('a') == 1
+
+    clock.now = 11
+    assert cache.get('a') is None
+    assert cache.get('b') == 2
+    assert [key for key, _, _ in cache.entries()] == ['b']
+
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses']) == (2, 1)
+
+
+def test_geocode_caches_answers():
+    backend = StubGeocoder({'1 Main St': (37.1, -122.1)})
+    geocoder = Geocoder(backend)
+
+    assert geocoder.geocode('1 Main St') == Location('1 MAIN ST', 37.1, -122.1)
+    assert geocoder.geocode('1  main st') == Location('1 MAIN ST', 37.1, -122.1)
+
+    # unknown addresses are cached too
+    assert geocoder.geocode('nowhere') is None
+    assert geocoder.geocode('Nowhere') is None
+
+    assert backend.calls == ['1 Main St', 'nowhere']
+
+
+def test_cache_persistence(tmp_path):
+    path = str(tmp_path/'geocode.json')
+    backend = StubGeocoder({'1 Main St': (37.1, -122.1)})
+    geocoder = Geocoder(backend)
+    geocoder.geocode('1 Main St')
+    geocoder.geocode('nowhere')
+    geocoder.save_cache(path)
+
+    backend = StubGeocoder({})
+    geocoder = Geocoder(backend, ttl=3600)
+    geocoder.load_cache(path)
+
+    assert geocoder.geocode('1 main st') == Location('1 MAIN ST', 37.1, -122.1)
+    assert geocoder.geocode('nowhere') is None
+    assert backend.calls == []
+
+
+def test_cache_persistence_drops_expired(tmp_path):
+    path = str(tmp_path/'geocode.json')
+    geocoder = Geocoder(StubGeocoder({'1 Main St': (37.1, -122.1)}), ttl=10)
+    geocoder.geocode('1 Main St')
+    geocoder.cache.put('old', Location('old', 1., 2.), stored=0.)
+    geocoder.save_cache(path)
+
+    geocoder = Geocoder(StubGeocoder({}), ttl=10)
+    geocoder.load_cache(path)
+    assert [key for key, _, _ in geocoder.cache.entries()] == ['1 main st']
+
+
+def gazetteer():
+    rows = [
+        NamedXNode('Market Street', 1, 37.780, -122.410),
+        NamedXNode('5th Street', 1, 37.780, -122.410),
+        NamedXNode('Market Street', 2, 37.790, -122.400),
+        NamedXNode('Market Street', 3, 37.800, -122.390),
+        NamedXNode('Van Ness Avenue', 3, 37.800, -122.390),
+    ]
+    return Gazetteer.from_named_xnodes(rows, ['San Francisco', 'CA'])
+
+
+def test_gazetteer_lookup():
+    g = gazetteer()
+
+    # streets resolve to the intersection nearest their middle
+    assert g.lookup('Market St') == Location('Market St', 37.790, -122.400)
+    assert (g.lookup('market street, San Francisco, CA') ==
+            Location('market street, San Francisco, CA', 37.790, -122.400))
+
+    # intersections, in either order and with any separator
+    assert g.lookup('Market St & 5th St')[1:] == (37.780, -122.410)
+    assert g.lookup('5th Street and Market Street')[1:] == (37.780, -122.410)
+    assert g.lookup('Van Ness Ave / Market St')[1:] == (37.800, -122.390)
+
+    # other localities, streets and non-intersections are left to the service
+    assert g.lookup('Market St, Oakland') is None
+    assert g.lookup('Mission St') is None
+    assert g.lookup('5th St & Van Ness Ave') is None
+
+
+def test_gazetteer_before_service():
+    backend = StubGeocoder({'Market St': (0., 0.)})
+    geocoder = Geocoder(backend, gazetteer())
+
+    assert geocoder.geocode('Market St')[1:] == (37.790, -122.400)
+    assert backend.calls == []
+
+
+def test_geocode_all_order():
+    places = {'a': (1., 1.), 'b': (2., 2.), 'c': (3., 3.)}
+    event = threading.Event()
+    backend = StubGeocoder(places, block=('a',), event=event)
+    geocoder = Geocoder(backend, gazetteer(), max_workers=4)
+    geocoder.cache.put('c', Location('C', 3., 3.))
+
+    # 'a' only answers once 'b' has been looked up
+    def release():
+        while 'b' not in backend.calls:
+            time.sleep(0.001)
+        event.set()
+
+    thread = threading.Thread(target=release)
+    thread.start()
+    locs = geocoder.geocode_all(['a', 'Market St', 'b', 'c', 'missing', 'A'])
+    thread.join()
+
+    assert [loc and loc[1:] for loc in locs] == [
+        (1., 1.), (37.790, -122.400), (2., 2.), (3., 3.), None, (1., 1.)]
+
+    # hits are answered without the service, and each miss is asked once
+    assert sorted(backend.calls) == ['a', 'b', 'missing']
+
+
+def test_geocode_all_hits_do_not_wait():
+    event = threading.Event()
+    backend = StubGeocoder({'slow': (1., 1.)}, block=('slow',), event=event)
+    geocoder = Geocoder(backend, gazetteer(), max_workers=1)
+    geocoder.cache.put('cached', Location('cached', 2., 2.))
+
+    # a slow call occupying the only worker
+    pending = geocoder._executor.submit(geocoder.geocode, 'slow')
+
+    locs = geocoder.geocode_all(['cached', 'Market St'])
+    assert [loc[1:] for loc in locs] == [(2., 2.), (37.790, -122.400)]
+
+    event.set()
+    assert pending.result()[1:] == (1., 1.)
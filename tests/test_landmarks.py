@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+from benchmarks.synthetic_city import synthetic_city, xnode_waypoints
+from scenicstroll.route_graph import Landmarks, RoutingGraph, Topology
+
+
+@pytest.fixture(scope='module')
+def topology():
+    city = synthetic_city(20, 20, 100., num_photos=3000, seed=3)
+    return Topology.from_waypoints(xnode_waypoints(city))
+
+
+@pytest.fixture(scope='module')
+def landmarks(topology):
+    return Landmarks.build(topology, [0, 5], 8)
+
+
+def test_bounds_match_tables(topology, landmarks):
+    d = landmarks.distances[1].copy()
+    d[2, 10] = np.inf
+    tables = Landmarks(landmarks.alphas, landmarks.landmarks, d[None],
+                       landmarks.fingerprint)
+    source, target = 3, topology.num_nodes - 4
+    to_target, from_source = tables.heuristics(0, source, target, 3)
+
+    # the same bounds as from the whole tables of the 3 best landmarks
+    gap = np.abs(d[:, target] - d[:, source])
+    active = d[np.argsort(-np.where(np.isfinite(gap), gap, -1))[:3]]
+    for node, h in ((target, to_target), (source, from_source)):
+        with np.errstate(invalid='ignore'):
+            expected = np.abs(active - active[:, node, None]).max(axis=0)
+        expected[~np.isfinite(expected)] = 0.
+        assert [h(v) for v in range(topology.num_nodes)] == expected.tolist()
+        assert h(10) == expected[10]
+
+
+@pytest.mark.parametrize('method', ['astar', 'bidirectional'])
+def test_landmark_search_optimal(topology, landmarks, method):
+    rng = np.random.RandomState(0)
+    for alpha in landmarks.alphas:
+        plain = RoutingGraph.from_topology(topology, alpha)
+        rg = RoutingGraph.from_topology(topology, alpha, landmarks)
+
+        for u1, u2 in rng.choice(topology.node_ids, (10, 2)).tolist():
+            expected = sum(e['weight']
+                           for e in plain.get_optimal_path(u1, u2)[1])
+            weight = sum(e['weight']
+                         for e in rg.get_optimal_path(u1, u2, method)[1])
+            assert weight == pytest.approx(expected)
@@ -0,0 +1,235 @@
+import parse_osm
+import pytest
+import struct
+import zlib
+from collections import defaultdict
+from parse_osm import _pbf_blocks, _xml_blocks, bulk_parse_osm
+
+
+BBOX = (-122.6, 37.6, -122.3, 37.9)
+
+# (id, lon, lat), as written in XML with 7 decimals
+NODES = [
+    (101, '-122.4194155', '37.7749295'),
+    (102, '-122.4183000', '37.7755100'),
+    (103, '-122.4171234', '37.7761007'),
+    (104, '-122.4160001', '37.7768999'),
+    (105, '-122.4148765', '37.7775432'),
+    (-7, '-122.4137000', '37.7781000'),
+    (2200000000, '-122.4125111', '37.7790222'),
+    (106, '-121.9000000', '37.7700000'),     # outside the bbox
+]
+
+# (id, tags, refs)
+WAYS = [
+    (1, [('highway', 'residential'), ('name', 'Market Street')],
+     [101, 102, 103]),
+    (2, [('name', 'Caño St\tWest'), ('highway', 'footway')],
+     [103, 104, 106, 105]),
+    (3, [('highway', 'motorway'), ('name', 'Freeway')], [101, 105]),
+    (4, [('building', 'yes')], [102, 104, 105]),
+    (5, [('highway', 'path')], [105, -7, 2200000000, 101]),
+    (6000000000, [('highway', 'steps'), ('name', 'A & B <steps>')],
+     [2200000000, 104]),
+]
+
+
+def write_xml(path):
+    def escape(s):
+        return (s.replace('&', '&amp;').replace('<', '&lt;')
+                .replace('>', '&gt;').replace('"', '&quot;')
+                .replace('\t', '&#9;'))
+
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+             '<osm version="0.6">']
+    for node_id, lon, lat in NODES:
+        lines.append('<node id="{}" lat="{}" lon="{}"/>'.format(
+            node_id, lat, lon))
+    for way_id, tags, refs in WAYS:
+        lines.append('<way id="{}">'.format(way_id))
+        lines.extend('<nd ref="{}"/>'.format(r) for r in refs)
+        lines.extend('<tag k="{}" v="{}"/>'.format(escape(k), escape(v))
+                     for k, v in tags)
+        lines.append('</way>')
+    lines.append('</osm>')
+
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines))
+
+
+# protobuf encoding, just enough for the PBF fixture
+
+def varint(n):
+    n &= (1 << 64) - 1
+    out = bytearray()
+    while True:
+        b, n = n & 0x7f, n >> 7
+        out.append(b | 0x80 if n else b)
+        if not n:
+            return bytes(out)
+
+
+def zigzag(n):
+    return (n << 1) ^ (n >> 63)
+
+
+def field(number, value):
+    if isinstance(value, int):
+        return varint(number << 3) + varint(value)
+    return varint(number << 3 | 2) + varint(len(value)) + value
+
+
+def packed(values):
+    return b''.join(varint(v) for v in values)
+
+
+def deltas(values):
+    return [b - a for a, b in zip([0] + values[:-1], values)]
+
+
+def nanodegrees(s):
+    # exact, from the decimal string, in units of the default granularity
+    whole, frac = s.lstrip('-').split('.')
+    n = int(whole)*10**7 + int(frac.ljust(7, '0'))
+    return -n if s.startswith('-') else n
+
+
+def fileblock(blob_type, block):
+    blob = field(2, len(block)) + field(3, zlib.compress(block))
+    header = field(1, blob_type.encode('utf-8')) + field(3, len(blob))
+    return struct.pack('>i', len(header)) + header + blob
+
+
+def write_pbf(path):
+    strings = ['']
+    index = {}
+
+    def string(s):
+        if s not in index:
+            index[s] = len(strings)
+            strings.append(s)
+        return index[s]
+
+    # the first node plain, the others dense, in one block
+    node_id, lon, lat = NODES[0]
+    plain = (field(1, zigzag(node_id)) +
+             field(8, zigzag(nanodegrees(lat))) +
+             field(9, zigzag(nanodegrees(lon))))
+
+    ids = [n[0] for n in NODES[1:]]
+    lats = [nanodegrees(n[2]) for n in NODES[1:]]
+    lons = [nanodegrees(n[1]) for n in NODES[1:]]
+    dense = (field(1, packed(zigzag(d) for d in deltas(ids))) +
+             field(8, packed(zigzag(d) for d in deltas(lats))) +
+             field(9, packed(zigzag(d) for d in deltas(lons))))
+
+    groups = field(1, plain) + field(2, dense)
+    table = b''.join(field(1, s.encode('utf-8')) for s in strings)
+    nodes_block = field(1, table) + field(2, groups)
+
+    # the ways in a second block
+    strings[1:] = []
+    index.clear()
+    group = b''
+    for way_id, tags, refs in WAYS:
+        way = (field(1, way_id) +
+               field(2, packed(string(k) for k, _ in tags)) +
+               field(3, packed(string(v) for _, v in tags)) +
+               field(8, packed(zigzag(d) for d in deltas(refs))))
+        group += field(3, way)
+    table = b''.join(field(1, s.encode('utf-8')) for s in strings)
+    ways_block = field(1, table) + field(2, group) + field(17, 100)
+
+    with open(path, 'wb') as f:
+        f.write(fileblock('OSMHeader', field(4, b'OsmSchema-V0.6')))
+        f.write(fileblock('OSMData', nodes_block))
+        f.write(fileblock('OSMData', ways_block))
+
+
+@pytest.fixture
+def fixtures(tmp_path):
+    xml, pbf = str(tmp_path/'fixture.osm'), str(tmp_path/'fixture.osm.pbf')
+    write_xml(xml)
+    write_pbf(pbf)
+    return xml, pbf
+
+
+def concatenated(blocks):
+    num_elements, nodes, ways = 0, [], []
+    for n, block_nodes, block_ways in blocks:
+        num_elements += n
+        nodes.extend(block_nodes)
+        ways.extend(block_ways)
+    return num_elements, nodes, ways
+
+
+def test_blocks_identical(fixtures):
+    xml, pbf = fixtures
+
+    from_xml = concatenated(_xml_blocks(xml, BBOX, block_size=3))
+    from_pbf = concatenated(_pbf_blocks(pbf, BBOX, processes=2))
+
+    assert from_xml == from_pbf
+
+    num_elements, nodes, ways = from_pbf
+    assert num_elements == len(NODES) + len(WAYS)
+    assert [n[0] for n in nodes] == [n[0] for n in NODES[:-1]]
+    assert nodes[0] == (101, -122.4194155, 37.7749295)
+    assert [w[0] for w in ways] == [1, 2, 5, 6000000000]
+    assert ways[1][1] == 'Caño St\tWest'
+
+
+class RecordingSession:
+    """
+    Just enough of a session for `bulk_parse_osm`, recording the rows
+    copied into each table.
+    """
+
+    def __init__(self):
+        self.tables = defaultdict(list)
+        self.added = []
+
+    def add(self, obj):
+        self.added.append(obj)
+
+    def flush(self):
+        pass
+
+    def commit(self):
+        pass
+
+    def connection(self):
+        session = self
+
+        class Connection:
+            class connection:
+                @staticmethod
+                def cursor():
+                    return session
+
+        return Connection
+
+    def copy_expert(self, sql, f):
+        self.tables[sql.split()[1]].extend(f.read().splitlines())
+
+
+class NullLog:
+    def write(self, mesg):
+        pass
+
+
+def test_copy_rows_identical(fixtures, monkeypatch):
+    monkeypatch.setattr(parse_osm.RouteDB, 'bump_data_version',
+                        lambda self: 1)
+
+    tables = []
+    for path in fixtures:
+        session = RecordingSession()
+        bulk_parse_osm(path, session, BBOX, NullLog(), batch_size=2,
+                       processes=2)
+        tables.append(dict(session.tables))
+
+    assert tables[0] == tables[1]
+    assert set(tables[0]) == {'way', 'waypoint', 'node'}
+    assert len(tables[0]['node']) == len(NODES) - 1
+    assert tables[0]['way'][1] == '2\tCaño St\\tWest\t9'
@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+from route_db import score_nodes
+from scenery import GridKDE, normalize_scores
+
+
+def photos_and_nodes(seed=0):
+    rng = np.random.RandomState(seed)
+    lon0, lat0 = -122.42, 37.77
+
+    # photos around a few hotspots, and nodes spread over the same area
+    centers = rng.uniform(-0.02, 0.02, (5, 2))
+    photos = (centers[rng.randint(5, size=5000)] +
+              rng.normal(0, 0.004, (5000, 2)) + (lon0, lat0))
+    nodes = rng.uniform(-0.025, 0.025, (2000, 2)) + (lon0, lat0)
+    return photos, nodes
+
+
+def chunks(nodes, size=300):
+    for i in range(0, len(nodes), size):
+        yield np.arange(i, min(i + size, len(nodes))), nodes[i:i + size]
+
+
+def test_default_normalization_matches_sklearn():
+    KernelDensity = pytest.importorskip('sklearn.neighbors').KernelDensity
+
+    photos, nodes = photos_and_nodes()
+    model = GridKDE(bandwidth=200.).fit(photos)
+
+    # as RouteDB.update_scores scores nodes, without passing normalize
+    ids, scores = score_nodes(model, chunks(nodes), processes=1)
+    assert ids.tolist() == list(range(len(nodes)))
+
+    # the exact estimate in the same projected metres, normalized over all
+    # nodes as in the notebook
+    project = lambda X: np.column_stack(model._project(X[:, 0], X[:, 1]))
+    kde = KernelDensity(bandwidth=200.).fit(project(photos))
+    expected = normalize_scores(kde.score_samples(project(nodes)))
+
+    assert ((scores > 0) & (scores <= 1)).all()
+
+    # the grid truncates the kernel at 4 bandwidths, so nodes far from every
+    # photo get less scenic scores, up to the least scenic one
+    P, N = project(photos), project(nodes)
+    nearest = np.sqrt(((N[:, None] - P[None])**2).sum(axis=2)).min(axis=1)
+    near = nearest <= 3*200.
+    assert near.mean() > 0.5
+    assert np.abs(scores - expected)[near].max() < 2e-3
+    assert (scores[~near] >= expected[~near] - 2e-3).all()
+
+
+def test_explicit_normalization():
+    photos, nodes = photos_and_nodes(1)
+    model = GridKDE(bandwidth=200.).fit(photos)
+
+    _, scores = score_nodes(model, chunks(nodes), processes=1,
+                            normalize=lambda s: s)
+    assert np.allclose(scores, model.score_samples(nodes))